@@ -1,41 +1,564 @@
 import tkinter as tk
 from tkinter import filedialog, ttk
+import tkinter.font  # (tk.font - вимірювання ширини тексту умов)
 import re
 from PIL import ImageGrab, Image
+import numpy as np
 import io
+import argparse
+import base64
+import bisect
+import difflib
+import functools
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape as xml_escape
 
 # --- 1. ГЛОБАЛЬНІ ЗМІННІ ТА КОНФІГУРАЦІЯ ---
 
-# Словник для зберігання псевдокоду, розбитого по функціях
+# Словник для зберігання псевдокоду, розбитого по функціях (парситься ліниво, див. LazyFunctionCodeMap)
 FUNCTION_CODE_MAP = {}
-GLOBAL_TEXT_SCALE_FACTOR = 1.0
-# Стан для відстеження перетягування об'єктів на полотні
-drag_data = {"item": None, "x": 0, "y": 0, "arrow_id": None, "point_index": -1}
-
-# Словники для відстеження зв'язків між стрілками та блоками
-ARROW_CONNECTIONS = {}  # {arrow_id: {'source_tag': str, 'target_tag': str}}
-BLOCK_TO_ARROWS = {}  # {block_group_tag: [arrow_id, ...]}
 
 # Крок сітки для візуального вирівнювання (в пікселях)
 GRID_SIZE = 25
 
 # Базові розміри та відступи для елементів схеми
 ZOOM_STEP_MULTIPLIER = 1.1
-GLOBAL_SCALE_FACTOR_X = 1.0
-GLOBAL_SCALE_FACTOR_Y = 1.0
 X_CENTER_DEFAULT = 400  # Початкова X-координата центру діаграми
 Y_START = 50  # Початкова Y-координата для першого блоку
 BLOCK_WIDTH_DEFAULT = 200  # Базова ширина блоку
 BLOCK_HEIGHT_DEFAULT = 65  # Базова (мінімальна) висота блоку
 V_SPACING_DEFAULT = 50  # Базовий вертикальний відступ між блоками
-BASE_H_OFFSET_DEFAULT = 270  # Базовий горизонтальний зсув для гілок (if/loop)
-NEST_OFFSET_STEP_DEFAULT = 70  # Додатковий зсув для вкладених рівнів
+BRANCH_GAP_DEFAULT = 50  # Мінімальний горизонтальний проміжок між гілками 'if' (x "Зсув IF")
+LOOP_LANE_GAP_DEFAULT = 30  # Відступ лінії повернення/виходу циклу від його тіла (x "Зсув циклів")
 BRANCH_V_SPACING_DEFAULT = 30  # Малий верт. відступ для початку гілки
 PORT_SNAPPING_TOLERANCE = 25  # Радіус (px) для "прилипання" стрілки до порту
+PORT_RADIUS = 3  # Радіус зони "прилипання" самого порту
+
+# Режим сторінок (схема ділиться на сторінки з міжсторінковими з'єднувачами)
+PAGE_HEIGHT_DEFAULT = 2000  # Висота сторінки, px (разом з полями)
+PAGE_WIDTH_DEFAULT = 1400  # Ширина сторінки, px (ширше - лише попередження: схема ділиться по висоті)
+
+# Кеш готових сцен (розкладка + елементи полотна) для швидкого перемикання функцій
+SCENE_CACHE = OrderedDict()  # {cache_key: scene}, порядок = давність використання (LRU)
+SCENE_CACHE_MAX_ITEMS = 60000  # Ліміт сумарної кількості елементів полотна у кеші
+
+# Поступовий рендеринг великих схем (частинами, між якими вікно обробляє події)
+PROGRESSIVE_RENDER_MIN_ITEMS = 4000  # Сцени з такою кількістю елементів і більше малюються частинами
+RENDER_CHUNK_BUDGET_MS = 15  # Час на створення однієї частини елементів, мс
+RENDER_CHUNK_DELAY_MS = 1  # Пауза між частинами (обробка подій та перемальовування), мс
+
+# Плаваючий початок координат: сцена - у світових координатах будь-якого розміру,
+# полотно показує її зі зсувом на ctx.origin_x/origin_y (координати полотна залишаються малими)
+ORIGIN_REBASE_DISTANCE = 4000  # Видима область далі від (0, 0) полотна - початок переноситься до неї, px
+GRID_WINDOW = 12000  # Сітка малюється лише у вікні ±GRID_WINDOW навколо (0, 0) полотна, px
+
+# Паралельний парсинг функцій (пул процесів)
+PARALLEL_PARSE_MIN_TOKENS = 50000  # Нижче цього сумарного розміру тіл парсимо послідовно
+PARALLEL_PARSE_MIN_FUNCTIONS = 4  # Мінімальна кількість функцій для запуску пулу
+
+# Дисковий кеш результатів парсингу (ключ - хеш вмісту файлу та версії парсера)
+PARSER_VERSION = 2  # Збільшувати при будь-якій зміні токенізатора/парсера
+PARSE_CACHE_DIR = os.environ.get("AUTOASD_CACHE_DIR",
+                                 os.path.join(os.path.expanduser("~"), ".cache", "autoasd"))
+PARSE_CACHE_MAGIC = b"AASDPRS1"  # Сигнатура файлу кешу
+PARSE_CACHE_MAX_FILES = 200  # Максимальна кількість файлів у кеші (найдавніше використані видаляються)
+
+WATCH_POLL_MS = 700  # Період перевірки змін вихідного файлу (режим стеження), мс
+EDGE_POINTS_COMPACT_MIN = 256  # Мінімум мертвих рядків точок стрілок, з якого GeometryStore їх ущільнює
+
+
+# --- 1.1. КОНТЕКСТ ДІАГРАМИ ТА РЕЄСТР БЛОКІВ ---
+
+def _grow_rows(array, size, fill=0):
+    """Повертає масив з місткістю не менше size рядків (подвоєння, як у list)."""
+    if size <= len(array):
+        return array
+    capacity = max(size, 2 * len(array), 16)
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class GeometryStore:
+    """
+    Колонкове сховище геометрії діаграми (NumPy).
+
+    Межі блоків - масив N×4 (рядок = ID блоку), точки стрілок - плоский
+    масив M×2 та зсуви (перша точка, кількість точок) для кожної стрілки.
+    Зсув, масштаб, межі вмісту, пошук блоку/порту та відносні точки для
+    експорту рахуються векторно; полотно та експортери беруть координати звідси.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Видаляє всю геометрію (перед перемальовуванням)."""
+        self.rects = np.full((0, 4), np.nan)  # [x0, y0, x1, y1], NaN - блок ще не має меж
+        self.four_ports = np.zeros(0, dtype=bool)  # Ромби мають 4 порти (T, L, R, B), решта - 2 (T, B)
+        self.block_count = 0
+
+        self.points = np.zeros((0, 2))  # Точки всіх стрілок підряд (NaN - рядок не належить жодній стрілці)
+        self.point_count = 0
+        self.edge_start = np.zeros(0, dtype=np.int64)  # Індекс першої точки стрілки у points
+        self.edge_length = np.zeros(0, dtype=np.int64)  # Кількість точок стрілки
+        self.edge_capacity = np.zeros(0, dtype=np.int64)  # Рядків у points, відведених стрілці (>= edge_length)
+        self.dead_points = 0  # Рядки points, що не належать жодній стрілці (після переносу стрілок)
+        self.edge_ids = []  # ID стрілок на полотні (за індексом стрілки)
+        self.edge_index = {}  # {arrow_id: індекс стрілки}
+
+    # --- Блоки ---
+
+    def set_block_rect(self, block_id, rect, four_ports=False):
+        """Записує межі блоку (рядок block_id)."""
+        self.rects = _grow_rows(self.rects, block_id + 1, np.nan)
+        self.four_ports = _grow_rows(self.four_ports, block_id + 1, False)
+        self.rects[block_id] = rect
+        self.four_ports[block_id] = four_ports
+        self.block_count = max(self.block_count, block_id + 1)
+
+    def block_rect(self, block_id):
+        """Межі блоку (x0, y0, x1, y1) або None."""
+        if block_id >= self.block_count or np.isnan(self.rects[block_id, 0]):
+            return None
+        return tuple(self.rects[block_id].tolist())
+
+    def translate_block(self, block_id, dx, dy):
+        """Зсуває межі блоку."""
+        self.rects[block_id] += (dx, dy, dx, dy)
+
+    def blocks_at(self, x, y, tolerance=0):
+        """ID блоків, межі яких (з допуском) містять точку, - верхні (пізніші) першими."""
+        rects = self.rects[:self.block_count]
+        with np.errstate(invalid="ignore"):
+            hit = ((rects[:, 0] - tolerance <= x) & (x <= rects[:, 2] + tolerance) &
+                   (rects[:, 1] - tolerance <= y) & (y <= rects[:, 3] + tolerance))
+        return np.flatnonzero(hit)[::-1].tolist()
+
+    def ports(self):
+        """
+        Точки прив'язки всіх блоків: (координати P×2, ID блоків P).
+        Порядок - як у старих невидимих портах полотна: за блоками, T(, L, R), B.
+        """
+        rects = self.rects[:self.block_count]
+        valid = ~np.isnan(rects[:, 0])
+        block_ids = np.flatnonzero(valid)
+        rects = rects[valid]
+        four = self.four_ports[:self.block_count][valid]
+        cx = (rects[:, 0] + rects[:, 2]) / 2
+        cy = (rects[:, 1] + rects[:, 3]) / 2
+
+        # (номер порту в межах блоку, x, y, маска)
+        candidates = [
+            (0, cx, rects[:, 1], np.ones(len(rects), dtype=bool)),  # Вхід (зверху)
+            (1, rects[:, 0], cy, four),  # Вихід 'False' (зліва)
+            (2, rects[:, 2], cy, four),  # Вихід 'True' (справа)
+            (3, cx, rects[:, 3], np.ones(len(rects), dtype=bool)),  # Вихід / з'єднання (знизу)
+        ]
+        order = np.concatenate([block_ids[mask] * 4 + slot for slot, _, _, mask in candidates])
+        xy = np.concatenate([np.column_stack((px[mask], py[mask])) for _, px, py, mask in candidates])
+        owners = np.concatenate([block_ids[mask] for _, _, _, mask in candidates])
+        sort = np.argsort(order, kind="stable")
+        return xy[sort], owners[sort]
+
+    def nearest_ports(self, query_xy, tolerance):
+        """
+        Для кожної точки (Q×2) шукає найближчий порт у квадраті ±tolerance.
+
+        Повертає (координати Q×2 - порт або сама точка, ID блоків Q; -1 - не знайдено).
+        """
+        query_xy = np.asarray(query_xy, dtype=float).reshape(-1, 2)
+        snapped = query_xy.copy()
+        owners_out = np.full(len(query_xy), -1, dtype=np.int64)
+        port_xy, owners = self.ports()
+        if not len(port_xy) or not len(query_xy):
+            return snapped, owners_out
+
+        reach = tolerance + PORT_RADIUS
+        # Обробляємо частинами, щоб матриця відстаней Q×P не росла необмежено
+        chunk = max(1, 1_000_000 // len(port_xy))
+        for start in range(0, len(query_xy), chunk):
+            q = query_xy[start:start + chunk]
+            delta = port_xy[None, :, :] - q[:, None, :]
+            in_reach = (np.abs(delta) <= reach).all(axis=2)
+            distance = np.where(in_reach, np.hypot(delta[..., 0], delta[..., 1]), np.inf)
+            # При рівних відстанях перемагає пізніший (верхній) порт
+            best = len(port_xy) - 1 - np.argmin(distance[:, ::-1], axis=1)
+            found = np.isfinite(distance[np.arange(len(q)), best])
+            rows = np.flatnonzero(found) + start
+            snapped[rows] = port_xy[best[found]]
+            owners_out[rows] = owners[best[found]]
+        return snapped, owners_out
+
+    def relative_points(self, query_xy, block_ids):
+        """Відносні (0..1) координати точок у межах заданих блоків (для draw.io)."""
+        query_xy = np.asarray(query_xy, dtype=float).reshape(-1, 2)
+        rects = self.rects[np.asarray(block_ids, dtype=np.int64)]
+        size = rects[:, 2:] - rects[:, :2]
+        degenerate = (size == 0).any(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rel = np.clip((query_xy - rects[:, :2]) / size, 0.0, 1.0)
+        rel[degenerate] = 0.5  # (Центр за замовчуванням)
+        return rel
+
+    # --- Стрілки ---
+
+    def add_edge(self, arrow_id, coords):
+        """Додає ламану стрілки (плоский список координат x0, y0, x1, y1, ...)."""
+        xy = np.asarray(coords, dtype=float).reshape(-1, 2)
+        index = len(self.edge_ids)
+        self.points = _grow_rows(self.points, self.point_count + len(xy))
+        self.points[self.point_count:self.point_count + len(xy)] = xy
+        self.edge_start = _grow_rows(self.edge_start, index + 1)
+        self.edge_length = _grow_rows(self.edge_length, index + 1)
+        self.edge_capacity = _grow_rows(self.edge_capacity, index + 1)
+        self.edge_start[index] = self.point_count
+        self.edge_length[index] = len(xy)
+        self.edge_capacity[index] = len(xy)
+        self.point_count += len(xy)
+        self.edge_ids.append(arrow_id)
+        self.edge_index[arrow_id] = index
+
+    def edge_points(self, arrow_id):
+        """Точки стрілки (вид K×2 на спільний масив - зміни пишуться прямо у сховище)."""
+        index = self.edge_index[arrow_id]
+        start = self.edge_start[index]
+        return self.points[start:start + self.edge_length[index]]
+
+    def edge_coords(self, arrow_id):
+        """Плоский список координат стрілки (для canvas.coords)."""
+        return self.edge_points(arrow_id).ravel().tolist()
+
+    def set_edge_coords(self, arrow_id, coords):
+        """
+        Замінює точки стрілки. Якщо вони вміщуються у відведені стрілці рядки,
+        пишуться на місце; інакше стрілка переноситься в кінець масиву, а
+        звільнені рядки ущільнюються, коли їх стає забагато.
+        """
+        xy = np.asarray(coords, dtype=float).reshape(-1, 2)
+        index = self.edge_index[arrow_id]
+        start = self.edge_start[index]
+        capacity = self.edge_capacity[index]
+        if len(xy) <= capacity:
+            self.points[start:start + len(xy)] = xy
+            self.points[start + len(xy):start + capacity] = np.nan  # (Запас слоту - поза межами вмісту)
+            self.edge_length[index] = len(xy)
+            return
+
+        self.points[start:start + capacity] = np.nan  # (Старий слот - мертвий)
+        self.dead_points += capacity
+        self.points = _grow_rows(self.points, self.point_count + len(xy))
+        self.points[self.point_count:self.point_count + len(xy)] = xy
+        self.edge_start[index] = self.point_count
+        self.edge_length[index] = len(xy)
+        self.edge_capacity[index] = len(xy)
+        self.point_count += len(xy)
+        if self.dead_points > max(EDGE_POINTS_COMPACT_MIN, self.point_count // 2):
+            self._compact_points()
+
+    def _compact_points(self):
+        """Переписує точки всіх стрілок підряд, прибираючи мертві рядки та запас слотів."""
+        count = len(self.edge_ids)
+        lengths = self.edge_length[:count].copy()
+        starts = self.edge_start[:count]
+        if count:
+            rows = np.concatenate([np.arange(start, start + length) for start, length in zip(starts, lengths)])
+            live = self.points[rows]
+        else:
+            live = np.zeros((0, 2))
+        self.points = _grow_rows(np.zeros((0, 2)), len(live))
+        self.points[:len(live)] = live
+        self.point_count = len(live)
+        self.edge_start[:count] = np.concatenate(([0], np.cumsum(lengths)[:-1])) if count else lengths
+        self.edge_capacity[:count] = lengths
+        self.dead_points = 0
+
+    def edge_endpoints(self):
+        """Перші та останні точки всіх стрілок: (E×2, E×2)."""
+        count = len(self.edge_ids)
+        first = self.edge_start[:count]
+        last = first + self.edge_length[:count] - 1
+        return self.points[first], self.points[last]
+
+    # --- Уся сцена ---
+
+    def translate(self, dx, dy):
+        """Зсуває всю геометрію (разом з canvas.move("all", ...) при перенесенні початку координат)."""
+        self.rects[:self.block_count] += (dx, dy, dx, dy)
+        self.points[:self.point_count] += (dx, dy)
+
+    def scale(self, factor):
+        """Масштабує всю геометрію відносно (0, 0) (разом з canvas.scale("all", 0, 0, ...))."""
+        self.rects[:self.block_count] *= factor
+        self.points[:self.point_count] *= factor
+
+    def bounds(self):
+        """Межі вмісту (блоки та стрілки): (x0, y0, x1, y1) або None, якщо сцена порожня."""
+        rects = self.rects[:self.block_count]
+        rects = rects[~np.isnan(rects[:, 0])]
+        points = self.points[:self.point_count]
+        points = points[~np.isnan(points[:, 0])]
+        if not len(rects) and not len(points):
+            return None
+        xs = np.concatenate((rects[:, 0], rects[:, 2], points[:, 0]))
+        ys = np.concatenate((rects[:, 1], rects[:, 3], points[:, 1]))
+        return float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())
+
+
+class BlockRecord:
+    """
+    Запис реєстру блоків: стабільний ID (призначається під час розкладки),
+    тип, текст, елементи полотна та приєднані стрілки. Межі блоку
+    зберігаються у GeometryStore контексту.
+    """
+    __slots__ = ("block_id", "kind", "text", "tag", "items", "edges", "_geometry")
+
+    def __init__(self, block_id, kind, text, geometry):
+        self.block_id = block_id
+        self.kind = kind  # "ell", "rect", "rhombus", "sub", "para", "hex", "fold", "conn"
+        self.text = text  # Текст, показаний у блоці
+        self.tag = f"{kind}_{block_id}"  # Тег групи елементів блоку на полотні
+        self.items = []  # ID елементів полотна (фігура - перша)
+        self.edges = set()  # ID приєднаних стрілок
+        self._geometry = geometry
 
-# Глобальні мапи для зв'язку ID, тексту та стрілок
-BLOCK_TEXT_MAP = {}  # {block_group_tag: "Текст блоку"}
-BLOCK_ID_COUNTER = 0  # Унікальний лічильник для ID блоків
+    @property
+    def rect(self):
+        """(x0, y0, x1, y1) - зовнішні межі фігури або None."""
+        return self._geometry.block_rect(self.block_id)
+
+    def center(self):
+        """Центр блоку (x, y)."""
+        x0, y0, x1, y1 = self.rect
+        return (x0 + x1) / 2, (y0 + y1) / 2
+
+
+class DiagramContext:
+    """
+    Увесь змінний стан однієї діаграми: реєстр блоків, геометрія, зв'язки
+    стрілок, масштаб та стан перетягування.
+
+    Кожне полотно має власний контекст, тому кілька діаграм (вікна, кеш,
+    фонова розкладка) не заважають одна одній.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+
+        # Реєстр блоків та зворотна мапа "елемент полотна -> блок"
+        self.blocks = {}  # {block_id: BlockRecord}
+        self.item_to_block = {}  # {canvas_item_id: block_id}
+        self.block_id_counter = 0  # Наступний вільний ID блоку
+
+        # Координати блоків та стрілок (NumPy)
+        self.geometry = GeometryStore()
+
+        # Зв'язки стрілок з блоками (зворотні зв'язки - у BlockRecord.edges)
+        self.arrow_connections = {}  # {arrow_id: {'source': block_id, 'target': block_id}}
+
+        # Візуальний масштаб (Zoom) та масштаб тексту
+        self.scale_x = 1.0
+        self.scale_y = 1.0
+        self.text_scale = 1.0
+
+        # Плаваючий початок координат: світова точка, що на полотні має координати (0, 0)
+        # (світові координати = координати полотна + origin; масштабуються разом зі сценою)
+        self.origin_x = 0.0
+        self.origin_y = 0.0
+
+        # Стан для відстеження перетягування об'єктів на полотні
+        self.drag = {"item": None, "x": 0, "y": 0, "arrow_id": None, "point_index": -1}
+
+        # Незавершений поступовий рендеринг сцени (SceneRenderer) або None
+        self.render_job = None
+
+        # Дерево конструкцій поточної функції (з вимірами розкладки) та згорнуті вузли
+        self.flow_tree = None  # {"key": (хеш коду, skip_init), "nodes": [...], "index": {рядок: вузол}}
+        self.collapsed = {}  # {хеш коду функції: {рядок псевдокоду згорнутого складеного вузла}}
+        self.block_nodes = {}  # {block_id: рядок складеного вузла} - заголовки та згорнуті блоки сцени
+        self.block_lines = {}  # {block_id: рядок простого вузла} - решта блоків сцени (для пошуку)
+
+    def reset_scene(self):
+        """Скидає стан, що належить намальованій сцені (перед перемальовуванням)."""
+        self.blocks.clear()
+        self.item_to_block.clear()
+        self.block_id_counter = 0
+        self.geometry.clear()
+        self.arrow_connections.clear()
+        self.block_nodes.clear()
+        self.block_lines.clear()
+
+    def new_block(self, kind, text, block_id=None):
+        """Створює запис блоку з наступним (або заданим) ID та додає його до реєстру."""
+        if block_id is None:
+            block_id = self.block_id_counter
+        self.block_id_counter = max(self.block_id_counter, block_id + 1)
+        block = BlockRecord(block_id, kind, text, self.geometry)
+        self.blocks[block_id] = block
+        return block
+
+    def register_block_items(self, block, rect, item_ids, four_ports=False):
+        """Запам'ятовує межі блоку та елементи полотна, з яких він складається."""
+        self.geometry.set_block_rect(block.block_id, rect, four_ports)
+        block.items.extend(item_ids)
+        for item_id in item_ids:
+            self.item_to_block[item_id] = block.block_id
+
+    def block_for_item(self, item_id):
+        """Повертає BlockRecord, якому належить елемент полотна, або None."""
+        block_id = self.item_to_block.get(item_id)
+        return None if block_id is None else self.blocks[block_id]
+
+    def rebase_origin(self, dx, dy):
+        """
+        Переносить початок координат полотна на (dx, dy): усі елементи та
+        геометрія зсуваються на (-dx, -dy), світові координати не змінюються.
+        """
+        self.canvas.move("all", -dx, -dy)
+        self.geometry.translate(-dx, -dy)
+        self.origin_x += dx
+        self.origin_y += dy
+
+    def scale_origin(self, factor):
+        """Зум відносно (0, 0) полотна: світові координати масштабуються разом з полотном."""
+        self.origin_x *= factor
+        self.origin_y *= factor
+
+
+# --- 1.2. ВИМІРЮВАННЯ ПРОДУКТИВНОСТІ ---
+
+class PerfStats:
+    """
+    Постійне легке вимірювання: тривалість етапів (perf_counter), лічильники
+    (створені елементи Tk, виклики Tcl, влучання в кеш) та перемальовування
+    за джерелом. Показується у панелі продуктивності та зберігається в JSON.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Очищує всі виміри."""
+        with self.lock:
+            self.stages = {}  # {етап: [кількість, сума_с, остання_с, максимум_с]}
+            self.counters = {}  # {лічильник: значення}
+            self.redraws = {}  # {джерело: кількість перемальовувань}
+            self.started = time.time()
+
+    def add_time(self, stage, seconds):
+        """Додає один вимір тривалості етапу."""
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = [0, 0.0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = seconds
+            entry[3] = max(entry[3], seconds)
+
+    @contextmanager
+    def span(self, stage):
+        """Вимірює тривалість блоку with як етап stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        """Декоратор: кожен виклик функції - вимір етапу stage."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, amount=1):
+        """Збільшує лічильник."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def redraw(self, trigger):
+        """Рахує перемальовування за джерелом (повзунок, меню, live reload...)."""
+        with self.lock:
+            self.redraws[trigger] = self.redraws.get(trigger, 0) + 1
+
+    def as_dict(self):
+        """Знімок вимірів (мс) для JSON."""
+        with self.lock:
+            stages = {stage: {"count": count, "total_ms": total * 1000, "last_ms": last * 1000,
+                              "max_ms": longest * 1000, "mean_ms": total * 1000 / count}
+                      for stage, (count, total, last, longest) in self.stages.items()}
+            return {"started": self.started, "elapsed_s": time.time() - self.started, "stages": stages,
+                    "counters": dict(self.counters), "redraws": dict(self.redraws)}
+
+    def dump_json(self, filepath):
+        """Зберігає знімок вимірів у JSON (для порівняння між запусками)."""
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(self.as_dict(), f, ensure_ascii=False, indent=2)
+
+    def report(self):
+        """Текстовий звіт для панелі продуктивності."""
+        data = self.as_dict()
+        lines = [f"{'Етап':<28}{'N':>6}{'Ост.':>9}{'Макс.':>9}{'Сума':>10}  (мс)"]
+        for stage, entry in sorted(data["stages"].items(), key=lambda item: -item[1]["total_ms"]):
+            lines.append(f"{stage:<28}{entry['count']:>6}{entry['last_ms']:>9.1f}{entry['max_ms']:>9.1f}"
+                         f"{entry['total_ms']:>10.1f}")
+        lines.append("")
+        lines.extend(f"{name}: {value}" for name, value in sorted(data["counters"].items()))
+        if data["redraws"]:
+            lines.append("")
+            lines.append("Перемальовування:")
+            lines.extend(f"  {trigger}: {count}" for trigger, count in
+                         sorted(data["redraws"].items(), key=lambda item: -item[1]))
+        return "\n".join(lines)
+
+
+class TclCallCounter:
+    """
+    Обгортка інтерпретатора Tcl віджета (widget.tk): рахує виклики call() -
+    усі методи полотна (create_*, coords, itemconfigure...) проходять через нього.
+    """
+
+    def __init__(self, tkapp, stats):
+        self._tkapp = tkapp
+        self._stats = stats
+
+    def call(self, *args):
+        self._stats.count("tcl_calls")
+        return self._tkapp.call(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._tkapp, name)
+
+
+PERF = PerfStats()  # Виміри поточного процесу (панель "Продуктивність")
 
 
 # --- 2. УТИЛІТИ: ЗБЕРЕЖЕННЯ ТА ЕКСПОРТ ---
@@ -53,13 +576,16 @@ def _toggle_grid(canvas, is_visible):
         canvas.tag_lower(GRID_TAG)
 
 
-def save_full_flowchart_as_png_via_pil(canvas, filepath):
+@PERF.timed("export_png")
+def save_full_flowchart_as_png_via_pil(ctx, filepath):
     """
     Експортує *повний* вміст полотна (всі елементи) у файл PNG.
 
     Використовує PostScript для захоплення всієї сцени, а не лише видимої
-    частини, та ігнорує сітку при розрахунку меж.
+    частини; межі вмісту (без сітки) беруться зі сховища геометрії.
     """
+    _finish_scene_render(ctx)  # (Незавершений поступовий рендеринг - домальовуємо)
+    canvas = ctx.canvas
     ps_data = None
     MIN_PADDING_PX = 50  # Мінімальний відступ
     PADDING_FACTOR = 0.05  # 5% відступ від розміру вмісту
@@ -67,18 +593,10 @@ def save_full_flowchart_as_png_via_pil(canvas, filepath):
     try:
         # 1. Отримуємо межі всіх значущих елементів (блоки та стрілки).
         canvas.update_idletasks()
-
-        # Ігноруємо сітку, порти та інші допоміжні елементи.
-        content_items = canvas.find_withtag("block") + canvas.find_withtag("flow_arrow")
-
-        if not content_items:
-            print("Помилка: Полотно порожнє. Нічого зберігати.")
-            return False
-
-        bbox_initial = canvas.bbox(*content_items)
+        bbox_initial = ctx.geometry.bounds()
 
         if not bbox_initial:
-            print("Помилка: Блоки/стрілки не знайдені.")
+            print("Помилка: Полотно порожнє. Нічого зберігати.")
             return False
 
         x0, y0, x1, y1 = bbox_initial
@@ -126,6 +644,7 @@ def save_full_flowchart_as_png_via_pil(canvas, filepath):
         return False, _toggle_grid(canvas, True)  # Повертаємо сітку у разі помилки
 
 
+@PERF.timed("export_screenshot")
 def save_canvas_screenshot(canvas, filepath):
     """Зберігає *лише видиму* частину полотна (скріншот вікна)."""
     if ImageGrab is None:
@@ -146,63 +665,26 @@ def save_canvas_screenshot(canvas, filepath):
         return False
 
 
-def _draw_ports_for_block(canvas, x0, y0, x1, y1, group_tag, is_rhombus=False):
-    """
-    Створює невидимі "порти" (точки прив'язки) для блоку.
-
-    Ці порти використовуються для логіки "прилипання" стрілок.
-    """
-    W = x1 - x0
-    H = y1 - y0
-    center_x = (x0 + x1) / 2
-    center_y = (y0 + y1) / 2
-
-    # Визначення координат портів.
-    port_coords = []
-
-    if is_rhombus:
-        # Ромби (if/while) мають 4 порти (T, L, R, B).
-        port_coords = [
-            (center_x, y0),  # Вхід (зверху)
-            (x0, center_y),  # Вихід 'False' (зліва)
-            (x1, center_y),  # Вихід 'True' (справа)
-            (center_x, y1)  # З'єднання (знизу)
-        ]
-    else:
-        # Інші блоки (rect, ellipse) мають 2 порти (T, B).
-        port_coords = [
-            (center_x, y0),  # Вхід (зверху)
-            (center_x, y1)  # Вихід (знизу)
-        ]
-
-    PORT_RADIUS = 3  # Радіус зони "прилипання" для порту.
-
-    for px, py in port_coords:
-        # Створюємо невидимий об'єкт-порт.
-        canvas.create_oval(
-            px - PORT_RADIUS, py - PORT_RADIUS,
-            px + PORT_RADIUS, py + PORT_RADIUS,
-            fill="", outline="", width=0,  # fill="" та outline="" роблять овал невидимим.
-            tags=("block_port", group_tag)
-        )
-
-
 # --- 3. ДОПОМІЖНІ ФУНКЦІЇ МАЛЮВАННЯ (ПРИМІТИВИ) ---
 
-def draw_arrow(canvas, x_start, y_start, x_end, y_end, draw_arrow_head=True):
+def draw_arrow(ctx, x_start, y_start, x_end, y_end, draw_arrow_head=True):
     """Малює просту пряму стрілку з однієї точки в іншу."""
+    canvas = ctx.canvas
     if draw_arrow_head:
-        canvas.create_line(x_start, y_start, x_end, y_end, arrow=tk.LAST, width=2, tags=("flow_arrow",))
+        arrow_id = canvas.create_line(x_start, y_start, x_end, y_end, arrow=tk.LAST, width=2, tags=("flow_arrow",))
     else:
-        canvas.create_line(x_start, y_start, x_end, y_end, width=2, tags=("flow_arrow",))
+        arrow_id = canvas.create_line(x_start, y_start, x_end, y_end, width=2, tags=("flow_arrow",))
+    ctx.geometry.add_edge(arrow_id, (x_start, y_start, x_end, y_end))
 
 
-def draw_multi_point_arrow(canvas, points, text="", draw_arrow_head=True):
+def draw_multi_point_arrow(ctx, points, text="", draw_arrow_head=True):
     """Малює ламану стрілку, що проходить через список точок (points)."""
+    canvas = ctx.canvas
     if draw_arrow_head:
-        canvas.create_line(points, arrow=tk.LAST, width=2, tags=("flow_arrow",))
+        arrow_id = canvas.create_line(points, arrow=tk.LAST, width=2, tags=("flow_arrow",))
     else:
-        canvas.create_line(points, width=2, tags=("flow_arrow",))
+        arrow_id = canvas.create_line(points, width=2, tags=("flow_arrow",))
+    ctx.geometry.add_edge(arrow_id, points)
 
     # Додавання тексту ("True", "False") біля першого сегмента стрілки.
     if text:
@@ -226,8 +708,12 @@ def draw_multi_point_arrow(canvas, points, text="", draw_arrow_head=True):
             canvas.create_text(x_pos, y_pos, text=text, font=("Arial", 9, "bold"), fill="black", anchor=anchor)
 
 
-def draw_grid_lines(canvas, grid_size, max_size, is_visible):
-    """Малює або оновлює сітку на полотні."""
+@PERF.timed("grid")
+def draw_grid_lines(canvas, grid_size, max_size, is_visible, region=None):
+    """
+    Малює або оновлює сітку на полотні: квадрат (0, 0)-(max_size, max_size)
+    або область region (x0, y0, x1, y1), лінії - кратні grid_size.
+    """
     GRID_COLOR = "#cccccc"  # Світло-сірий
     GRID_TAG = "grid_line"
     state = 'normal' if is_visible else 'hidden'
@@ -235,33 +721,47 @@ def draw_grid_lines(canvas, grid_size, max_size, is_visible):
     # Видаляємо стару сітку перед малюванням нової.
     canvas.delete(GRID_TAG)
 
+    x0, y0, x1, y1 = region if region is not None else (0, 0, max_size, max_size)
+    if x1 <= x0 or y1 <= y0: return
+
     # Вертикальні лінії
-    for i in range(0, max_size, grid_size):
-        canvas.create_line(i, 0, i, max_size, fill=GRID_COLOR, tags=(GRID_TAG,), dash=(1, 2), state=state)
+    vertical = range(int(x0 // grid_size) * grid_size, int(x1), grid_size)
+    for i in vertical:
+        canvas.create_line(i, y0, i, y1, fill=GRID_COLOR, tags=(GRID_TAG,), dash=(1, 2), state=state)
 
     # Горизонтальні лінії
-    for j in range(0, max_size, grid_size):
-        canvas.create_line(0, j, max_size, j, fill=GRID_COLOR, tags=(GRID_TAG,), dash=(1, 2), state=state)
+    horizontal = range(int(y0 // grid_size) * grid_size, int(y1), grid_size)
+    for j in horizontal:
+        canvas.create_line(x0, j, x1, j, fill=GRID_COLOR, tags=(GRID_TAG,), dash=(1, 2), state=state)
+    PERF.count("tk_items", len(vertical) + len(horizontal))
 
     # Переміщуємо сітку на задній план, під усі блоки.
     canvas.tag_lower(GRID_TAG)
 
 
-def draw_ellipse(canvas, x, y_top, text, h_scale, v_scale, color):
+def grid_region(scroll_region):
+    """Частина області прокрутки (x0, y0, x1, y1), де малюється сітка: вікно ±GRID_WINDOW навколо (0, 0)."""
+    x0, y0, x1, y1 = scroll_region
+    return max(x0, -GRID_WINDOW), max(y0, -GRID_WINDOW), min(x1, GRID_WINDOW), min(y1, GRID_WINDOW)
+
+
+def draw_ellipse(ctx, x, y_top, text, h_scale, v_scale, color):
     """Малює блок "Початок/Кінець" (Овал)."""
+    canvas = ctx.canvas
     W = BLOCK_WIDTH_DEFAULT * h_scale
     TEXT_PADDING = 15  # Більший відступ для овалу
     MIN_H = BLOCK_HEIGHT_DEFAULT * v_scale
 
-    # Унікальний тег групи для цього блоку
-    group_tag = f"ell_{int(x)}_{int(y_top)}"
+    # Запис реєстру та унікальний тег групи для цього блоку
+    block = ctx.new_block("ell", text)
+    group_tag = block.tag
     # Обмеження ширини тексту
     text_width_constraint = W - (TEXT_PADDING * 2.5)
 
     # 1. Створюємо текст (для розрахунку висоти)
     text_id = canvas.create_text(
         x, y_top + TEXT_PADDING, text=text,
-        font=("Arial", int(11 * v_scale * GLOBAL_TEXT_SCALE_FACTOR), "bold"),  # <-- ЗМІНА ТУТ
+        font=("Arial", int(11 * v_scale * ctx.text_scale), "bold"),  # <-- ЗМІНА ТУТ
         width=text_width_constraint,
         anchor="n"
     )
@@ -277,7 +777,7 @@ def draw_ellipse(canvas, x, y_top, text, h_scale, v_scale, color):
     y1 = y_top + H
 
     # 4. Малюємо овал
-    canvas.create_oval(x0, y0, x1, y1, fill=color, outline="black", tags=("block", "ellipse", group_tag))
+    shape_id = canvas.create_oval(x0, y0, x1, y1, fill=color, outline="black", tags=("block", "ellipse", group_tag))
 
     # 5. Центруємо текст у готовому блоці
     canvas.coords(text_id, x, y_top + H / 2)
@@ -285,24 +785,26 @@ def draw_ellipse(canvas, x, y_top, text, h_scale, v_scale, color):
     canvas.tag_raise(text_id)  # Текст поверх фігури
     canvas.itemconfig(text_id, tags=canvas.gettags(text_id) + ("block_text", group_tag))
 
-    # 6. Малюємо невидимі порти прив'язки
-    _draw_ports_for_block(canvas, x0, y0, x1, y1, group_tag)
+    # 6. Реєструємо межі блоку (за ними рахуються порти прив'язки стрілок)
+    ctx.register_block_items(block, (x0, y0, x1, y1), [shape_id, text_id])
 
     return (x, y1)  # Повертаємо координати нижньої точки
 
-def draw_rectangle(canvas, x, y_top, text, h_scale, v_scale, color):
+def draw_rectangle(ctx, x, y_top, text, h_scale, v_scale, color):
     """Малює стандартний блок операції (Прямокутник)."""
+    canvas = ctx.canvas
     W = BLOCK_WIDTH_DEFAULT * h_scale
     TEXT_PADDING = 10
     MIN_H = BLOCK_HEIGHT_DEFAULT * v_scale
 
-    group_tag = f"rect_{int(x)}_{int(y_top)}"
+    block = ctx.new_block("rect", text)
+    group_tag = block.tag
     text_width_constraint = W - (TEXT_PADDING * 2)
 
     # 1. Створюємо текст
     text_id = canvas.create_text(
         x, y_top + TEXT_PADDING, text=text,
-        font=("Arial", int(14 * v_scale * GLOBAL_TEXT_SCALE_FACTOR)),  # <-- ЗМІНА ТУТ
+        font=("Arial", int(14 * v_scale * ctx.text_scale)),  # <-- ЗМІНА ТУТ
         width=text_width_constraint, anchor="n"
     )
     # 2. Розраховуємо висоту
@@ -317,7 +819,7 @@ def draw_rectangle(canvas, x, y_top, text, h_scale, v_scale, color):
     y1 = y_top + H
 
     # 4. Малюємо прямокутник
-    canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="black", tags=("block", "rect", group_tag))
+    shape_id = canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="black", tags=("block", "rect", group_tag))
 
     # 5. Центруємо текст
     canvas.coords(text_id, x, y_top + H / 2)
@@ -325,33 +827,66 @@ def draw_rectangle(canvas, x, y_top, text, h_scale, v_scale, color):
     canvas.tag_raise(text_id)
     canvas.itemconfig(text_id, tags=canvas.gettags(text_id) + ("block_text", group_tag))
 
-    # 6. Малюємо порти
-    _draw_ports_for_block(canvas, x0, y0, x1, y1, group_tag)
+    # 6. Реєструємо межі блоку (за ними рахуються порти прив'язки стрілок)
+    ctx.register_block_items(block, (x0, y0, x1, y1), [shape_id, text_id])
 
     return (x, y1)
 
 
-def draw_rhombus(canvas, x, y_top, text, h_scale, v_scale, color):
+_MEASURE_FONTS = {}  # {розмір: tk.font.Font} - шрифти для вимірювання тексту
+
+
+def measure_text_width(ctx, text, v_scale):
+    """Ширина тексту (px) шрифтом блоків; без Tk (або шрифту) - сталі 100 px."""
+    size = int(14 * v_scale * ctx.text_scale)
+    try:
+        f = _MEASURE_FONTS.get(size)
+        if f is None:
+            f = _MEASURE_FONTS[size] = tk.font.Font(family="Arial", size=size)
+        return f.measure(text)
+    except Exception:
+        return 100
+
+
+def rhombus_label(text):
+    """Текст умови так, як він показується у ромбі."""
+    return text.replace("and", "і").replace("or", "або")
+
+
+def rhombus_width(ctx, text, h_scale, v_scale):
+    """Повна ширина ромба для тексту (спільна для розкладки та малювання)."""
+    TEXT_PADDING = 20
+    W_for_text = (measure_text_width(ctx, text, v_scale) + (TEXT_PADDING * 1.5)) * 2.2  # Емпіричний коефіцієнт
+    return max(BLOCK_WIDTH_DEFAULT, W_for_text) * h_scale
+
+
+def hexagon_width(ctx, text, h_scale, v_scale):
+    """Повна ширина шестикутника 'for' для тексту (спільна для розкладки та малювання)."""
+    TEXT_PADDING = 10
+    W_for_text = (measure_text_width(ctx, text, v_scale) + (TEXT_PADDING * 2)) * 2.1  # Емпіричний коефіцієнт
+    return max(BLOCK_WIDTH_DEFAULT, W_for_text) * h_scale * 1.3
+
+
+def parallelogram_skew(h_scale):
+    """Горизонтальний зсув нахилу паралелограма."""
+    return (BLOCK_WIDTH_DEFAULT / 8) * h_scale
+
+
+def draw_rhombus(ctx, x, y_top, text, h_scale, v_scale, color):
     """Малює блок умови або циклу (Ромб)."""
+    canvas = ctx.canvas
     TEXT_PADDING = 20
     MIN_H = BLOCK_HEIGHT_DEFAULT * v_scale
     H = MIN_H
     h = H / 2
     y_center = y_top + h
-    text = text.replace("and", "і").replace("or", "або")
+    text = rhombus_label(text)
 
-    group_tag = f"rhombus_{int(x)}_{int(y_top)}"
+    block = ctx.new_block("rhombus", text)
+    group_tag = block.tag
 
     # 1. Розраховуємо ширину ромба на основі довжини тексту
-    try:
-        f = tk.font.Font(family="Arial", size=int(14 * v_scale * GLOBAL_TEXT_SCALE_FACTOR)); # <-- ЗМІНА ТУТ
-        text_width = f.measure(text)
-    except Exception:
-        text_width = 100
-
-    W_base = BLOCK_WIDTH_DEFAULT
-    W_for_text = (text_width + (TEXT_PADDING * 1.5)) * 2.2  # Емпіричний коефіцієнт для ромба
-    W = max(W_base, W_for_text) * h_scale
+    W = rhombus_width(ctx, text, h_scale, v_scale)
     w = W / 2
 
     # 2. Координати вершин ромба (p1...p4)
@@ -361,38 +896,41 @@ def draw_rhombus(canvas, x, y_top, text, h_scale, v_scale, color):
     p4 = (x, y_top)  # Верхня
 
     # 3. Малюємо ромб
-    canvas.create_polygon(p1, p2, p3, p4, fill=color, outline="black", tags=("block", "rhombus", group_tag))
+    shape_id = canvas.create_polygon(p1, p2, p3, p4, fill=color, outline="black",
+                                     tags=("block", "rhombus", group_tag))
 
     # 4. Малюємо текст
     text_width_constraint = W - (W / 2) - TEXT_PADDING + 100
     text_id = canvas.create_text(x, y_center, text=text,
-                                 font=("Arial", int(14 * v_scale * GLOBAL_TEXT_SCALE_FACTOR)), # <-- ЗМІНА ТУТ
+                                 font=("Arial", int(14 * v_scale * ctx.text_scale)), # <-- ЗМІНА ТУТ
                                  width=text_width_constraint,
                                  anchor="center")
     canvas.tag_raise(text_id)
     canvas.itemconfig(text_id, tags=canvas.gettags(text_id) + ("block_text", group_tag))
 
-    # 5. Малюємо порти (спеціальний режим для ромба)
-    _draw_ports_for_block(canvas, x - w, y_top, x + w, y_top + H, group_tag, is_rhombus=True)
+    # 5. Реєструємо межі блоку (за ними рахуються порти прив'язки стрілок)
+    ctx.register_block_items(block, (x - w, y_top, x + w, y_top + H), [shape_id, text_id], four_ports=True)
 
     # Повертаємо словник з ключовими точками для стрілок
     return {"top": p4, "bottom": p2, "left": p1, "right": p3}
 
 
-def draw_subroutine(canvas, x, y_top, text, h_scale, v_scale, color):
+def draw_subroutine(ctx, x, y_top, text, h_scale, v_scale, color):
     """Малює блок виклику підпрограми (Прямокутник з лініями)."""
+    canvas = ctx.canvas
     W = BLOCK_WIDTH_DEFAULT * h_scale
     TEXT_PADDING = 10
     MIN_H = BLOCK_HEIGHT_DEFAULT * v_scale
     LINE_OFFSET = 15 * h_scale  # Відступ для внутрішніх ліній
 
-    sub_tag = f"sub_{int(x)}_{int(y_top)}"
+    block = ctx.new_block("sub", text)
+    sub_tag = block.tag
     text_width_constraint = W - (TEXT_PADDING * 2) - (LINE_OFFSET * 2)
 
     # 1. Текст та розрахунок висоти
     text_id = canvas.create_text(
         x, y_top + TEXT_PADDING, text=text,
-        font=("Arial", int(14 * v_scale * GLOBAL_TEXT_SCALE_FACTOR)), # <-- ЗМІНА ТУТ
+        font=("Arial", int(14 * v_scale * ctx.text_scale)), # <-- ЗМІНА ТУТ
         width=text_width_constraint, anchor="n"
     )
     text_bbox = canvas.bbox(text_id)
@@ -406,11 +944,12 @@ def draw_subroutine(canvas, x, y_top, text, h_scale, v_scale, color):
     y1 = y_top + H
 
     # 3. Малюємо основний прямокутник
-    canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="black", tags=("block", "sub", sub_tag))
+    shape_id = canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="black", tags=("block", "sub", sub_tag))
 
     # 4. Малюємо додаткові вертикальні лінії
-    canvas.create_line(x0 + LINE_OFFSET, y0, x0 + LINE_OFFSET, y1, width=1, fill="black", tags=(sub_tag,))
-    canvas.create_line(x1 - LINE_OFFSET, y0, x1 - LINE_OFFSET, y1, width=1, fill="black", tags=(sub_tag,))
+    line_ids = [
+        canvas.create_line(x0 + LINE_OFFSET, y0, x0 + LINE_OFFSET, y1, width=1, fill="black", tags=(sub_tag,)),
+        canvas.create_line(x1 - LINE_OFFSET, y0, x1 - LINE_OFFSET, y1, width=1, fill="black", tags=(sub_tag,))]
 
     # 5. Центруємо текст
     canvas.coords(text_id, x, y_top + H / 2)
@@ -418,25 +957,27 @@ def draw_subroutine(canvas, x, y_top, text, h_scale, v_scale, color):
     canvas.tag_raise(text_id)
     canvas.itemconfig(text_id, tags=canvas.gettags(text_id) + ("block_text", sub_tag))
 
-    # 6. Малюємо порти
-    _draw_ports_for_block(canvas, x0, y0, x1, y1, sub_tag)
+    # 6. Реєструємо межі блоку (за ними рахуються порти прив'язки стрілок)
+    ctx.register_block_items(block, (x0, y0, x1, y1), [shape_id, text_id] + line_ids)
 
     return (x, y1)
 
 
-def draw_parallelogram(canvas, x, y_top, text, h_scale, v_scale, color):
+def draw_parallelogram(ctx, x, y_top, text, h_scale, v_scale, color):
     """Малює блок Вводу/Виводу (Паралелограм)."""
+    canvas = ctx.canvas
     W = BLOCK_WIDTH_DEFAULT * h_scale
     TEXT_PADDING = 10
     MIN_H = BLOCK_HEIGHT_DEFAULT * v_scale
-    skew_offset = (BLOCK_WIDTH_DEFAULT / 8) * h_scale  # Горизонтальний зсув для нахилу
+    skew_offset = parallelogram_skew(h_scale)  # Горизонтальний зсув для нахилу
 
-    group_tag = f"para_{int(x)}_{int(y_top)}"
+    block = ctx.new_block("para", text)
+    group_tag = block.tag
     text_width_constraint = W - (TEXT_PADDING * 2) - skew_offset
 
     # 1. Текст та розрахунок висоти
     text_id = canvas.create_text(x, y_top + TEXT_PADDING, text=text,
-                                 font=("Arial", int(14 * v_scale * GLOBAL_TEXT_SCALE_FACTOR)), # <-- ЗМІНА ТУТ
+                                 font=("Arial", int(14 * v_scale * ctx.text_scale)), # <-- ЗМІНА ТУТ
                                  width=text_width_constraint, anchor="n")
     text_bbox = canvas.bbox(text_id)
     text_height = 0 if not text_bbox else (text_bbox[3] - text_bbox[1])
@@ -453,7 +994,7 @@ def draw_parallelogram(canvas, x, y_top, text, h_scale, v_scale, color):
     p4 = (x - w_half - skew_offset, y_top + H)  # Нижня ліва
 
     # 3. Малюємо фігуру
-    canvas.create_polygon(p1, p2, p3, p4, fill=color, outline="black", tags=("block", "para", group_tag))
+    shape_id = canvas.create_polygon(p1, p2, p3, p4, fill=color, outline="black", tags=("block", "para", group_tag))
 
     # 4. Центруємо текст
     canvas.coords(text_id, x, y_center)
@@ -461,33 +1002,27 @@ def draw_parallelogram(canvas, x, y_top, text, h_scale, v_scale, color):
     canvas.tag_raise(text_id)
     canvas.itemconfig(text_id, tags=canvas.gettags(text_id) + ("block_text", group_tag))
 
-    # 5. Малюємо порти (використовуючи зовнішні межі фігури)
+    # 5. Реєструємо межі блоку (зовнішні межі фігури, за ними рахуються порти)
     x0_bounds = x - w_half - skew_offset;
     x1_bounds = x + w_half + skew_offset;
-    _draw_ports_for_block(canvas, x0_bounds, y_top, x1_bounds, y_top + H, group_tag)
+    ctx.register_block_items(block, (x0_bounds, y_top, x1_bounds, y_top + H), [shape_id, text_id])
 
     return (x, y_top + H)
 
-def draw_hexagon(canvas, x, y_top, text, h_scale, v_scale, color):
+def draw_hexagon(ctx, x, y_top, text, h_scale, v_scale, color):
     """Малює блок циклу 'for' (Шестикутник)."""
+    canvas = ctx.canvas
     TEXT_PADDING = 10
     MIN_H = BLOCK_HEIGHT_DEFAULT * v_scale
     H = MIN_H
     h = H / 2;
     y_center = y_top + h
 
-    group_tag = f"hex_{int(x)}_{int(y_top)}"
+    block = ctx.new_block("hex", text)
+    group_tag = block.tag
 
     # 1. Розрахунок ширини на основі тексту
-    try:
-        f = tk.font.Font(family="Arial", size=int(14 * v_scale * GLOBAL_TEXT_SCALE_FACTOR)); # <-- ЗМІНА ТУТ
-        text_width = f.measure(text)
-    except Exception:
-        text_width = 100
-
-    W_base = BLOCK_WIDTH_DEFAULT;
-    W_for_text = (text_width + (TEXT_PADDING * 2)) * 2.1  # Емпіричний коефіцієнт
-    W = max(W_base, W_for_text) * h_scale * 1.3
+    W = hexagon_width(ctx, text, h_scale, v_scale)
     w = W / 2
     hex_offset = H  # Зсув для бічних граней
 
@@ -500,140 +1035,246 @@ def draw_hexagon(canvas, x, y_top, text, h_scale, v_scale, color):
     p6 = (x - w, y_center)  # Ліва
 
     # 3. Малюємо фігуру
-    canvas.create_polygon(p1, p2, p3, p4, p5, p6, fill=color, outline="black",
-                          tags=("block", "hex", group_tag))
+    shape_id = canvas.create_polygon(p1, p2, p3, p4, p5, p6, fill=color, outline="black",
+                                     tags=("block", "hex", group_tag))
     # 4. Малюємо текст
     text_width_constraint = W - (2 * hex_offset) - (2 * TEXT_PADDING) + 100
     text_id = canvas.create_text(x, y_center, text=text,
-                                 font=("Arial", int(14 * v_scale * GLOBAL_TEXT_SCALE_FACTOR)), # <-- ЗМІНА ТУТ
+                                 font=("Arial", int(14 * v_scale * ctx.text_scale)), # <-- ЗМІНА ТУТ
                                  width=text_width_constraint,
                                  anchor="center")
     canvas.tag_raise(text_id)
     canvas.itemconfig(text_id, tags=canvas.gettags(text_id) + ("block_text", group_tag))
 
-    # 5. Малюємо порти
+    # 5. Реєструємо межі блоку (за ними рахуються порти прив'язки стрілок)
     x0_bounds = x - w;
     x1_bounds = x + w;
-    _draw_ports_for_block(canvas, x0_bounds, y_top, x1_bounds, y_top + H, group_tag)
+    ctx.register_block_items(block, (x0_bounds, y_top, x1_bounds, y_top + H), [shape_id, text_id])
 
     # Повертаємо ключові точки
     return {"top": (x, y_top), "bottom": (x, y_top + H), "left": p6, "right": p3}
 
 
-# --- 4. ДОПОМІЖНІ ФУНКЦІЇ: АНАЛІЗ ЛОГІЧНИХ БЛОКІВ ---
+def draw_folded_block(ctx, x, y_top, text, h_scale, v_scale, color):
+    """Малює згорнуту конструкцію (цикл або розгалуження) одним підсумковим блоком."""
+    canvas = ctx.canvas
+    W = BLOCK_WIDTH_DEFAULT * h_scale
+    TEXT_PADDING = 10
+    MIN_H = BLOCK_HEIGHT_DEFAULT * v_scale
 
-def find_if_branches(code_list, start_index):
-    """
-    Знаходить тіло гілки 'If' (true_branch), тіло гілки 'Else' (false_branch)
-    та індекс рядка, де закінчується вся конструкція ('Все якщо').
+    block = ctx.new_block("fold", text)
+    group_tag = block.tag
+    text_width_constraint = W - (TEXT_PADDING * 2)
 
-    Враховує вкладеність, щоб не зупинитись на 'Все якщо' від вкладеного 'If'.
-    """
-    true_branch_code = []
-    false_branch_code = []
-    if_end_index = -1  # Індекс рядка "Все якщо"
-    else_index = -1  # Індекс рядка "Інакше"
-    nested_if_balance = 0  # Лічильник вкладеності
-    j = start_index + 1
+    # 1. Створюємо текст
+    text_id = canvas.create_text(
+        x, y_top + TEXT_PADDING, text=text,
+        font=("Arial", int(12 * v_scale * ctx.text_scale), "italic"),
+        width=text_width_constraint, anchor="n"
+    )
+    # 2. Розраховуємо висоту
+    text_bbox = canvas.bbox(text_id)
+    text_height = 0 if not text_bbox else (text_bbox[3] - text_bbox[1])
+    H = max(MIN_H, text_height + (TEXT_PADDING * 2))
 
-    while j < len(code_list):
-        line_j = code_list[j].strip()
+    # 3. Координати
+    x0 = x - W / 2
+    y0 = y_top
+    x1 = x + W / 2
+    y1 = y_top + H
 
-        # 1. Відстеження вкладеності
-        if (line_j.startswith("Якщо:") or
-                line_j.startswith("Повторити для:") or
-                line_j.startswith("Повторити поки:") or
-                line_j.startswith("Повторити доки (початок)")):
-            nested_if_balance += 1
+    # 4. Малюємо прямокутник з пунктирною рамкою (ознака прихованого тіла)
+    shape_id = canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="black", width=2, dash=(6, 3),
+                                       tags=("block", "fold", group_tag))
 
-        # 2. Пошук кінця поточного блоку 'If'
-        elif line_j.startswith("Все якщо"):
-            if nested_if_balance == 0:
-                if_end_index = j  # Знайшли кінець *нашого* блоку
-                break
-            else:
-                nested_if_balance -= 1  # Це кінець вкладеного блоку
+    # 5. Центруємо текст
+    canvas.coords(text_id, x, y_top + H / 2)
+    canvas.itemconfigure(text_id, anchor="center")
+    canvas.tag_raise(text_id)
+    canvas.itemconfig(text_id, tags=canvas.gettags(text_id) + ("block_text", group_tag))
 
-        # 3. Відстеження кінця вкладених циклів
-        elif line_j.startswith("Все повторити"):
-            if nested_if_balance > 0:
-                nested_if_balance -= 1  # (Тільки якщо ми всередині циклу)
+    # 6. Реєструємо межі блоку
+    ctx.register_block_items(block, (x0, y0, x1, y1), [shape_id, text_id])
 
-        # 4. Пошук 'Інакше' (тільки на нашому рівні вкладеності)
-        elif (line_j.startswith("Інакше Якщо:") or line_j.startswith("Інакше")) \
-                and nested_if_balance == 0 and else_index == -1:
-            else_index = j
+    return (x, y1)
 
-        j += 1
 
-    # Якщо "Все якщо" не знайдено, блок триває до кінця коду
-    if if_end_index == -1:
-        if_end_index = len(code_list)
+def offpage_connector_height(v_scale):
+    """Висота міжсторінкового з'єднувача (спільна для розбиття на сторінки та малювання)."""
+    return BLOCK_HEIGHT_DEFAULT * v_scale * 0.8
 
-    # 5. Розділення коду на гілки 'True' та 'False'
-    if else_index != -1:
-        # Є гілка 'Інакше'
-        true_branch_code = code_list[start_index + 1: else_index]
-        false_branch_code = code_list[else_index: if_end_index]
-    else:
-        # Немає гілки 'Інакше'
-        true_branch_code = code_list[start_index + 1: if_end_index]
-        false_branch_code = []
 
-    return true_branch_code, false_branch_code, if_end_index
+def draw_offpage_connector(ctx, x, y_top, text, h_scale, v_scale, color="white"):
+    """Малює міжсторінковий з'єднувач (п'ятикутник вістрям донизу) з номером переходу."""
+    canvas = ctx.canvas
+    W = BLOCK_WIDTH_DEFAULT * h_scale * 0.4
+    H = offpage_connector_height(v_scale)
 
+    block = ctx.new_block("conn", text)
+    group_tag = block.tag
 
-def find_loop_body(code_list, start_index):
-    """
-    Знаходить тіло циклу (loop_body_code) та індекс рядка
-    "Все повторити", що завершує цей цикл.
+    # 1. Координати (прямокутник з трикутним низом)
+    x0 = x - W / 2
+    x1 = x + W / 2
+    y1 = y_top + H
+    y_side = y_top + H * 0.6  # Початок скосів
 
-    Враховує вкладеність (if, for, while).
-    """
-    loop_body_code = []
-    loop_end_index = -1
-    end_marker = "Все повторити"  # Маркер кінця для 'for' та 'while'
+    # 2. Малюємо фігуру та номер
+    shape_id = canvas.create_polygon((x0, y_top), (x1, y_top), (x1, y_side), (x, y1), (x0, y_side),
+                                     fill=color, outline="black", tags=("block", "conn", group_tag))
+    text_id = canvas.create_text(x, y_top + H * 0.35, text=text,
+                                 font=("Arial", int(11 * v_scale * ctx.text_scale), "bold"), anchor="center")
+    canvas.tag_raise(text_id)
+    canvas.itemconfig(text_id, tags=canvas.gettags(text_id) + ("block_text", group_tag))
 
-    # Перевірка, чи це дійсно початок циклу
-    if not (code_list[start_index].strip().startswith("Повторити для:") or \
-            code_list[start_index].strip().startswith("Повторити поки:")):
-        return [], start_index
+    # 3. Реєструємо межі блоку
+    ctx.register_block_items(block, (x0, y_top, x1, y1), [shape_id, text_id])
 
-    nested_balance = 0  # Лічильник вкладеності
-    j = start_index + 1
+    return (x, y1)
 
-    while j < len(code_list):
-        line_j = code_list[j].strip()
 
-        # 1. Відстеження вкладених блоків
-        if (line_j.startswith("Якщо:") or
-                line_j.startswith("Повторити для:") or
-                line_j.startswith("Повторити поки:") or
-                line_j.startswith("Повторити доки (початок)")):
-            nested_balance += 1
+# --- 4. ДОПОМІЖНІ ФУНКЦІЇ: АНАЛІЗ ЛОГІЧНИХ БЛОКІВ ---
 
-        # 2. Пошук кінця *нашого* циклу
-        elif line_j.startswith(end_marker):
-            if nested_balance == 0:
-                loop_end_index = j  # Знайшли кінець
-                break
+def _simple_flow_node(line):
+    """Вузол простого блоку: тип фігури та текст, що в ній показується."""
+    if line.startswith("Початок") or line.startswith("Кінець"):
+        # (Головна функція - овал, інші функції - блок підпрограми)
+        shape = "ell" if line in ("Початок", "Кінець") else "sub"
+        return {"kind": shape, "text": line}
+    if line.startswith("Виклик:"):
+        return {"kind": "sub", "text": line.replace("Виклик: ", "")}
+    if line.startswith("Ввід:") or line.startswith("Вивід:"):
+        return {"kind": "para", "text": line}
+    # Усі інші операції (присвоєння тощо)
+    return {"kind": "rect", "text": line}
+
+
+def build_flow_tree(code_list, skip_init=False):
+    """
+    Будує дерево конструкцій блок-схеми з псевдокоду за один прохід.
+
+    Вузол - словник {"kind", "text", ...}. Складені вузли мають списки
+    дочірніх вузлів: 'if' - "true" та "false", 'for'/'while'/'do' - "body".
+    Ланцюжок 'Інакше Якщо' стає вкладеним 'if' (chain=True) у гілці "false".
+    Складені вузли також мають "line" - індекс рядка, що їх відкриває (ключ
+    згортання), та "parent" - складений вузол, що їх містить (або None);
+    прості - "source_line", індекс свого рядка ('do' - ще "end_line", рядок умови).
+    Відкриті конструкції тримаються у стеку, тому кожен рядок розбирається
+    рівно один раз; незакриті конструкції тривають до кінця коду.
+    """
+    root = []
+    stack = []  # [(відкритий вузол, список, куди додаються його дочірні вузли)]
+
+    def _has_open(kinds):
+        return any(node["kind"] in kinds for node, _ in stack)
+
+    for line_index, raw_line in enumerate(code_list):
+        line = raw_line.strip()
+        target = stack[-1][1] if stack else root
+        parent = stack[-1][0] if stack else None
+
+        # 1. Пропуск порожніх рядків та 'skip_init'
+        if not line or line.startswith("Завершення:"):
+            continue
+        if skip_init and line.startswith("Ініціалізація:"):
+            continue
+
+        # 2. Початок складених конструкцій
+        if line.startswith("Якщо:"):
+            text = line.replace("Якщо: ", "").replace(" то", "")
+            node = {"kind": "if", "text": text, "true": [], "false": [], "chain": False,
+                    "line": line_index, "parent": parent}
+            target.append(node)
+            stack.append((node, node["true"]))
+
+        elif line.startswith("Інакше Якщо:"):
+            text = line.replace("Інакше Якщо: ", "").replace(" то", "")
+            node = {"kind": "if", "text": text, "true": [], "false": [], "chain": False,
+                    "line": line_index, "parent": parent}
+            if stack and stack[-1][0]["kind"] == "if":
+                # Наступна ланка ланцюжка - у гілці "False" попереднього 'if'
+                parent["false"].append(node)
+                node["chain"] = True
             else:
-                nested_balance -= 1  # Це кінець вкладеного циклу
+                target.append(node)
+            stack.append((node, node["true"]))
+
+        elif line == "Інакше":
+            if stack and stack[-1][0]["kind"] == "if":
+                node = stack[-1][0]
+                stack[-1] = (node, node["false"])
+
+        elif line.startswith("Повторити для:"):
+            node = {"kind": "for", "text": line.replace("Повторити для: ", ""), "body": [],
+                    "line": line_index, "parent": parent}
+            target.append(node)
+            stack.append((node, node["body"]))
+
+        elif line.startswith("Повторити поки:"):
+            node = {"kind": "while", "text": line.replace("Повторити поки: ", ""), "body": [],
+                    "line": line_index, "parent": parent}
+            target.append(node)
+            stack.append((node, node["body"]))
+
+        elif line == "Повторити доки (початок)":
+            node = {"kind": "do", "text": "", "body": [], "line": line_index, "parent": parent}
+            target.append(node)
+            stack.append((node, node["body"]))
+
+        # 3. Кінці конструкцій (закривають також усе, що лишилось відкритим усередині)
+        elif line.startswith("Повторити доки (умова):"):
+            if _has_open(("do",)):
+                while stack[-1][0]["kind"] != "do":
+                    stack.pop()
+                node, _ = stack.pop()
+                node["text"] = line.replace("Повторити доки (умова): ", "")
+                node["end_line"] = line_index
+
+        elif line.startswith("Все якщо"):
+            if _has_open(("if",)):
+                while stack[-1][0]["kind"] != "if":
+                    stack.pop()
+                # (Одне 'Все якщо' закриває весь ланцюжок 'Інакше Якщо')
+                while stack[-1][0]["chain"]:
+                    stack.pop()
+                stack.pop()
+
+        elif line.startswith("Все повторити"):
+            if _has_open(("for", "while")):
+                while stack[-1][0]["kind"] not in ("for", "while"):
+                    stack.pop()
+                stack.pop()
+
+        elif line.startswith("Все"):
+            continue
 
-        # 3. Відстеження кінця вкладених 'If'
-        elif line_j.startswith("Все якщо"):
-            if nested_balance > 0:
-                nested_balance -= 1
+        # 4. Прості блоки (з рядком псевдокоду - для пошуку блоку за рядком)
+        else:
+            node = _simple_flow_node(line)
+            node["source_line"] = line_index
+            target.append(node)
+
+    return root
 
-        j += 1
 
-    # Якщо кінець не знайдено, цикл триває до кінця файлу
-    if loop_end_index == -1:
-        loop_end_index = len(code_list) - 1
+# Заголовок підсумкового блоку згорнутої конструкції
+_FOLDED_PREFIX = {"if": "Якщо: ", "for": "Повторити для: ", "while": "Повторити поки: ",
+                  "do": "Повторити доки: "}
 
-    # 4. Вилучення тіла циклу
-    loop_body_code = code_list[start_index + 1: loop_end_index]
-    return loop_body_code, loop_end_index
+
+def _folded_text(node):
+    """Текст блоку згорнутої конструкції: заголовок та кількість прихованих вузлів."""
+    hidden = node.get("hidden_count")
+    if hidden is None:
+        hidden = 0
+        stack = list(_flow_children(node))
+        while stack:
+            child_nodes = stack.pop()
+            hidden += len(child_nodes)
+            for child in child_nodes:
+                stack.extend(_flow_children(child))
+        node["hidden_count"] = hidden  # (Піддерево не змінюється, поки дерево в кеші)
+    return f"▸ {_FOLDED_PREFIX[node['kind']]}{node['text']} (+{hidden})"
 
 
 # --- 5. ДОПОМІЖНА ФУНКЦІЯ: ВИЛУЧЕННЯ ТОКЕНІВ З ДУЖОК ---
@@ -667,17 +1308,19 @@ def get_block_tokens(word_list, start_index):
 
 # --- 6. ОСНОВНА ЛОГІКА МАЛЮВАННЯ ДІАГРАМИ ---
 
-def draw_flowchart(canvas, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors):
+def draw_flowchart(ctx, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors):
     """
     (Ця функція більше не використовується, замінена на draw_flowchart_with_offset)
-    Обгортка для запуску рекурсивного малювання.
+    Обгортка для запуску малювання.
     """
+    canvas = ctx.canvas
     canvas.delete("all")
     EXTENDED_SIZE = 4000
     canvas.config(scrollregion=(0, 0, EXTENDED_SIZE, EXTENDED_SIZE))
 
-    _draw_flowchart_recursive(canvas, code_list, Y_START, EXTENDED_SIZE / 2, h_scale, v_scale, loop_offset_factor,
-                              if_offset_factor, colors, skip_init=False, nesting_level=0)
+    flow_tree = build_flow_tree(code_list, skip_init=False)
+    layout_flow_tree(ctx, flow_tree, h_scale, v_scale, loop_offset_factor, if_offset_factor)
+    draw_flow_tree(ctx, flow_tree, Y_START, EXTENDED_SIZE / 2, h_scale, v_scale, colors)
 
     canvas.update_idletasks()
     actual_bbox = canvas.bbox("all")
@@ -692,27 +1335,261 @@ def draw_flowchart(canvas, code_list, h_scale, v_scale, loop_offset_factor, if_o
         canvas.config(scrollregion=(0, 0, 800, 800))
 
 
-def _draw_flowchart_recursive(canvas, code_list, start_y, x_center, h_scale, v_scale, loop_offset_factor,
-                              if_offset_factor, colors, skip_init, nesting_level=0):
+def _flow_children(node):
+    """Дочірні послідовності вузла дерева (у порядку малювання)."""
+    kind = node["kind"]
+    if kind == "if":
+        return (node["true"], node["false"])
+    if kind in ("for", "while", "do"):
+        return (node["body"],)
+    return ()
+
+
+def _sequence_extent(nodes):
+    """Обсяг послідовності (ліворуч, праворуч) з уже виміряних вузлів."""
+    left = 0
+    right = 0
+    for node in nodes:
+        left = max(left, node["extent"][0])
+        right = max(right, node["extent"][1])
+    return (left, right)
+
+
+def _flow_tree_for(ctx, code_list, skip_init):
     """
-    Рекурсивно малює блок-схему на основі списку псевдокоду.
+    Дерево конструкцій функції з кешу контексту (будується заново лише для
+    іншого коду або skip_init) з позначками згорнутих вузлів ("collapsed").
 
-    Повертає (кінцевий_y, кінцевий_x) - координати точки,
-    з якої має виходити наступна стрілка.
+    Дерево зберігає виміри layout_flow_tree між перемальовуваннями, тому після
+    згортання або розгортання перевимірюються лише змінений вузол та його предки.
+    """
+    key = (_hash_code_list(code_list), skip_init)
+    if ctx.flow_tree is None or ctx.flow_tree["key"] != key:
+        nodes = build_flow_tree(code_list, skip_init)
+        index = {}  # {рядок: складений вузол}
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if "line" in node:
+                index[node["line"]] = node
+            for child_nodes in _flow_children(node):
+                stack.extend(child_nodes)
+        for line in ctx.collapsed.get(key[0], ()):
+            if line in index:
+                index[line]["collapsed"] = True
+        ctx.flow_tree = {"key": key, "nodes": nodes, "index": index}
+    return ctx.flow_tree
+
+
+def _invalidate_flow_layout(node):
+    """Скидає виміри вузла та всіх його предків (їх обсяг залежить від нього)."""
+    while node is not None:
+        node.pop("layout_key", None)
+        node = node["parent"]
+
+
+def _toggle_collapsed(ctx, code_list, skip_init, line):
+    """
+    Згортає або розгортає складений вузол (за рядком псевдокоду, що його відкриває).
+    Повертає новий стан (True - згорнутий) або None, якщо такого вузла немає.
+    """
+    tree = _flow_tree_for(ctx, code_list, skip_init)
+    node = tree["index"].get(line)
+    if node is None:
+        return None
+    collapsed = ctx.collapsed.setdefault(tree["key"][0], set())
+    node["collapsed"] = not node.get("collapsed")
+    if node["collapsed"]:
+        collapsed.add(line)
+    else:
+        collapsed.discard(line)
+    _invalidate_flow_layout(node)
+    tree.pop("pages", None)  # (Висоти вузлів змінились - сторінки розбиваються заново)
+    return node["collapsed"]
+
+
+def _set_all_collapsed(ctx, code_list, skip_init, is_collapsed):
+    """Згортає (або розгортає) усі складені вузли функції."""
+    tree = _flow_tree_for(ctx, code_list, skip_init)
+    tree.pop("pages", None)
+    collapsed = ctx.collapsed.setdefault(tree["key"][0], set())
+    for line, node in tree["index"].items():
+        node["collapsed"] = is_collapsed
+        node.pop("layout_key", None)
+        if is_collapsed:
+            collapsed.add(line)
+        else:
+            collapsed.discard(line)
+
+
+@PERF.timed("pages")
+def _flow_pages(ctx, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor, skip_init,
+                page_height=PAGE_HEIGHT_DEFAULT):
+    """
+    Розбиває схему функції на сторінки висотою не більше page_height - лише
+    між вузлами головної послідовності (межами блоків верхнього рівня), з
+    урахуванням міжсторінкових з'єднувачів. Вузол, вищий за сторінку, займає
+    окрему (завелику) сторінку.
+
+    Висоти беруться з пробного малювання у SceneRecorder окремого контексту
+    (полотно та реєстр поточної схеми не змінюються); результат кешується
+    у дереві конструкцій.
+
+    Повертає список діапазонів вузлів верхнього рівня [(початок, кінець), ...].
+    """
+    tree = _flow_tree_for(ctx, code_list, skip_init)
+    key = (h_scale, v_scale, loop_offset_factor, if_offset_factor, ctx.text_scale, page_height)
+    cached = tree.get("pages")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    # 1. Пробне малювання: Y верхівок вузлів верхнього рівня
+    nodes = tree["nodes"]
+    scratch = DiagramContext(SceneRecorder(ctx.canvas))
+    scratch.text_scale = ctx.text_scale
+    tops = []
+    try:
+        layout_flow_tree(scratch, nodes, h_scale, v_scale, loop_offset_factor, if_offset_factor)
+        end_y, _ = draw_flow_tree(scratch, nodes, Y_START, X_CENTER_DEFAULT, h_scale, v_scale, None,
+                                  node_tops=tops)
+    finally:
+        scratch.canvas.close()
+
+    # 2. Жадібне розбиття: на сторінку - стільки вузлів, скільки вміщується
+    V_SP = V_SPACING_DEFAULT * v_scale
+    CONNECTOR = offpage_connector_height(v_scale) + V_SP  # З'єднувач разом зі стрілкою
+    count = len(tops)
+
+    def _page_height(start, end):
+        bottom = tops[end] - V_SP if end < count else end_y
+        height = Y_START + (bottom - tops[start]) + Y_START  # (Поля зверху та знизу)
+        if start > 0:
+            height += CONNECTOR
+        if end < count:
+            height += CONNECTOR
+        return height
+
+    pages = []
+    start = 0
+    while start < count:
+        end = start + 1
+        while end < count and _page_height(start, end + 1) <= page_height:
+            end += 1
+        pages.append((start, end))
+        start = end
+    if not pages:
+        pages.append((0, 0))
+
+    tree["pages"] = (key, pages)
+    return pages
+
+
+def _page_sequence(nodes, pages, page):
+    """Вузли сторінки page (з 0) з міжсторінковими з'єднувачами на початку та в кінці."""
+    start, end = pages[page]
+    sequence = list(nodes[start:end])
+    # (З'єднувач k - перехід між сторінками k та k + 1, однаковий номер з обох боків)
+    if page > 0:
+        sequence.insert(0, {"kind": "conn", "text": str(page)})
+    if page < len(pages) - 1:
+        sequence.append({"kind": "conn", "text": str(page + 1)})
+    return sequence
+
+
+def layout_flow_tree(ctx, nodes, h_scale, v_scale, loop_offset_factor, if_offset_factor):
+    """
+    Висхідний прохід розкладки: вимірює горизонтальний обсяг піддерев.
+
+    Для розгалуження записує у вузол зсуви гілок від осі ("dx_true", "dx_false"),
+    для циклу - зсуви ліній повернення та виходу ("dx_back", "dx_exit"),
+    для кожного вузла - обсяг його піддерева "extent" = (ліворуч, праворуч).
+    Зсуви рівно такі, щоб сусідні піддерева та лінії не перетинались;
+    "Зсув IF" та "Зсув циклів" лише масштабують проміжки між ними.
+
+    Вузли обходяться без рекурсії: прямий порядок збирається стеком,
+    а вимірюються у зворотному (діти - раніше за батьків), кожен один раз.
+    Згорнутий вузол ("collapsed") вимірюється як простий блок, його тіло
+    не обходиться. Вузли, вже виміряні з тими самими параметрами
+    ("layout_key"), пропускаються разом з піддеревом.
+
+    Повертає обсяг послідовності відносно її осі: (ліворуч, праворуч).
+    """
+    W = BLOCK_WIDTH_DEFAULT * h_scale
+    BRANCH_GAP = BRANCH_GAP_DEFAULT * h_scale * if_offset_factor
+    LANE_GAP = LOOP_LANE_GAP_DEFAULT * h_scale * loop_offset_factor
+    layout_key = (h_scale, v_scale, loop_offset_factor, if_offset_factor, ctx.text_scale)
+
+    # 1. Прямий порядок обходу (батько перед нащадками)
+    order = []
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if node.get("layout_key") == layout_key:
+            continue
+        order.append(node)
+        if not node.get("collapsed"):
+            for child_nodes in _flow_children(node):
+                stack.extend(child_nodes)
+
+    # 2. Вимірювання від листків до кореня
+    for node in reversed(order):
+        kind = node["kind"]
+        node["layout_key"] = layout_key
+
+        if node.get("collapsed"):
+            # Згорнута конструкція - один підсумковий блок
+            node["extent"] = (W / 2, W / 2)
+
+        elif kind == "if":
+            half = rhombus_width(ctx, rhombus_label(node["text"]), h_scale, v_scale) / 2
+            true_left, true_right = _sequence_extent(node["true"])
+            false_left, false_right = _sequence_extent(node["false"])
+            # Гілка не заходить за вісь (там з'єднання гілок) і починається за вершиною ромба
+            node["dx_true"] = max(half, true_left) + BRANCH_GAP / 2
+            node["dx_false"] = max(half, false_right) + BRANCH_GAP / 2
+            node["extent"] = (max(half, node["dx_false"] + false_left),
+                              max(half, node["dx_true"] + true_right))
+
+        elif kind in ("for", "while", "do"):
+            if kind == "for":
+                half = hexagon_width(ctx, node["text"], h_scale, v_scale) / 2
+            else:
+                half = rhombus_width(ctx, rhombus_label(node["text"]), h_scale, v_scale) / 2
+            body_left, body_right = _sequence_extent(node["body"])
+            # Лінії циклу йдуть одразу за найширшою частиною тіла (або заголовка)
+            node["dx_back"] = max(half, body_left) + LANE_GAP
+            if kind == "do":
+                node["extent"] = (node["dx_back"], max(half, body_right))  # (Вихід з 'do-while' - вниз по осі)
+            else:
+                node["dx_exit"] = max(half, body_right) + LANE_GAP
+                node["extent"] = (node["dx_back"], node["dx_exit"])
+
+        else:
+            # Прості блоки (паралелограм ширший на нахил)
+            half = W / 2 + (parallelogram_skew(h_scale) if kind == "para" else 0)
+            node["extent"] = (half, half)
+
+    return _sequence_extent(nodes)
+
+
+def draw_flow_tree(ctx, nodes, start_y, x_center, h_scale, v_scale, colors, node_tops=None):
     """
-    global BLOCK_TEXT_MAP
-    global BLOCK_ID_COUNTER
+    Низхідний прохід розкладки: малює послідовність вузлів дерева
+    (build_flow_tree, виміряного layout_flow_tree) на осі x_center.
 
-    current_y = start_y  # Поточна Y-координата (низ останнього блоку)
-    last_connector_x = x_center  # X-координата для з'єднання
-    last_connector_y = start_y  # Y-координата для з'єднання
+    X гілок та ліній циклів беруться з виміряних зсувів, Y - послідовно,
+    з висот щойно намальованих блоків (висоту перенесеного тексту знає лише Tk).
 
-    # Спеціальна змінна для циклу do-while (для малювання стрілки назад)
-    start_do_body_y = start_y
+    Працює без рекурсії: кадр стеку - це курсор по одній послідовності
+    (вісь, поточний Y, точка з'єднання) та фаза складеного вузла, що
+    чекає на результат дочірньої послідовності.
 
-    # Прапор, що запобігає малюванню зайвої стрілки (напр., після 'do-while')
-    skip_next_connecting_arrow = False
+    node_tops - список, куди додаються Y верхівок вузлів самої послідовності
+    nodes (для розбиття на сторінки), або None.
 
+    Повертає (кінцевий_y, кінцевий_x) - координати точки,
+    з якої має виходити наступна стрілка.
+    """
     # 1. Розпакування кольорів
     try:
         (color_ellipse, color_rect, color_rhombus, color_sub, color_hex) = colors
@@ -725,398 +1602,356 @@ def _draw_flowchart_recursive(canvas, code_list, start_y, x_center, h_scale, v_s
         color_hex = "#D8BFD8"
 
     # 2. Розрахунок масштабованих відступів
-    W = BLOCK_WIDTH_DEFAULT * h_scale
-    H = BLOCK_HEIGHT_DEFAULT * v_scale
     V_SP = V_SPACING_DEFAULT * v_scale
-    BASE_HO = BASE_H_OFFSET_DEFAULT * h_scale
-    NEST_OS = NEST_OFFSET_STEP_DEFAULT * h_scale
     BRANCH_VS = BRANCH_V_SPACING_DEFAULT * v_scale
 
-    i = 0
-    while i < len(code_list):
-        line = code_list[i].strip()
+    def _sequence_frame(seq, y, x):
+        # (current_y - низ останнього блоку, last_x/last_y - точка з'єднання)
+        return {"nodes": seq, "index": 0, "x": x, "current_y": y, "last_x": x, "last_y": y,
+                "phase": 0, "state": None}
 
-        # 3. Пропуск прапорця 'skip_init'
-        if skip_init and line.startswith("Ініціалізація:"):
-            i += 1
-            continue
+    def _mark_head(node):
+        # Щойно намальований блок - заголовок складеного вузла (для згортання)
+        ctx.block_nodes[ctx.block_id_counter - 1] = node["line"]
 
-        try:
-            # 4. Пропуск порожніх рядків або маркерів кінця блоків
-            if (not line or
-                    line.startswith("Все") or
-                    line.startswith("Завершення:") or
-                    line.startswith("Все повторити")):
-                i += 1
-                continue
+    stack = [_sequence_frame(nodes, start_y, x_center)]
+    result = (start_y, x_center)  # (кінцевий_y, кінцевий_x) щойно завершеної послідовності
 
-            # (Рядок 'Інакше' обробляється всередині 'find_if_branches')
-            if line.strip() == "Інакше":
-                i += 1
-                continue
+    while stack:
+        frame = stack[-1]
 
-            # 5. Розрахунок Y-координати верхівки *поточного* блоку
-            block_top_y = current_y
-            if current_y != start_y:
-                block_top_y += V_SP  # Додаємо вертикальний відступ
-
-            # 6. Малювання з'єднувальної стрілки (від попереднього блоку до поточного)
-            if current_y != start_y:
-                if not skip_next_connecting_arrow:
-                    draw_arrow(canvas, last_connector_x, last_connector_y, x_center, block_top_y, draw_arrow_head=True)
-                skip_next_connecting_arrow = False
-
-            # === 7. ОБРОБКА БЛОКІВ ===
-
-            # --- 7.1. Цикл "DO-WHILE" (початок тіла) ---
-            if line == "Повторити доки (початок)":
-                start_do_body_y = block_top_y  # Запам'ятовуємо Y тіла
-
-                # Знаходимо кінець тіла (рядок "Повторити доки (умова):")
-                body_end_index = -1
-                j = i + 1
-                while j < len(code_list):
-                    if code_list[j].strip().startswith("Повторити доки (умова):"):
-                        body_end_index = j
-                        break
-                    j += 1
-                if body_end_index == -1:
-                    raise ValueError("Malformed do-while block: condition not found")
-
-                loop_body_code = code_list[i + 1: body_end_index]
-
-                # Малюємо стрілку до тіла (якщо це не перший блок)
-                if current_y != start_y:
-                    draw_arrow(canvas, last_connector_x, last_connector_y, x_center, start_do_body_y,
-                               draw_arrow_head=True)
-
-                # Рекурсивний виклик для малювання тіла циклу
-                (body_end_y, body_end_x) = _draw_flowchart_recursive(canvas, loop_body_code, start_do_body_y, x_center,
-                                                                     h_scale, v_scale, loop_offset_factor,
-                                                                     if_offset_factor, colors, skip_init,
-                                                                     nesting_level + 1)
-                # Оновлюємо координати для наступного блоку (умови)
-                last_connector_y = body_end_y
-                last_connector_x = body_end_x
-                current_y = body_end_y
-                i = body_end_index  # Перестрибуємо на рядок умови
-                skip_next_connecting_arrow = True  # З'єднувальна стрілка вже намальована
-                continue
+        # 3. Послідовність завершена - повертаємо її точку з'єднання батьківському кадру
+        if frame["index"] >= len(frame["nodes"]):
+            stack.pop()
+            result = (frame["last_y"], frame["last_x"])
+            continue
 
-            # --- 7.2. Цикл "DO-WHILE" (умова) ---
-            elif line.startswith("Повторити доки (умова):"):
-                text = line.replace("Повторити доки (умова): ", "")
-                block_top_y = current_y + V_SP
-                draw_arrow(canvas, last_connector_x, last_connector_y, x_center, block_top_y, draw_arrow_head=True)
-
-                rhombus_coords = draw_rhombus(canvas, x_center, block_top_y, text, h_scale, v_scale, color_rhombus)
-
-                # Збереження тексту для експорту
-                group_tag = f"rhombus_{BLOCK_ID_COUNTER}"
-                BLOCK_TEXT_MAP[group_tag] = text
-                BLOCK_ID_COUNTER += 1
-
-                # Малювання стрілки "True" (назад до тіла циклу)
-                body_nesting_level = nesting_level + 1
-                current_loop_offset_back = (BASE_HO / 3) + (body_nesting_level * NEST_OS * loop_offset_factor)
-                back_bend_x = rhombus_coords["left"][0] - current_loop_offset_back
-                p1_back = rhombus_coords["left"]
-                p2_back = (back_bend_x, p1_back[1])
-                P_BACK_Y = start_do_body_y - V_SP / 2
-                p3_back = (back_bend_x, P_BACK_Y)
-                p4_back = (x_center, P_BACK_Y)
-                draw_multi_point_arrow(canvas, [p1_back, p2_back, p3_back, p4_back], text="True", draw_arrow_head=True)
-
-                # Малювання стрілки "False" (вихід з циклу)
-                start_exit_x, start_exit_y = rhombus_coords["bottom"]
-                join_exit_y = start_exit_y + V_SP
-                draw_arrow(canvas, start_exit_x, start_exit_y, x_center, join_exit_y,
-                           draw_arrow_head=True)
-
-                current_y = join_exit_y
-                last_connector_x = x_center
-                last_connector_y = join_exit_y
-                i += 1
+        node = frame["nodes"][frame["index"]]
+        kind = node["kind"]
+        text = node["text"]
+        x_center = frame["x"]
+        phase = frame["phase"]
+        state = frame["state"]
+        end_y = None  # Y точки з'єднання, коли вузол повністю намальовано
+
+        # 4. Перша фаза: Y-координата верхівки блоку та з'єднувальна стрілка від попереднього
+        if phase == 0:
+            block_top_y = frame["current_y"]
+            if frame["index"] > 0:
+                block_top_y += V_SP
+                draw_arrow(ctx, frame["last_x"], frame["last_y"], x_center, block_top_y, draw_arrow_head=True)
+            if node_tops is not None and len(stack) == 1:
+                node_tops.append(block_top_y)
+
+        # === 5. ОБРОБКА БЛОКІВ ===
+
+        # --- 5.0. Згорнута конструкція (тіло не малюється) ---
+        if node.get("collapsed"):
+            _, end_y = draw_folded_block(ctx, x_center, block_top_y, _folded_text(node), h_scale, v_scale,
+                                         color_rhombus)
+            _mark_head(node)
+
+        # --- 5.1. Цикл "DO-WHILE" (тіло, потім умова) ---
+        elif kind == "do":
+            if phase == 0:
+                # Запам'ятовуємо Y тіла та малюємо тіло
+                frame["state"] = {"body_y": block_top_y}
+                frame["phase"] = 1
+                stack.append(_sequence_frame(node["body"], block_top_y, x_center))
                 continue
 
-            # --- 7.3. Цикл "FOR" ---
-            if line.startswith("Повторити для:"):
-                text = line.replace("Повторити для: ", "")
-
-                hex_coords = draw_hexagon(canvas, x_center, block_top_y, text, h_scale, v_scale, color_hex)
-
-                group_tag = f"hex_{BLOCK_ID_COUNTER}"
-                BLOCK_TEXT_MAP[group_tag] = text
-                BLOCK_ID_COUNTER += 1
-
-                # Знаходимо тіло та кінець циклу
-                loop_body_code, loop_end_index = find_loop_body(code_list, i)
+            (body_end_y, body_end_x) = result
+            block_top_y = body_end_y + V_SP
+            draw_arrow(ctx, body_end_x, body_end_y, x_center, block_top_y, draw_arrow_head=True)
+            rhombus_coords = draw_rhombus(ctx, x_center, block_top_y, text, h_scale, v_scale, color_rhombus)
+            _mark_head(node)
+            if "end_line" in node:
+                # (Умова - у рядку після тіла: блок знаходиться і за ним)
+                ctx.block_lines[ctx.block_id_counter - 1] = node["end_line"]
+
+            # Малювання стрілки "True" (назад до тіла циклу)
+            back_bend_x = x_center - node["dx_back"]
+            p1_back = rhombus_coords["left"]
+            p2_back = (back_bend_x, p1_back[1])
+            P_BACK_Y = state["body_y"] - V_SP / 2
+            p3_back = (back_bend_x, P_BACK_Y)
+            p4_back = (x_center, P_BACK_Y)
+            draw_multi_point_arrow(ctx, [p1_back, p2_back, p3_back, p4_back], text="True", draw_arrow_head=True)
+
+            # Малювання стрілки "False" (вихід з циклу)
+            start_exit_x, start_exit_y = rhombus_coords["bottom"]
+            end_y = start_exit_y + V_SP
+            draw_arrow(ctx, start_exit_x, start_exit_y, x_center, end_y, draw_arrow_head=True)
+
+        # --- 5.2. Цикл "FOR" ---
+        elif kind == "for":
+            if phase == 0:
+                hex_coords = draw_hexagon(ctx, x_center, block_top_y, text, h_scale, v_scale, color_hex)
+                _mark_head(node)
 
                 # Стрілка до тіла циклу
                 branch_start_y = hex_coords["bottom"][1] + BRANCH_VS
-                draw_arrow(canvas, hex_coords["bottom"][0], hex_coords["bottom"][1],
+                draw_arrow(ctx, hex_coords["bottom"][0], hex_coords["bottom"][1],
                            x_center, branch_start_y, draw_arrow_head=True)
 
-                # Рекурсивне малювання тіла
-                (body_end_y, body_end_x) = _draw_flowchart_recursive(canvas, loop_body_code, branch_start_y, x_center,
-                                                                     h_scale, v_scale, loop_offset_factor,
-                                                                     if_offset_factor, colors, skip_init,
-                                                                     nesting_level + 1)
-
-                # Малювання стрілки "назад" (від кінця тіла до входу в шестикутник)
-                if nesting_level == 0:
-                    current_loop_offset_back = (BASE_HO / 3) + (NEST_OS * 10 * loop_offset_factor + 30)
-                else:
-                    current_loop_offset_back = (BASE_HO / 3) + (nesting_level * NEST_OS * 10 * loop_offset_factor)
-
-                loop_back_x = hex_coords["left"][0] - current_loop_offset_back
-                p1_back = (body_end_x, body_end_y)
-                p2_back = (body_end_x, body_end_y + V_SP / 2)
-                p3_back = (loop_back_x, body_end_y + V_SP / 2)
-                p4_back = (loop_back_x, hex_coords["left"][1])
-                p5_back = hex_coords["left"]
-                draw_multi_point_arrow(canvas, [p1_back, p2_back, p3_back, p4_back, p5_back], draw_arrow_head=True)
-
-                # Малювання стрілки "вихід" (від правої грані)
-                start_exit_x, start_exit_y = hex_coords["right"]
-                join_exit_y = body_end_y + V_SP / 1
-                if nesting_level == 0:
-                    current_loop_offset_exit = (BASE_HO / 3) + (NEST_OS * loop_offset_factor + 50)
-                else:
-                    current_loop_offset_exit = (BASE_HO / 3) + (nesting_level * NEST_OS * loop_offset_factor)
-
-                EXIT_OFFSET_X = current_loop_offset_exit + NEST_OS * 2
-                final_join_y = join_exit_y + V_SP / 2
-                exit_points = [
-                    (start_exit_x, start_exit_y),
-                    (start_exit_x + EXIT_OFFSET_X, start_exit_y),
-                    (start_exit_x + EXIT_OFFSET_X, final_join_y),
-                    (x_center, final_join_y),
-                ]
-
-                # (Логіка для виходу з циклу на 0-му рівні вкладеності)
-                if nesting_level == 0:
-                    exit_points = [
-                        (start_exit_x, start_exit_y),
-                        (start_exit_x + EXIT_OFFSET_X, start_exit_y),
-                        (start_exit_x + EXIT_OFFSET_X, final_join_y),
-                        (x_center, final_join_y),
-                        (x_center, final_join_y + V_SP)]
-                    draw_multi_point_arrow(canvas, exit_points, draw_arrow_head=True)
-                else:
-                    draw_multi_point_arrow(canvas, exit_points, draw_arrow_head=False)
-
-                current_y = final_join_y
-                last_connector_y = final_join_y
-                last_connector_x = x_center
-                skip_next_connecting_arrow = True
-                i = loop_end_index + 1  # Перестрибуємо в кінець циклу
+                frame["state"] = {"coords": hex_coords}
+                frame["phase"] = 1
+                stack.append(_sequence_frame(node["body"], branch_start_y, x_center))
                 continue
 
-            # --- 7.4. Цикл "WHILE" ---
-            elif line.startswith("Повторити поки:"):
-                text = line.replace("Повторити поки: ", "")
-
-                rhombus_coords = draw_rhombus(canvas, x_center, block_top_y, text, h_scale, v_scale, color_rhombus)
-
-                group_tag = f"rhombus_{BLOCK_ID_COUNTER}"
-                BLOCK_TEXT_MAP[group_tag] = text
-                BLOCK_ID_COUNTER += 1
-
-                loop_body_code, loop_end_index = find_loop_body(code_list, i)
+            hex_coords = state["coords"]
+            (body_end_y, body_end_x) = result
+
+            # Малювання стрілки "назад" (від кінця тіла до входу в шестикутник)
+            loop_back_x = x_center - node["dx_back"]
+            p1_back = (body_end_x, body_end_y)
+            p2_back = (body_end_x, body_end_y + V_SP / 2)
+            p3_back = (loop_back_x, body_end_y + V_SP / 2)
+            p4_back = (loop_back_x, hex_coords["left"][1])
+            p5_back = hex_coords["left"]
+            draw_multi_point_arrow(ctx, [p1_back, p2_back, p3_back, p4_back, p5_back], draw_arrow_head=True)
+
+            # Малювання стрілки "вихід" (від правої грані до осі під тілом)
+            start_exit_x, start_exit_y = hex_coords["right"]
+            exit_x = x_center + node["dx_exit"]
+            end_y = body_end_y + V_SP * 1.5
+            exit_points = [
+                (start_exit_x, start_exit_y),
+                (exit_x, start_exit_y),
+                (exit_x, end_y),
+                (x_center, end_y),
+            ]
+            draw_multi_point_arrow(ctx, exit_points, draw_arrow_head=False)
+
+        # --- 5.3. Цикл "WHILE" ---
+        elif kind == "while":
+            if phase == 0:
+                rhombus_coords = draw_rhombus(ctx, x_center, block_top_y, text, h_scale, v_scale, color_rhombus)
+                _mark_head(node)
 
                 # Стрілка "True" (до тіла циклу)
                 branch_start_y = rhombus_coords["bottom"][1] + BRANCH_VS
                 p1_true = rhombus_coords["bottom"]
                 p2_true = (x_center, branch_start_y)
-                draw_multi_point_arrow(canvas, [p1_true, p2_true], text="True", draw_arrow_head=True)
-
-                # Рекурсивне малювання тіла
-                (body_end_y, body_end_x) = _draw_flowchart_recursive(canvas, loop_body_code, branch_start_y, x_center,
-                                                                     h_scale, v_scale, loop_offset_factor,
-                                                                     if_offset_factor, colors, skip_init,
-                                                                     nesting_level + 1)
-
-                # Стрілка "назад" (від кінця тіла до умови)
-                current_loop_offset_back = (BASE_HO / 3) + (nesting_level * NEST_OS * loop_offset_factor)
-                loop_back_x = rhombus_coords["left"][0] - current_loop_offset_back * 8 * loop_offset_factor
-                p1_back = (body_end_x, body_end_y)
-                p2_back = (body_end_x, body_end_y + V_SP / 1)
-                p3_back = (loop_back_x, body_end_y + V_SP / 1)
-                p4_back = (loop_back_x, rhombus_coords["top"][1] - 20 * v_scale)
-                p5_back = (body_end_x, rhombus_coords["top"][1] - 20 * v_scale)
-                draw_multi_point_arrow(canvas, [p1_back, p2_back, p3_back, p4_back, p5_back], draw_arrow_head=True)
-
-                # Стрілка "False" (вихід з циклу)
-                start_exit_x, start_exit_y = rhombus_coords["right"]
-                join_exit_y = body_end_y + V_SP / 1.5
-                current_loop_offset_exit = (BASE_HO / 3) + (nesting_level * NEST_OS * loop_offset_factor)
-                EXIT_OFFSET_X = current_loop_offset_exit + NEST_OS * 2
-                final_join_y = join_exit_y + V_SP / 2
-                exit_points = [
-                    (start_exit_x, start_exit_y),
-                    (start_exit_x + EXIT_OFFSET_X, start_exit_y),
-                    (start_exit_x + EXIT_OFFSET_X, final_join_y),
-                    (x_center, final_join_y),
-                    (x_center, final_join_y + V_SP),
-                ]
-                draw_multi_point_arrow(canvas, exit_points, text="False", draw_arrow_head=True)
-
-                current_y = final_join_y
-                last_connector_x = x_center
-                last_connector_y = current_y
-                skip_next_connecting_arrow = True
-                i = loop_end_index + 1  # Перестрибуємо в кінець
-                continue
-
-            # --- 7.5. Блок "IF" / "ELSE IF" ---
-            elif line.startswith("Якщо:") or line.startswith("Інакше Якщо:"):
-                text = line.replace("Якщо: ", "").replace("Інакше Якщо: ", "").replace(" то", "")
-
-                rhombus_coords = draw_rhombus(canvas, x_center, block_top_y, text, h_scale, v_scale, color_rhombus)
+                draw_multi_point_arrow(ctx, [p1_true, p2_true], text="True", draw_arrow_head=True)
 
-                group_tag = f"rhombus_{BLOCK_ID_COUNTER}"
-                BLOCK_TEXT_MAP[group_tag] = text
-                BLOCK_ID_COUNTER += 1
-
-                # Знаходимо гілки "True", "False" та кінець блоку
-                true_code, false_code, if_end_index = find_if_branches(code_list, i)
-
-                # Розрахунок X-координат для гілок (з урахуванням вкладеності)
-                current_branch_offset = (BASE_HO * if_offset_factor) - (
-                        NEST_OS * nesting_level * h_scale)
-                true_x = x_center + current_branch_offset
-                false_x = x_center - (
-                        current_branch_offset + (
-                        NEST_OS * h_scale * 1.5 * if_offset_factor))
+                frame["state"] = {"coords": rhombus_coords}
+                frame["phase"] = 1
+                stack.append(_sequence_frame(node["body"], branch_start_y, x_center))
+                continue
 
+            rhombus_coords = state["coords"]
+            (body_end_y, body_end_x) = result
+
+            # Стрілка "назад" (від кінця тіла до входу в умову)
+            loop_back_x = x_center - node["dx_back"]
+            p1_back = (body_end_x, body_end_y)
+            p2_back = (body_end_x, body_end_y + V_SP)
+            p3_back = (loop_back_x, body_end_y + V_SP)
+            p4_back = (loop_back_x, rhombus_coords["top"][1] - 20 * v_scale)
+            p5_back = (body_end_x, rhombus_coords["top"][1] - 20 * v_scale)
+            draw_multi_point_arrow(ctx, [p1_back, p2_back, p3_back, p4_back, p5_back], draw_arrow_head=True)
+
+            # Стрілка "False" (вихід з циклу, нижче лінії повернення)
+            start_exit_x, start_exit_y = rhombus_coords["right"]
+            exit_x = x_center + node["dx_exit"]
+            end_y = body_end_y + V_SP / 1.5 + V_SP / 2
+            exit_points = [
+                (start_exit_x, start_exit_y),
+                (exit_x, start_exit_y),
+                (exit_x, end_y),
+                (x_center, end_y),
+            ]
+            draw_multi_point_arrow(ctx, exit_points, text="False", draw_arrow_head=False)
+
+        # --- 5.4. Блок "IF" / "ELSE IF" ---
+        elif kind == "if":
+            if phase == 0:
+                rhombus_coords = draw_rhombus(ctx, x_center, block_top_y, text, h_scale, v_scale, color_rhombus)
+                _mark_head(node)
+
+                # X-координати гілок - з виміряних обсягів піддерев
+                true_x = x_center + node["dx_true"]
                 branch_start_y = rhombus_coords["bottom"][1] + BRANCH_VS
 
                 # Малювання гілки "True"
                 p1_true = rhombus_coords["right"]
                 p2_true = (true_x, p1_true[1])
                 p3_true = (true_x, branch_start_y)
-                draw_multi_point_arrow(canvas, [p1_true, p2_true, p3_true], text="True", draw_arrow_head=True)
-                (true_end_y, true_end_x) = _draw_flowchart_recursive(canvas, true_code, branch_start_y, true_x,
-                                                                     h_scale, v_scale, loop_offset_factor,
-                                                                     if_offset_factor, colors, skip_init,
-                                                                     nesting_level + 1)
-
-                # Малювання гілки "False" (якщо вона є)
-                p1_false = rhombus_coords["left"]
-                p2_false = (false_x, p1_false[1])
-                join_y = 0  # Y-координата, де гілки з'єднуються
-
-                if false_code:
-                    # Випадок: if ... else ...
-                    p3_false = (false_x, branch_start_y)
-                    draw_multi_point_arrow(canvas, [p1_false, p2_false, p3_false], text="False", draw_arrow_head=True)
-                    (false_end_y, false_end_x) = _draw_flowchart_recursive(canvas, false_code, branch_start_y, false_x,
-                                                                           h_scale, v_scale, loop_offset_factor,
-                                                                           if_offset_factor, colors, skip_init,
-                                                                           nesting_level + 1)
-
-                    # Точка з'єднання - нижче обох гілок
-                    join_y = max(true_end_y, false_end_y) + V_SP
-
-                    # Малюємо з'єднувальні лінії
-                    draw_arrow(canvas, true_end_x, true_end_y, true_end_x, join_y, draw_arrow_head=False)
-                    draw_arrow(canvas, true_end_x, join_y, x_center, join_y, draw_arrow_head=False)
-                    draw_arrow(canvas, false_end_x, false_end_y, false_end_x, join_y, draw_arrow_head=False)
-                    draw_arrow(canvas, false_end_x, join_y, x_center, join_y, draw_arrow_head=False)
-                else:
-                    # Випадок: if ... (без else)
-                    join_y = true_end_y + V_SP
-
-                    # З'єднуємо гілку "True"
-                    draw_arrow(canvas, true_end_x, true_end_y, true_end_x, join_y, draw_arrow_head=False)
-                    draw_arrow(canvas, true_end_x, join_y, x_center, join_y, draw_arrow_head=False)
-
-                    # Гілка "False" просто огинає блок
-                    p3_false = (false_x, p1_false[1] + BRANCH_VS)
-                    p4_false = (false_x, join_y)
-                    p5_false = (x_center, join_y)
-                    draw_multi_point_arrow(canvas, [p1_false, p2_false, p3_false, p4_false, p5_false],
-                                           text="False",
-                                           draw_arrow_head=False)
-
-                current_y = join_y
-                last_connector_x = x_center
-                last_connector_y = join_y
-                i = if_end_index + 1  # Перестрибуємо в кінець "Все якщо"
+                draw_multi_point_arrow(ctx, [p1_true, p2_true, p3_true], text="True", draw_arrow_head=True)
+
+                frame["state"] = {"coords": rhombus_coords, "branch_start_y": branch_start_y}
+                frame["phase"] = 1
+                stack.append(_sequence_frame(node["true"], branch_start_y, true_x))
                 continue
 
-            # --- 7.6. Стандартні (прості) блоки ---
-            else:
-                y_bottom = 0
-                text_to_save = line
-                style_key_prefix = "rect"  # Тип блоку за замовчуванням
-
-                if line.startswith("Початок") or line.startswith("Кінець"):
-                    style_key_prefix = "ell"
-                    is_main = (line == "Початок" or line == "Кінець")
-                    if is_main:
-                        _, y_bottom = draw_ellipse(canvas, x_center, block_top_y, line, h_scale, v_scale, color_ellipse)
-                    else:
-                        # (Для функцій)
-                        _, y_bottom = draw_subroutine(canvas, x_center, block_top_y, line, h_scale, v_scale, color_sub)
-                    text_to_save = line
-
-                elif line.startswith("Виклик:"):
-                    style_key_prefix = "sub"
-                    text_display = line.replace("Виклик: ", "")
-                    _, y_bottom = draw_subroutine(canvas, x_center, block_top_y, text_display, h_scale, v_scale,
-                                                  color_sub)
-                    text_to_save = text_display
-
-                elif line.startswith("Ввід:"):
-                    style_key_prefix = "para"
-                    _, y_bottom = draw_parallelogram(canvas, x_center, block_top_y, line, h_scale, v_scale, color_sub)
-                    text_to_save = line
-
-                elif line.startswith("Вивід:"):
-                    style_key_prefix = "para"
-                    _, y_bottom = draw_parallelogram(canvas, x_center, block_top_y, line, h_scale, v_scale, color_sub)
-                    text_to_save = line
+            rhombus_coords = state["coords"]
+            false_x = x_center - node["dx_false"]
+            p1_false = rhombus_coords["left"]
+            p2_false = (false_x, p1_false[1])
+
+            if phase == 1 and node["false"]:
+                # Випадок: if ... else ... - спершу малюємо гілку "False"
+                state["true_end"] = result
+                p3_false = (false_x, state["branch_start_y"])
+                draw_multi_point_arrow(ctx, [p1_false, p2_false, p3_false], text="False", draw_arrow_head=True)
+                frame["phase"] = 2
+                stack.append(_sequence_frame(node["false"], state["branch_start_y"], false_x))
+                continue
 
-                else:
-                    # Усі інші операції (присвоєння тощо)
-                    style_key_prefix = "rect"
-                    _, y_bottom = draw_rectangle(canvas, x_center, block_top_y, line, h_scale, v_scale, color_rect)
-                    text_to_save = line
+            if phase == 2:
+                (true_end_y, true_end_x) = state["true_end"]
+                (false_end_y, false_end_x) = result
 
-                # Збереження тексту для експорту (використовуючи координати як ключ)
-                group_tag = f"{style_key_prefix}_{int(x_center)}_{int(block_top_y)}"
-                BLOCK_TEXT_MAP[group_tag] = text_to_save
+                # Точка з'єднання - нижче обох гілок
+                end_y = max(true_end_y, false_end_y) + V_SP
 
-                # Оновлення координат для наступного блоку
-                last_connector_y = y_bottom
-                last_connector_x = x_center
-                current_y = y_bottom
-                i += 1
+                # Малюємо з'єднувальні лінії
+                draw_arrow(ctx, true_end_x, true_end_y, true_end_x, end_y, draw_arrow_head=False)
+                draw_arrow(ctx, true_end_x, end_y, x_center, end_y, draw_arrow_head=False)
+                draw_arrow(ctx, false_end_x, false_end_y, false_end_x, end_y, draw_arrow_head=False)
+                draw_arrow(ctx, false_end_x, end_y, x_center, end_y, draw_arrow_head=False)
+            else:
+                # Випадок: if ... (без else)
+                (true_end_y, true_end_x) = result
+                end_y = true_end_y + V_SP
+
+                # З'єднуємо гілку "True"
+                draw_arrow(ctx, true_end_x, true_end_y, true_end_x, end_y, draw_arrow_head=False)
+                draw_arrow(ctx, true_end_x, end_y, x_center, end_y, draw_arrow_head=False)
+
+                # Гілка "False" просто огинає блок
+                p3_false = (false_x, p1_false[1] + BRANCH_VS)
+                p4_false = (false_x, end_y)
+                p5_false = (x_center, end_y)
+                draw_multi_point_arrow(ctx, [p1_false, p2_false, p3_false, p4_false, p5_false],
+                                       text="False",
+                                       draw_arrow_head=False)
+
+        # --- 5.5. Стандартні (прості) блоки ---
+        else:
+            # (Кожен примітив сам реєструє блок та його текст у ctx.blocks)
+            if kind == "ell":
+                _, end_y = draw_ellipse(ctx, x_center, block_top_y, text, h_scale, v_scale, color_ellipse)
+            elif kind == "sub":
+                _, end_y = draw_subroutine(ctx, x_center, block_top_y, text, h_scale, v_scale, color_sub)
+            elif kind == "para":
+                _, end_y = draw_parallelogram(ctx, x_center, block_top_y, text, h_scale, v_scale, color_sub)
+            elif kind == "conn":
+                _, end_y = draw_offpage_connector(ctx, x_center, block_top_y, text, h_scale, v_scale)
+            else:
+                _, end_y = draw_rectangle(ctx, x_center, block_top_y, text, h_scale, v_scale, color_rect)
+            if "source_line" in node:
+                ctx.block_lines[ctx.block_id_counter - 1] = node["source_line"]
 
-        except Exception as e:
-            # Обробка помилок (наприклад, нескінченний цикл у коді)
-            # print(f"❌ Помилка в _draw_flowchart_recursive на токені {i}: {line}. Деталі: {e}")
-            i += 1
+        # 6. Вузол намальовано - наступний блок з'єднується з віссю під ним
+        frame["current_y"] = end_y
+        frame["last_x"] = x_center
+        frame["last_y"] = end_y
+        frame["index"] += 1
+        frame["phase"] = 0
+        frame["state"] = None
 
-    # Повертаємо координати для виходу з рекурсії
-    return (last_connector_y, last_connector_x)
+    # Повертаємо координати точки з'єднання всієї послідовності
+    return result
 
 
 # --- 7. ОСНОВНИЙ ПАРСЕР: C-КОД -> ПСЕВДОКОД ---
 
-def parse_token_list(input_tokens, depth=0):
+class ParseError(ValueError):
+    """Помилка розбору з позицією токена, на якому її виявлено."""
+
+    def __init__(self, message, position):
+        super().__init__(message)
+        self.position = position
+
+
+def _build_parse_tables(tokens):
     """
-    Рекурсивно обробляє список токенів C-коду і повертає список
-    рядків псевдокоду (з відступами).
+    Таблиці для розбору за лінійний час (один прохід у кожному напрямку):
+
+    match[i] - індекс парної дужки для '(' / '{' (або -1, якщо пари немає);
+    next_semicolon[i] - індекс першої ';' на позиції >= i (або len(tokens));
+    next_open_brace[i] - індекс першої '{' на позиції >= i (або len(tokens));
+    next_sync[i] - індекс першої ';' або '}' на позиції >= i (точка
+    ресинхронізації після помилки, або len(tokens)).
+    """
+    n = len(tokens)
+    match = [-1] * n
+    open_stack = {'(': [], '{': []}
+    closers = {')': '(', '}': '{'}
+    for i, token in enumerate(tokens):
+        if token in open_stack:
+            open_stack[token].append(i)
+        elif token in closers:
+            openers = open_stack[closers[token]]
+            if openers:
+                match[openers.pop()] = i
+
+    next_semicolon = [n] * (n + 1)
+    next_open_brace = [n] * (n + 1)
+    next_sync = [n] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        token = tokens[i]
+        next_semicolon[i] = i if token == ';' else next_semicolon[i + 1]
+        next_open_brace[i] = i if token == '{' else next_open_brace[i + 1]
+        next_sync[i] = i if token in (';', '}') else next_sync[i + 1]
+    return match, next_semicolon, next_open_brace, next_sync
+
+
+def parse_token_list(input_tokens, depth=0, diagnostics=None):
+    """
+    Обробляє список токенів C-коду і повертає список рядків псевдокоду
+    (з відступами).
+
+    Працює ітеративно, з явним стеком: кадр - це діапазон токенів тіла
+    конструкції [x, кінець) та його глибина, тож вкладеність коду не
+    обмежена глибиною рекурсії Python, а тіла не копіюються зрізами.
+    Елемент стеку - або кадр [x, кінець, глибина], або готовий рядок
+    псевдокоду, що виводиться, коли до нього дійде черга.
+
+    Усі пошуки (';', парні дужки) - за таблицями _build_parse_tables, тому
+    розбір лінійний навіть для пошкодженого коду. Після помилки оператор
+    пропускається до наступної ';' або '}' (panic mode), а в diagnostics
+    (якщо передано список) додається {"token": індекс, "near": токен, "message": текст}.
     """
     processed_output = []  # Список рядків псевдокоду
-    x = 0  # Поточний індекс токена
-    n = len(input_tokens)
-    indent = "\t" * depth  # Відступ для поточного рівня вкладеності
+    match, next_semicolon, next_open_brace, next_sync = _build_parse_tables(input_tokens)
+    stack = [[0, len(input_tokens), depth]]
+
+    def _semicolon(start, end):
+        # Перша ';' на позиції >= start у межах кадру
+        index = next_semicolon[start] if start < end else end
+        if index >= end:
+            raise ParseError("Очікувалась ';'", min(start, end))
+        # '{' без пари до цієї ';' - оператор "з'їв" початок блоку (пропущена ';')
+        brace_index = next_open_brace[start]
+        while brace_index < index:
+            if match[brace_index] == -1 or match[brace_index] > index:
+                raise ParseError("Очікувалась ';'", brace_index)
+            brace_index = next_open_brace[match[brace_index]]
+        return index
+
+    def _closing(open_index, end, message):
+        # Парна дужка для '(' / '{' на позиції open_index у межах кадру
+        close_index = match[open_index] if open_index < end else -1
+        if close_index == -1 or close_index >= end:
+            raise ParseError(message, min(open_index, end))
+        return close_index
+
+    while stack:
+        frame = stack.pop()
+        if isinstance(frame, str):
+            processed_output.append(frame)
+            continue
+
+        x, n, depth = frame
+        if x >= n:
+            continue
 
-    while x < n:
+        indent = "\t" * depth  # Відступ для поточного рівня вкладеності
+        pending = []  # Рядки та кадри тіл поточної конструкції (у порядку виводу)
+        closing = None  # Маркер кінця, що закриває вже виведену частину конструкції
         last_x = x  # Для виявлення нескінченних циклів парсера
         try:
             current_word = input_tokens[x]
@@ -1126,6 +1961,10 @@ def parse_token_list(input_tokens, depth=0):
             is_input_type = current_word == "scanf"
             is_declaration_type = current_word in ["int", "float", "double", "str", "char", "long"]
 
+            # (Зайва '}' - помилка; ресинхронізація одразу за нею)
+            if current_word == '}':
+                raise ParseError("Зайва '}'", x)
+
             # --- 2. ОБРОБКА КЕРУЮЧИХ КОНСТРУКЦІЙ (FOR, IF, WHILE, DO) ---
             if current_word in ["for", "if", "while", "do"]:
 
@@ -1141,240 +1980,201 @@ def parse_token_list(input_tokens, depth=0):
                         prefix = "Повторити поки"
 
                     # Знаходимо умову в дужках (...)
-                    open_paren_index = input_tokens.index('(', x + 1)
-
-                    # Пошук *відповідної* закриваючої дужки ')'
-                    close_paren_index = -1
-                    balance = 0
-                    for i in range(open_paren_index, n):
-                        if input_tokens[i] == '(':
-                            balance += 1
-                        elif input_tokens[i] == ')':
-                            balance -= 1
-                        if balance == 0:
-                            close_paren_index = i
-                            break
-                    if close_paren_index == -1:
-                        raise ValueError(f"Невідповідність дужок у {current_word}")
+                    open_paren_index = x + 1
+                    if open_paren_index >= n or input_tokens[open_paren_index] != '(':
+                        raise ParseError(f"Очікувалась '(' після '{current_word}'", open_paren_index)
+                    close_paren_index = _closing(open_paren_index, n, f"Невідповідність дужок у {current_word}")
 
                     # Формуємо заголовок (напр., "i = 0; i < 10; i++")
                     header_part = " ".join(input_tokens[open_paren_index + 1: close_paren_index]).strip()
 
-                    if current_word == "if":
-                        processed_output.append(f"{indent}{prefix}: {header_part} то")
-                    else:
-                        processed_output.append(f"{indent}{prefix}: {header_part}")
-
                     # Обробка тіла конструкції
                     if close_paren_index + 1 < n and input_tokens[close_paren_index + 1] == '{':
                         # Випадок 1: Тіло у фігурних дужках { ... }
-                        code_tokens, end_index = get_block_tokens(input_tokens, close_paren_index + 1)
-                        if end_index == -1: raise ValueError(f"Mismatched braces inside {current_word}")
-
-                        # Рекурсивний виклик для тіла
-                        nested_processed = parse_token_list(code_tokens, depth + 1)
-                        processed_output.extend(nested_processed)
+                        end_index = _closing(close_paren_index + 1, n, f"Незакрита '{{' у {current_word}")
+                        body_frame = [close_paren_index + 2, end_index, depth + 1]
                         x = end_index + 1
                     else:
                         # Випадок 2: Один оператор без дужок (до ';')
-                        semicolon_index = input_tokens.index(';', close_paren_index + 1)
-                        single_statement_tokens = input_tokens[close_paren_index + 1: semicolon_index + 1]
-
-                        nested_processed = parse_token_list(single_statement_tokens, depth + 1)
-                        processed_output.extend(nested_processed)
+                        semicolon_index = _semicolon(close_paren_index + 1, n)
+                        body_frame = [close_paren_index + 1, semicolon_index + 1, depth + 1]
                         x = semicolon_index + 1
 
+                    if current_word == "if":
+                        pending.append(f"{indent}{prefix}: {header_part} то")
+                    else:
+                        pending.append(f"{indent}{prefix}: {header_part}")
+                    pending.append(body_frame)
+
                     # Додаємо маркери кінця блоку
                     if current_word in ["for", "while"]:
-                        processed_output.append(f"{indent}Все повторити")
+                        pending.append(f"{indent}Все повторити")
 
                     # --- 2.2. ОБРОБКА "ELSE" ТА "ELSE IF" ---
                     if current_word == "if":
+                        closing = f"{indent}Все якщо"  # Маркер кінця 'if/else'
                         while x < n and input_tokens[x] == "else":
                             if x + 1 < n and input_tokens[x + 1] == "if":
                                 # Це "ELSE IF"
-                                x += 1  # (Пропускаємо 'else')
-                                try:
-                                    open_paren_index = input_tokens.index('(', x + 1)
-                                    close_paren_index = input_tokens.index(')', open_paren_index)
-                                    header_part = " ".join(
-                                        input_tokens[open_paren_index + 1: close_paren_index]).strip()
-                                except ValueError:
-                                    raise ValueError("Malformed 'else if' statement")
-
-                                processed_output.append(f"{indent}Інакше Якщо: {header_part} то")
+                                open_paren_index = x + 2
+                                if open_paren_index >= n or input_tokens[open_paren_index] != '(':
+                                    raise ParseError("Очікувалась '(' після 'else if'", open_paren_index)
+                                close_paren_index = _closing(open_paren_index, n, "Невідповідність дужок у 'else if'")
+                                header_part = " ".join(input_tokens[open_paren_index + 1: close_paren_index]).strip()
 
                                 # Обробка тіла 'else if' (з { } або без)
                                 if close_paren_index + 1 < n and input_tokens[close_paren_index + 1] == '{':
-                                    code_tokens, end_index = get_block_tokens(input_tokens, close_paren_index + 1)
-                                    if end_index == -1: raise ValueError("Mismatched braces in 'else if' block")
-                                    nested_processed = parse_token_list(code_tokens, depth + 1)
-                                    processed_output.extend(nested_processed)
+                                    end_index = _closing(close_paren_index + 1, n, "Незакрита '{' у 'else if'")
+                                    body_frame = [close_paren_index + 2, end_index, depth + 1]
                                     x = end_index + 1
                                 else:
-                                    semicolon_index = input_tokens.index(';', close_paren_index + 1)
-                                    single_statement_tokens = input_tokens[close_paren_index + 1: semicolon_index + 1]
-                                    nested_processed = parse_token_list(single_statement_tokens, depth + 1)
-                                    processed_output.extend(nested_processed)
+                                    semicolon_index = _semicolon(close_paren_index + 1, n)
+                                    body_frame = [close_paren_index + 1, semicolon_index + 1, depth + 1]
                                     x = semicolon_index + 1
+
+                                pending.append(f"{indent}Інакше Якщо: {header_part} то")
+                                pending.append(body_frame)
                             else:
                                 # Це "ELSE"
-                                processed_output.append(f"{indent}Інакше")
                                 x += 1  # (Пропускаємо 'else')
 
                                 # Обробка тіла 'else' (з { } або без)
                                 if x < n and input_tokens[x] == '{':
-                                    code_tokens, end_index = get_block_tokens(input_tokens, x)
-                                    if end_index == -1: raise ValueError("Mismatched braces in 'else' block")
-                                    nested_processed = parse_token_list(code_tokens, depth + 1)
-                                    processed_output.extend(nested_processed)
+                                    end_index = _closing(x, n, "Незакрита '{' у 'else'")
+                                    body_frame = [x + 1, end_index, depth + 1]
                                     x = end_index + 1
                                 else:
-                                    semicolon_index = input_tokens.index(';', x)
-                                    single_statement_tokens = input_tokens[x: semicolon_index + 1]
-                                    nested_processed = parse_token_list(single_statement_tokens, depth + 1)
-                                    processed_output.extend(nested_processed)
+                                    semicolon_index = _semicolon(x, n)
+                                    body_frame = [x, semicolon_index + 1, depth + 1]
                                     x = semicolon_index + 1
+
+                                pending.append(f"{indent}Інакше")
+                                pending.append(body_frame)
                                 break  # 'else' завжди останній у ланцюжку
 
-                        processed_output.append(f"{indent}Все якщо")  # Маркер кінця 'if/else'
+                        pending.append(closing)
+                        closing = None
 
                 # --- 2.3. DO-WHILE ---
                 elif current_word == "do":
                     if x + 1 < n and input_tokens[x + 1] == '{':
                         # Випадок 1: do { ... } while (...)
-                        start_brace_index = x + 1
-                        code_tokens, end_brace_index = get_block_tokens(input_tokens, start_brace_index)
-                        if end_brace_index == -1: raise ValueError("Mismatched braces in 'do' block")
-                        if end_brace_index + 1 >= n or input_tokens[end_brace_index + 1] != 'while':
-                            raise ValueError("Expected 'while' after 'do' block")
-
+                        end_brace_index = _closing(x + 1, n, "Незакрита '{' у 'do'")
+                        body_frame = [x + 2, end_brace_index, depth + 1]
                         while_index = end_brace_index + 1
-                        open_paren_index = while_index + 1
-                        close_paren_index = input_tokens.index(')', open_paren_index)
-                        header_part = " ".join(input_tokens[open_paren_index + 1: close_paren_index]).strip()
-
-                        processed_output.append(f"{indent}Повторити доки (початок)")
-                        nested_processed = parse_token_list(code_tokens, depth + 1)
-                        processed_output.extend(nested_processed)
-                        processed_output.append(f"{indent}Повторити доки (умова): {header_part}")
-
-                        semicolon_index = input_tokens.index(';', close_paren_index)
-                        x = semicolon_index + 1
                     else:
                         # Випадок 2: do ... while (...)
-                        semicolon_index = input_tokens.index(';', x + 1)
-                        code_tokens = input_tokens[x + 1: semicolon_index + 1]
-                        if semicolon_index + 1 >= n or input_tokens[semicolon_index + 1] != 'while':
-                            raise ValueError("Expected 'while' after 'do' statement")
-
+                        semicolon_index = _semicolon(x + 1, n)
+                        body_frame = [x + 1, semicolon_index + 1, depth + 1]
                         while_index = semicolon_index + 1
-                        open_paren_index = while_index + 1
-                        close_paren_index = input_tokens.index(')', open_paren_index)
-                        header_part = " ".join(input_tokens[open_paren_index + 1: close_paren_index]).strip()
 
-                        processed_output.append(f"{indent}Повторити доки (початок)")
-                        nested_processed = parse_token_list(code_tokens, depth + 1)
-                        processed_output.extend(nested_processed)
-                        processed_output.append(f"{indent}Повторити доки (умова): {header_part}")
+                    if while_index >= n or input_tokens[while_index] != 'while':
+                        raise ParseError("Очікувалось 'while' після тіла 'do'", while_index)
+                    open_paren_index = while_index + 1
+                    if open_paren_index >= n or input_tokens[open_paren_index] != '(':
+                        raise ParseError("Очікувалась '(' після 'while'", open_paren_index)
+                    close_paren_index = _closing(open_paren_index, n, "Невідповідність дужок у 'do-while'")
+                    header_part = " ".join(input_tokens[open_paren_index + 1: close_paren_index]).strip()
+                    semicolon_index_final = _semicolon(close_paren_index, n)
 
-                        semicolon_index_final = input_tokens.index(';', close_paren_index)
-                        x = semicolon_index_final + 1
-                continue
+                    pending.append(f"{indent}Повторити доки (початок)")
+                    pending.append(body_frame)
+                    pending.append(f"{indent}Повторити доки (умова): {header_part}")
+                    x = semicolon_index_final + 1
 
             # --- 3. ОБРОБКА ІНІЦІАЛІЗАЦІЇ ЗМІННИХ ---
             elif is_declaration_type:
-                semicolon_index = input_tokens.index(';', x)
+                semicolon_index = _semicolon(x, n)
                 # Беремо все між типом (int) та ';'
                 declaration_line = " ".join(input_tokens[x + 1: semicolon_index]).strip()
-                processed_output.append(f"{indent}Ініціалізація: {declaration_line}")
+                pending.append(f"{indent}Ініціалізація: {declaration_line}")
                 x = semicolon_index + 1
-                continue
 
             # --- 4. ОБРОБКА ВВОДУ/ВИВОДУ (printf/scanf) ---
             elif is_output_type or is_input_type:
-                try:
-                    semicolon_index = input_tokens.index(';', x)
-                    io_statement = " ".join(input_tokens[x: semicolon_index + 1]).strip()
-                    prefix = "Вивід" if is_output_type else "Ввід"
-
-                    # Спрощена логіка: шукаємо змінну після першої коми
-                    match_var = re.search(r',\s*(.*)\s*\)', io_statement)
-                    if match_var:
-                        variable = match_var.group(1)
-                        processed_output.append(f"{indent}{prefix}: {variable}")
-                    else:
-                        if not is_output_type:  # (scanf)
-                            processed_output.append(f"{indent}Ввід: Невідома змінна")
-                        # (printf без змінних, напр. "Hello", ігноруємо)
-
-                    x = semicolon_index + 1
-                    continue
-                except ValueError:
-                    # (Якщо в рядку немає ';', пропускаємо)
-                    try:
-                        x += input_tokens[x:].index(';') + 1
-                    except ValueError:
-                        x += 1
-                    continue
+                semicolon_index = _semicolon(x, n)
+                io_statement = " ".join(input_tokens[x: semicolon_index + 1]).strip()
+                prefix = "Вивід" if is_output_type else "Ввід"
+
+                # Спрощена логіка: шукаємо змінну після першої коми
+                match_var = re.search(r',\s*(.*)\s*\)', io_statement)
+                if match_var:
+                    variable = match_var.group(1)
+                    pending.append(f"{indent}{prefix}: {variable}")
+                else:
+                    if not is_output_type:  # (scanf)
+                        pending.append(f"{indent}Ввід: Невідома змінна")
+                    # (printf без змінних, напр. "Hello", ігноруємо)
+
+                x = semicolon_index + 1
 
             # --- 5. ПРОПУСК (fflush) ---
             elif current_word == "fflush":
-                semicolon_index = input_tokens.index(';', x)
+                semicolon_index = _semicolon(x, n)
                 x = semicolon_index + 1
-                continue
 
             # --- 6. ОБРОБКА ВИКЛИКУ ФУНКЦІЇ ---
             elif x + 1 < n and input_tokens[x + 1] == '(':
                 # (Якщо наступний токен - дужка, це виклик функції)
                 open_paren_index = x + 1
-                close_paren_index = input_tokens.index(')', open_paren_index)
-                semicolon_index = input_tokens.index(';', close_paren_index)
+                close_paren_index = _closing(open_paren_index, n, f"Невідповідність дужок у виклику {current_word}")
+                semicolon_index = _semicolon(close_paren_index, n)
                 values = " ".join(input_tokens[open_paren_index + 1: close_paren_index]).strip()
-                processed_output.append(f"{indent}Виклик: {current_word}({values})")
+                pending.append(f"{indent}Виклик: {current_word}({values})")
                 x = semicolon_index + 1
-                continue
 
             # --- 7. ОБРОБКА "RETURN" ---
             elif current_word == "return":
-                semicolon_index = input_tokens.index(';', x)
+                semicolon_index = _semicolon(x, n)
                 tokens_in_statement = input_tokens[x:semicolon_index]
                 statement_line = " ".join(tokens_in_statement).strip()
 
                 # Малюємо блок 'return' тільки якщо він щось повертає
                 # (Ігноруємо 'return;' та 'return 0;')
                 if statement_line and statement_line != "return 0":
-                    processed_output.append(f"{indent}{statement_line}")
+                    pending.append(f"{indent}{statement_line}")
 
                 x = semicolon_index + 1
-                continue
 
             # --- 8. ОБРОБКА ІНШИХ ОПЕРАТОРІВ (ПРИСВОЄННЯ) ---
             else:
-                semicolon_index = input_tokens.index(';', x)
+                semicolon_index = _semicolon(x, n)
                 statement_line = " ".join(input_tokens[x: semicolon_index]).strip()
                 if statement_line:  # (Якщо рядок не порожній)
-                    processed_output.append(f"{indent}{statement_line}")
+                    pending.append(f"{indent}{statement_line}")
                 x = semicolon_index + 1
-                continue
 
-        except ValueError:
-            # (Якщо сталася помилка парсингу, напр. 'index' не знайшов ';')
-            x += 1
+        except ParseError as e:
+            # Panic mode: фіксуємо помилку та пропускаємо решту оператора до ';' або '}'
+            # (вже розібрані частини 'if' лишаються та закриваються маркером кінця)
+            if diagnostics is not None:
+                near = input_tokens[e.position] if e.position < len(input_tokens) else ""
+                diagnostics.append({"token": e.position, "near": near, "message": str(e)})
+            if closing is not None:
+                pending.append(closing)
+            sync_index = next_sync[max(e.position, last_x)]
+            x = sync_index + 1 if sync_index < n else n
 
         # Захист від нескінченного циклу парсера
         if x == last_x and x < n:
             print(f"Infinite loop detected! Force skipping token: {input_tokens[x]}")
             x += 1
 
+        # Спершу - вивід поточної конструкції (з її тілами), потім - решта кадру
+        stack.append([x, n, depth])
+        stack.extend(reversed(pending))
+
     return processed_output
 
 
+@PERF.timed("find_function_bodies")
 def find_function_bodies(tokens):
     """
     Знаходить усі функції у списку токенів та вилучає їхні тіла та аргументи.
 
-    Повертає: {func_name: {"args": [tokens], "body": [tokens]}}
+    Повертає: {func_name: {"args": [tokens], "body": [tokens], "offset": індекс тіла у tokens}}.
+    Тіло без закриваючої '}' (файл, що ще редагується) триває до кінця
+    токенів і позначається "unclosed": True; пошук на цьому завершується.
     """
     function_map = {}
     i = 0
@@ -1439,22 +2239,282 @@ def find_function_bodies(tokens):
 
                         function_map[function_name] = {
                             "args": arg_tokens,
-                            "body": body_tokens
+                            "body": body_tokens,
+                            "offset": start_brace_index + 1  # Індекс першого токена тіла у файлі
                         }
 
+                        if end_brace_index < 0:
+                            # (Немає парної '}': тіло - решта файлу, далі шукати нічого)
+                            function_map[function_name]["body"] = tokens[start_brace_index + 1:]
+                            function_map[function_name]["unclosed"] = True
+                            break
+
                         i = end_brace_index + 1  # Перестрибуємо в кінець функції
                         continue
         i += 1
 
     # Резервний варіант (якщо код - це лише 'main' без 'int main()')
     if not function_map and tokens:
-        function_map["main"] = {"args": [], "body": tokens}
+        function_map["main"] = {"args": [], "body": tokens, "offset": 0}
     return function_map
 
 
+def _build_function_pseudocode(func_name, data, diagnostics=None):
+    """
+    Парсить тіло однієї функції (результат find_function_bodies) у псевдокод
+    та додає блоки "Початок"/"Кінець". Помилки розбору додаються у diagnostics.
+    """
+    tokens = data["body"]
+    arg_tokens = data["args"]
+
+    # Запускаємо парсер C -> Псевдокод
+    with PERF.span("parse_token_list"):
+        parsed_list = parse_token_list(tokens, depth=0, diagnostics=diagnostics)
+
+    final_list = []
+    arg_string = " ".join(arg_tokens)
+    if len(arg_string) > 30:
+        arg_string = arg_string[:27] + "..."
+
+    # Додаємо "Початок" та "Кінець"
+    if func_name == "main":
+        final_list.append("Початок")
+        final_list.extend(parsed_list)
+        final_list.append("Кінець")
+    else:
+        final_list.append(f"Початок: {func_name}({arg_string})")
+        final_list.extend(parsed_list)
+        final_list.append(f"Кінець: {func_name}({arg_string})")
+
+    return final_list
+
+
+class LazyFunctionCodeMap(Mapping):
+    """
+    Словник {ім'я_функції: псевдокод}, що парсить тіло функції лише при
+    першому зверненні (вибір у списку, експорт) та запам'ятовує результат.
+
+    Ключі (і їхній порядок) відомі одразу після find_function_bodies.
+    Разом з псевдокодом зберігається діагностика розбору кожної функції
+    (позиції - індекси токенів тіла; рядки файлу - через line_starts).
+    """
+
+    def __init__(self, function_map, parsed=None, cache_key=None, diagnostics=None, line_starts=None):
+        self._function_map = function_map  # {func_name: {"args": [...], "body": [...], "offset": int}}
+        self._parsed = dict(parsed or {})  # {func_name: [рядки псевдокоду]}
+        self._diagnostics = dict(diagnostics or {})  # {func_name: [помилки розбору]}
+        self._line_starts = line_starts  # Індекс першого токена кожного рядка файлу (див. _line_starts)
+        self._cache_key = cache_key  # Ключ дискового кешу (None - не кешувати)
+        self._saved_count = len(self._parsed)  # Скільки тіл вже записано на диск
+        self._body_hashes = {}  # {func_name: хеш токенів}
+
+    def __getitem__(self, func_name):
+        if func_name not in self._parsed:
+            data = self._function_map[func_name]  # (KeyError для невідомих функцій)
+            code_list, diagnostics = _parse_function_safely(func_name, data)
+            self._diagnostics[func_name] = diagnostics
+            self._parsed[func_name] = code_list
+        return self._parsed[func_name]
+
+    def __contains__(self, func_name):
+        # (Перевірка наявності не повинна запускати парсинг)
+        return func_name in self._function_map
+
+    def __iter__(self):
+        return iter(self._function_map)
+
+    def __len__(self):
+        return len(self._function_map)
+
+    def is_parsed(self, func_name):
+        """Чи вже розпарсено тіло функції."""
+        return func_name in self._parsed
+
+    def parse_all(self, max_workers=None):
+        """
+        Парсить усі ще не розпарсені функції (паралельно, якщо обсяг великий)
+        та зливає результати у порядку знаходження функцій.
+        """
+        pending = {name: data for name, data in self._function_map.items() if name not in self._parsed}
+        for func_name, (code_list, diagnostics) in parse_all_functions(pending, max_workers).items():
+            if func_name not in self._parsed:
+                self._diagnostics[func_name] = diagnostics
+                self._parsed[func_name] = code_list
+
+    def diagnostics(self, func_name):
+        """
+        Помилки розбору функції (парсить її, якщо потрібно) у вигляді
+        [{"line": номер рядка файлу або None, "token", "near", "message"}].
+        """
+        self[func_name]
+        data = self._function_map[func_name]
+        result = []
+        for diagnostic in self._diagnostics.get(func_name, []):
+            line = None
+            if self._line_starts is not None and "offset" in data:
+                # (Номер рядка, 1-based: кількість рядків, що починаються не пізніше токена)
+                line = bisect.bisect_right(self._line_starts, data["offset"] + diagnostic["token"])
+            result.append(dict(diagnostic, line=line))
+        return result
+
+    def source_span(self, func_name):
+        """
+        (перший, останній) рядок файлу тіла функції (від '{' до '}', 1-based)
+        або None - без позицій рядків чи для резервної "main" з усього файлу.
+        """
+        data = self._function_map[func_name]
+        if self._line_starts is None or data.get("offset", 0) == 0:
+            return None
+        start_token = data["offset"] - 1  # '{'
+        end_token = data["offset"] + len(data["body"])  # '}' (у незакритого тіла - останній токен)
+        if data.get("unclosed"):
+            end_token -= 1
+        return (bisect.bisect_right(self._line_starts, start_token),
+                bisect.bisect_right(self._line_starts, end_token))
+
+    def body_hash(self, func_name):
+        """Хеш токенів (аргументи + тіло) функції - для виявлення змін."""
+        if func_name not in self._body_hashes:
+            data = self._function_map[func_name]
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update("\x00".join(data["args"]).encode("utf-8"))
+            digest.update(b"\x01")
+            digest.update("\x00".join(data["body"]).encode("utf-8"))
+            if data.get("unclosed"):
+                digest.update(b"\x02")  # (Ті самі токени без '}' - інша діагностика)
+            self._body_hashes[func_name] = digest.hexdigest()
+        return self._body_hashes[func_name]
+
+    def reload(self, function_map, cache_key=None, line_starts=None):
+        """
+        Створює нову мапу для оновленого файлу, переносячи вже розпарсені тіла
+        функцій (та їхню діагностику), хеш яких не змінився.
+
+        Повертає (нова_мапа, [імена змінених/нових функцій]).
+        """
+        new_map = LazyFunctionCodeMap(function_map, cache_key=cache_key, line_starts=line_starts)
+        changed = []
+        for func_name in function_map:
+            if func_name in self._function_map and new_map.body_hash(func_name) == self.body_hash(func_name):
+                if func_name in self._parsed:
+                    new_map._parsed[func_name] = self._parsed[func_name]
+                    new_map._diagnostics[func_name] = self._diagnostics.get(func_name, [])
+            else:
+                changed.append(func_name)
+        return new_map, changed
+
+    def is_fully_parsed(self):
+        """Чи розпарсені всі функції."""
+        return len(self._parsed) >= len(self._function_map)
+
+    def body_token_count(self):
+        """Сумарна кількість токенів у тілах усіх функцій."""
+        return sum(len(data["body"]) for data in self._function_map.values())
+
+    def save_cache(self):
+        """Записує знайдені функції та вже розпарсені тіла у дисковий кеш (якщо є нові)."""
+        parsed = dict(self._parsed)  # (Знімок: парсинг може тривати у фоновому потоці)
+        if self._cache_key is None or len(parsed) <= self._saved_count:
+            return
+        diagnostics = {name: self._diagnostics.get(name, []) for name in parsed}
+        if _write_parse_cache(self._cache_key, self._function_map, parsed, diagnostics, self._line_starts):
+            self._saved_count = len(parsed)
+
+    def parse_all_and_save_cache(self):
+        """parse_all() з подальшим записом результату у дисковий кеш."""
+        self.parse_all()
+        self.save_cache()
+
+
+# --- 7.1. ПАРАЛЕЛЬНИЙ ПАРСИНГ (ПУЛ ПРОЦЕСІВ) ---
+
+_PARSE_WORKER_WORDS = None  # Словник токенів (індекс -> токен) у процесі-воркері
+
+
+def _unclosed_body_diagnostics(data):
+    """Діагностика тіла без закриваючої '}' (позиція - сама '{', перед першим токеном тіла)."""
+    if not data.get("unclosed"):
+        return []
+    return [{"token": -1, "near": "{", "message": "Немає закриваючої '}' тіла функції: тіло - до кінця файлу"}]
+
+
+def _parse_function_safely(func_name, data):
+    """
+    Парсить функцію. Повертає (псевдокод, діагностика); при внутрішній
+    помилці парсера - порожній псевдокод та діагностику з її описом.
+    """
+    diagnostics = _unclosed_body_diagnostics(data)
+    try:
+        return _build_function_pseudocode(func_name, data, diagnostics), diagnostics
+    except Exception as e_inner:
+        print(f"Error while parsing function '{func_name}': {e_inner}")
+        return [], [{"token": 0, "near": "", "message": f"Внутрішня помилка парсера: {e_inner}"}]
+
+
+def _encode_function_bodies(function_map):
+    """
+    Перетворює токени функцій на компактні масиви цілих чисел.
+
+    Повертає (words, jobs), де words - список унікальних токенів (індекс -> токен),
+    а jobs - [(func_name, array(args), array(body))] у порядку знаходження.
+    """
+    vocabulary = {}  # {токен: індекс}
+    jobs = []
+    for func_name, data in function_map.items():
+        args = array('I', [vocabulary.setdefault(token, len(vocabulary)) for token in data["args"]])
+        body = array('I', [vocabulary.setdefault(token, len(vocabulary)) for token in data["body"]])
+        jobs.append((func_name, args, body))
+    return list(vocabulary), jobs
+
+
+def _init_parse_worker(words):
+    """Ініціалізатор воркера: отримує словник токенів один раз на процес."""
+    global _PARSE_WORKER_WORDS
+    _PARSE_WORKER_WORDS = words
+
+
+def _parse_encoded_function(job):
+    """(Виконується у воркері) Декодує токени функції та парсить її."""
+    func_name, args, body = job
+    words = _PARSE_WORKER_WORDS
+    data = {"args": [words[i] for i in args], "body": [words[i] for i in body]}
+    return func_name, _parse_function_safely(func_name, data)
+
+
+@PERF.timed("parse_all_functions")
+def parse_all_functions(function_map, max_workers=None):
+    """
+    Парсить усі функції з function_map (результат find_function_bodies).
+
+    Великі обсяги розподіляються на пул процесів (токени передаються як
+    компактні масиви індексів); малі парсяться послідовно.
+    Повертає {func_name: (псевдокод, діагностика)} у порядку знаходження функцій.
+    """
+    total_tokens = sum(len(data["body"]) for data in function_map.values())
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if (max_workers <= 1 or len(function_map) < PARALLEL_PARSE_MIN_FUNCTIONS or
+            total_tokens < PARALLEL_PARSE_MIN_TOKENS):
+        return {name: _parse_function_safely(name, data) for name, data in function_map.items()}
+
+    words, jobs = _encode_function_bodies(function_map)
+    chunk_size = max(1, len(jobs) // (max_workers * 4))
+
+    # 'spawn' - безпечно для процесу з Tk та фоновими потоками
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_parse_worker, initargs=(words,)) as executor:
+        # (map зберігає порядок завдань, тому результат детермінований)
+        results = dict(executor.map(_parse_encoded_function, jobs, chunksize=chunk_size))
+    # (Воркер отримує лише токени - позначку незакритого тіла додаємо тут)
+    for func_name, data in function_map.items():
+        results[func_name][1][:0] = _unclosed_body_diagnostics(data)
+    return results
+
+
 def tokenize_code(code_string):
     """
-    (Не використовується, логіка дублюється в select_file_...)
+    (Не використовується, робоча версія - tokenize_c_source)
     Розбиває C-код на токени, зберігаючи оператори, дужки та роздільники.
     """
     # Додаємо пробіли навколо складних операторів
@@ -1500,218 +2560,1057 @@ def tokenize_code(code_string):
     return filtered_tokens
 
 
+# --- 7.2. ЗАВАНТАЖЕННЯ ФАЙЛУ ТА ДИСКОВИЙ КЕШ ПАРСИНГУ ---
+
+def _split_line_tokens(line):
+    """Розбиває один рядок C-коду на "сирі" токени (до фільтрації коментарів та #)."""
+    line = re.sub(r'//.*', '', line)  # Видалення // коментарів
+
+    # Додавання пробілів навколо операторів
+    symbols_to_separate = ['(', ')', '[', ']', ';', '=', ',', '&', '<', '>', '!', '+', '-', '{', '}', '|']
+    for symbol in symbols_to_separate:
+        line = line.replace(symbol, f' {symbol} ')
+    line = line.replace('!=', ' != ')
+    line = line.replace('==', ' == ')
+    line = line.replace('<=', ' <= ')
+    line = line.replace('>=', ' >= ')
+    line = line.replace('++', ' ++ ')
+    line = line.replace('--', ' -- ')
+    line = line.replace('+=', ' += ')
+    line = line.replace('-=', ' -= ')
+    line = line.replace('||', ' || ')
+    line = line.replace('&&', ' && ')
+
+    symbols = ['(', ')', '{', '}', ';', ',', '=', '+', '-', '*', '/', '>', '<', '!']
+    for sym in symbols:
+        line = line.replace(sym, f' {sym} ')
+
+    return line.split()
+
+
+def _filter_line_tokens(tokens, state):
+    """
+    Фільтрує /* ... */ та #define для токенів одного рядка.
+
+    state = (in_comment, in_define) на початку рядка.
+    Повертає (відфільтровані_токени, стан_на_кінці_рядка).
+    """
+    in_comment, in_define = state
+    filtered_tokens = []
+    for token in tokens:
+        if token.startswith('/*'): in_comment = True; continue
+        if token.endswith('*/'): in_comment = False; continue
+        if token.startswith('#'): in_define = True; continue
+        if in_define and token.endswith('\\'): continue
+        if in_define and not token.endswith('\\'): in_define = False; continue
+        if not in_comment and not in_define:
+            filtered_tokens.append(token)
+    return filtered_tokens, (in_comment, in_define)
+
+
+@PERF.timed("tokenize")
+def lex_source_lines(lines):
+    """
+    Токенізує текст по рядках, запам'ятовуючи стан фільтра на початку кожного
+    рядка (це дозволяє згодом перелексувати лише змінену ділянку).
+
+    Повертає {"lines": [...], "tokens": [[токени рядка], ...], "states": [стан_на_початку_рядка, ...]}.
+    """
+    line_tokens = []
+    states = []
+    state = (False, False)
+    for line in lines:
+        states.append(state)
+        tokens, state = _filter_line_tokens(_split_line_tokens(line), state)
+        line_tokens.append(tokens)
+    return {"lines": list(lines), "tokens": line_tokens, "states": states}
+
+
+@PERF.timed("tokenize")
+def relex_changed_lines(lexed, new_lines):
+    """
+    Інкрементально оновлює результат lex_source_lines для нового тексту.
+
+    Незмінні рядки на початку та в кінці файлу не лексуються повторно: після
+    зміненої ділянки лексинг триває лише до першого рядка, де стан фільтра
+    збігається зі старим (далі токени беруться зі старого результату).
+    Повертає (новий_lexed, кількість_перелексованих_рядків).
+    """
+    old_lines = lexed["lines"]
+    old_count, new_count = len(old_lines), len(new_lines)
+
+    # 1. Спільний префікс та суфікс (у рядках)
+    prefix = 0
+    while prefix < min(old_count, new_count) and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(old_count, new_count) - prefix and \
+            old_lines[old_count - 1 - suffix] == new_lines[new_count - 1 - suffix]:
+        suffix += 1
+
+    line_tokens = lexed["tokens"][:prefix]
+    states = lexed["states"][:prefix]
+    state = lexed["states"][prefix] if prefix < old_count else _end_state(lexed)
+
+    # 2. Лексуємо змінену ділянку та рядки суфікса до синхронізації стану
+    relexed = 0
+    i = prefix
+    while i < new_count:
+        old_i = i - (new_count - old_count)  # (Відповідний рядок старого тексту для суфікса)
+        if i >= new_count - suffix and lexed["states"][old_i] == state:
+            # Стан збігся - решта токенів не зміниться
+            line_tokens.extend(lexed["tokens"][old_i:])
+            states.extend(lexed["states"][old_i:])
+            break
+        states.append(state)
+        tokens, state = _filter_line_tokens(_split_line_tokens(new_lines[i]), state)
+        line_tokens.append(tokens)
+        relexed += 1
+        i += 1
+
+    return {"lines": list(new_lines), "tokens": line_tokens, "states": states}, relexed
+
+
+def _end_state(lexed):
+    """Стан фільтра після останнього рядка."""
+    if not lexed["lines"]:
+        return (False, False)
+    _, state = _filter_line_tokens(_split_line_tokens(lexed["lines"][-1]), lexed["states"][-1])
+    return state
+
+
+def tokenize_c_source(full_text):
+    """
+    Розбиває текст C-файлу на токени (видаляє коментарі // та директиви #).
+    Повертає фінальний список токенів для find_function_bodies.
+    """
+    return _join_line_tokens(lex_source_lines(full_text.split('\n')))
+
+
+def _join_line_tokens(lexed):
+    """Об'єднує токени всіх рядків у єдиний список."""
+    return [token for tokens in lexed["tokens"] for token in tokens]
+
+
+def _line_starts(lexed):
+    """
+    Індекс (у списку _join_line_tokens) першого токена кожного рядка -
+    за ним позиція токена перетворюється на номер рядка (bisect).
+    """
+    starts = array('I')
+    total = 0
+    for tokens in lexed["tokens"]:
+        starts.append(total)
+        total += len(tokens)
+    return starts
+
+
+def _source_cache_key(source_bytes):
+    """Ключ кешу: хеш вмісту файлу разом з версією парсера."""
+    digest = hashlib.sha256(source_bytes)
+    digest.update(f"|parser-{PARSER_VERSION}".encode("ascii"))
+    return digest.hexdigest()
+
+
+def _parse_cache_path(cache_key):
+    return os.path.join(PARSE_CACHE_DIR, f"{cache_key}.bin")
+
+
+def _read_parse_cache(cache_key):
+    """
+    Читає запис кешу. Повертає (function_map, parsed, diagnostics, line_starts)
+    або None, якщо запису немає, він пошкоджений чи створений іншою версією парсера.
+    """
+    path = _parse_cache_path(cache_key)
+    try:
+        with open(path, "rb") as f:
+            header = f.read(len(PARSE_CACHE_MAGIC) + 4)
+            if header != PARSE_CACHE_MAGIC + struct.pack("<HH", PARSER_VERSION, marshal.version):
+                return None
+            payload = marshal.loads(f.read())
+
+        words = payload["words"]
+        function_map = {}
+        for func_name, args_bytes, body_bytes, offset in payload["functions"]:
+            args, body = array('I'), array('I')
+            args.frombytes(args_bytes)
+            body.frombytes(body_bytes)
+            function_map[func_name] = {"args": [words[i] for i in args], "body": [words[i] for i in body],
+                                       "offset": offset}
+        for func_name in payload.get("unclosed", ()):
+            function_map[func_name]["unclosed"] = True
+        line_starts = array('I')
+        line_starts.frombytes(payload["line_starts"])
+        try:
+            os.utime(path)  # (Час використання: _prune_parse_cache витісняє найдавніше використані)
+        except OSError:
+            pass
+        return function_map, payload["parsed"], payload["diagnostics"], line_starts
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # (Пошкоджений або несумісний запис - просто парсимо заново)
+        print(f"Parse cache entry ignored: {e}")
+        return None
+
+
+def _write_parse_cache(cache_key, function_map, parsed, diagnostics, line_starts):
+    """Атомарно записує запис кешу (marshal + заголовок з версією). Повертає True при успіху."""
+    words, jobs = _encode_function_bodies(function_map)
+    payload = {
+        "words": words,
+        "functions": [(func_name, args.tobytes(), body.tobytes(), function_map[func_name].get("offset", 0))
+                      for func_name, args, body in jobs],
+        "parsed": parsed,
+        "diagnostics": diagnostics,
+        "line_starts": line_starts.tobytes() if line_starts is not None else b"",
+        "unclosed": [func_name for func_name, data in function_map.items() if data.get("unclosed")],
+    }
+    try:
+        os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=PARSE_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(PARSE_CACHE_MAGIC + struct.pack("<HH", PARSER_VERSION, marshal.version))
+            f.write(marshal.dumps(payload))
+        os.replace(tmp_path, _parse_cache_path(cache_key))  # (Читачі не побачать напівзаписаний файл)
+        _prune_parse_cache()
+        return True
+    except OSError as e:
+        print(f"Could not write parse cache: {e}")
+        return False
+
+
+def _prune_parse_cache():
+    """
+    Видаляє найдавніше використані записи (mtime оновлюється при читанні),
+    якщо їх більше за PARSE_CACHE_MAX_FILES. Записи, які тим часом видалив
+    інший процес, пропускаються.
+    """
+    entries = []
+    for name in os.listdir(PARSE_CACHE_DIR):
+        if not name.endswith(".bin"):
+            continue
+        path = os.path.join(PARSE_CACHE_DIR, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            pass
+    if len(entries) <= PARSE_CACHE_MAX_FILES:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - PARSE_CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def load_c_source(file_path):
+    """
+    Завантажує C-файл і повертає LazyFunctionCodeMap.
+
+    Якщо файл не змінювався з минулого відкриття, токенізація та парсинг
+    пропускаються повністю - функції беруться з дискового кешу.
+    """
+    with open(file_path, 'rb') as f:
+        source_bytes = f.read()
+
+    cache_key = _source_cache_key(source_bytes)
+    cached = _read_parse_cache(cache_key)
+    if cached is not None:
+        function_map, parsed, diagnostics, line_starts = cached
+        print(f"Parse cache hit: {len(function_map)} function(s), {len(parsed)} parsed.")
+        return LazyFunctionCodeMap(function_map, parsed=parsed, cache_key=cache_key, diagnostics=diagnostics,
+                                   line_starts=line_starts)
+
+    # (Нормалізація кінців рядків як у текстовому режимі open())
+    lexed = lex_source_lines(_decode_source_lines(source_bytes))
+    line_starts = _line_starts(lexed)
+
+    # Знаходимо всі функції в коді (парсинг тіл - ліниво)
+    function_map = find_function_bodies(_join_line_tokens(lexed))
+    code_map = LazyFunctionCodeMap(function_map, cache_key=cache_key, line_starts=line_starts)
+    _write_parse_cache(cache_key, function_map, {}, {}, line_starts)
+    return code_map
+
+
+def _decode_source_lines(source_bytes):
+    """Декодує вміст файлу та розбиває на рядки (кінці рядків нормалізуються)."""
+    return source_bytes.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+
+
+def reload_c_source(code_map, lexed, file_path):
+    """
+    Перечитує змінений файл: перелексовує лише змінені рядки (або весь файл,
+    якщо lexed=None), заново знаходить функції та переносить розпарсені тіла
+    незмінених функцій.
+
+    Повертає (нова_мапа, новий_lexed, [змінені функції]).
+    """
+    with open(file_path, 'rb') as f:
+        source_bytes = f.read()
+    new_lines = _decode_source_lines(source_bytes)
+
+    if lexed is None:
+        lexed = lex_source_lines(new_lines)
+    else:
+        lexed, relexed_count = relex_changed_lines(lexed, new_lines)
+        print(f"Live reload: re-lexed {relexed_count} of {len(new_lines)} line(s).")
+
+    cache_key = _source_cache_key(source_bytes)
+    line_starts = _line_starts(lexed)
+    function_map = find_function_bodies(_join_line_tokens(lexed))
+    new_map, changed = code_map.reload(function_map, cache_key=cache_key, line_starts=line_starts)
+    if not os.path.exists(_parse_cache_path(cache_key)):
+        _write_parse_cache(cache_key, function_map, {}, {}, line_starts)
+    return new_map, lexed, changed
+
+
+# --- 7.3. ПРОЕКТ З КІЛЬКОХ ФАЙЛІВ (ГЛОБАЛЬНИЙ ІНДЕКС ФУНКЦІЙ) ---
+
+PROJECT_SOURCE_EXTENSIONS = (".c",)
+PROJECT_PARALLEL_MIN_FILES = 4  # Менше файлів - індексуємо послідовно
+FUNCTION_MENU_MAX_ITEMS = 200  # Скільки знайдених функцій показувати у меню вибору
+
+
+def find_project_sources(directory):
+    """Усі C-файли каталогу (рекурсивно, без прихованих каталогів) у стабільному порядку."""
+    sources = []
+    for current, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        sources.extend(os.path.join(current, name) for name in sorted(files)
+                       if name.endswith(PROJECT_SOURCE_EXTENSIONS))
+    return sources
+
+
+def _index_source_file(file_path):
+    """
+    (Виконується у воркері) Лексує файл і знаходить його функції (через
+    load_c_source - заодно заповнює дисковий кеш для подальшого відкриття).
+    Повертає (file_path, [{"name", "start_line", "end_line", "body_hash"}], помилка або None);
+    тіла функцій у процес GUI не передаються.
+    """
+    try:
+        code_map = load_c_source(file_path)
+    except (OSError, UnicodeDecodeError) as e:
+        return file_path, [], str(e)
+    entries = []
+    for func_name in code_map:
+        span = code_map.source_span(func_name)
+        if span is None:
+            continue  # (Резервна "main" з усього файлу - у файлі немає визначень функцій)
+        entries.append({"name": func_name, "start_line": span[0], "end_line": span[1],
+                        "body_hash": code_map.body_hash(func_name)})
+    return file_path, entries, None
+
+
+class ProjectCodeMap(Mapping):
+    """
+    Функції всіх файлів проекту: {ключ: псевдокод}, як LazyFunctionCodeMap,
+    але файл завантажується (з дискового кешу) лише при першому зверненні
+    до його функції. Індекс (ім'я -> файл, рядки, хеш тіла) - у пам'яті.
+
+    Ключ - ім'я функції; якщо ім'я вже зайняте функцією з попереднього
+    файлу (static-функції з однаковими іменами) - "ім'я [відносний шлях]".
+    """
+
+    def __init__(self, root, results):
+        self.root = root
+        self._locations = {}  # {ключ: {"file", "name", "start_line", "end_line", "body_hash"}}
+        self._files = {}  # {шлях: LazyFunctionCodeMap} - лише завантажені файли
+        self.errors = {}  # {шлях: помилка читання}
+        self.file_count = len(results)
+        for file_path, entries, error in results:
+            if error is not None:
+                self.errors[file_path] = error
+            for entry in entries:
+                key = entry["name"]
+                if key in self._locations:
+                    key = f"{entry['name']} [{self.relative_path(file_path)}]"
+                self._locations[key] = dict(entry, file=file_path)
+
+    def __getitem__(self, key):
+        location = self._locations[key]  # (KeyError для невідомих функцій)
+        return self._file_map(location["file"])[location["name"]]
+
+    def __contains__(self, key):
+        return key in self._locations
+
+    def __iter__(self):
+        return iter(self._locations)
+
+    def __len__(self):
+        return len(self._locations)
+
+    def _file_map(self, file_path):
+        if file_path not in self._files:
+            self._files[file_path] = load_c_source(file_path)
+        return self._files[file_path]
+
+    def relative_path(self, file_path):
+        return os.path.relpath(file_path, self.root)
+
+    def location(self, key):
+        """{"file", "name", "start_line", "end_line", "body_hash"} функції (без завантаження файлу)."""
+        return self._locations[key]
+
+    def label(self, key):
+        location = self._locations[key]
+        return f"{location['name']}  ({self.relative_path(location['file'])}:{location['start_line']})"
+
+    def diagnostics(self, key):
+        location = self._locations[key]
+        return self._file_map(location["file"]).diagnostics(location["name"])
+
+    def body_hash(self, key):
+        return self._locations[key]["body_hash"]
+
+    def search(self, text, limit=FUNCTION_MENU_MAX_ITEMS):
+        """
+        Ключі функцій, ім'я (або файл) яких містить text (без урахування регістру):
+        спершу точні збіги, потім за початком імені, потім решта; не більше limit.
+        """
+        text = text.strip().lower()
+        if not text:
+            return list(self._locations)[:limit]
+        ranked = []
+        for key, location in self._locations.items():
+            name = location["name"].lower()
+            if text in name:
+                ranked.append((0 if name == text else 1 if name.startswith(text) else 2, key))
+            elif text in self.relative_path(location["file"]).lower():
+                ranked.append((3, key))
+        ranked.sort(key=lambda pair: pair[0])  # (Стабільне: у межах рангу - порядок файлів)
+        return [key for _, key in ranked[:limit]]
+
+    def loaded_files(self):
+        return dict(self._files)
+
+    def save_cache(self):
+        """Записує розпарсені за сесію тіла завантажених файлів у дисковий кеш."""
+        for code_map in self._files.values():
+            code_map.save_cache()
+
+
+@PERF.timed("index_project")
+def index_project(directory, max_workers=None):
+    """
+    Індексує всі C-файли каталогу: лексування та пошук функцій - паралельно
+    у пулі процесів (по файлу на завдання). Повертає ProjectCodeMap.
+    """
+    sources = find_project_sources(directory)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if max_workers <= 1 or len(sources) < PROJECT_PARALLEL_MIN_FILES:
+        results = [_index_source_file(file_path) for file_path in sources]
+    else:
+        # 'spawn' - як у parse_all_functions; (map зберігає порядок файлів)
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(sources)),
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = list(executor.map(_index_source_file, sources))
+    return ProjectCodeMap(directory, results)
+
+
 # =======================================================
 # --- 8. ЛОГІКА ПРИВ'ЯЗКИ ТА ОНОВЛЕННЯ СТРІЛОК ---
 # =======================================================
 
 
-def _update_arrow_mapping(arrow_id, source_tag=None, target_tag=None):
+def _update_arrow_mapping(ctx, arrow_id, source=None, target=None):
     """
-    Оновлює глобальні словники ARROW_CONNECTIONS та BLOCK_TO_ARROWS.
+    Оновлює зв'язки стрілки (ctx.arrow_connections) та списки стрілок
+    блоків у реєстрі (BlockRecord.edges).
     Це "мозок", що керує зв'язками стрілок та блоків.
 
-    source_tag/target_tag = None: Не змінювати.
-    source_tag/target_tag = False: Розірвати зв'язок (від'єднати).
-    source_tag/target_tag = 'tag': Встановити/змінити зв'язок.
+    source/target = None: Не змінювати.
+    source/target = False: Розірвати зв'язок (від'єднати).
+    source/target = block_id: Встановити/змінити зв'язок.
     """
-    global ARROW_CONNECTIONS
-    global BLOCK_TO_ARROWS
+    arrow_connections = ctx.arrow_connections
 
     arrow_id_int = int(arrow_id)
 
     # 1. Отримуємо поточні (старі) зв'язки для цієї стрілки
-    if arrow_id_int not in ARROW_CONNECTIONS:
-        ARROW_CONNECTIONS[arrow_id_int] = {'source_tag': None, 'target_tag': None}
-    old_source_tag = ARROW_CONNECTIONS[arrow_id_int].get('source_tag')
-    old_target_tag = ARROW_CONNECTIONS[arrow_id_int].get('target_tag')
+    if arrow_id_int not in arrow_connections:
+        arrow_connections[arrow_id_int] = {'source': None, 'target': None}
+    conn = arrow_connections[arrow_id_int]
+    old_source = conn['source']
+    old_target = conn['target']
 
     # 2. Визначаємо нові зв'язки на основі вхідних параметрів
-    new_source_tag = old_source_tag
-    new_target_tag = old_target_tag
+    new_source = old_source
+    new_target = old_target
+
+    if source is not None:
+        new_source = source if source is not False else None
+    if target is not None:
+        new_target = target if target is not False else None
+
+    # 3. Оновлюємо головний словник (arrow_connections)
+    conn['source'] = new_source
+    conn['target'] = new_target
+
+    # 4. Видаляємо стрілку зі старих блоків (якщо вона більше не приєднана до них)
+    for old_block_id in (old_source, old_target):
+        if old_block_id is not None and old_block_id not in (new_source, new_target) \
+                and old_block_id in ctx.blocks:
+            ctx.blocks[old_block_id].edges.discard(arrow_id_int)
 
-    if source_tag is not None:
-        new_source_tag = source_tag if source_tag is not False else None
-    if target_tag is not None:
-        new_target_tag = target_tag if target_tag is not False else None
+    # 5. Додаємо стрілку до нових блоків
+    for new_block_id in (new_source, new_target):
+        if new_block_id is not None and new_block_id in ctx.blocks:
+            ctx.blocks[new_block_id].edges.add(arrow_id_int)
 
-    # 3. Оновлюємо головний словник (ARROW_CONNECTIONS)
-    ARROW_CONNECTIONS[arrow_id_int]['source_tag'] = new_source_tag
-    ARROW_CONNECTIONS[arrow_id_int]['target_tag'] = new_target_tag
 
-    # 4. Оновлюємо зворотний словник (BLOCK_TO_ARROWS)
+def _snap_to_closest_block_point(ctx, x, y):
+    """
+    Шукає найближчий порт блоку у радіусі PORT_SNAPPING_TOLERANCE
+    (порти рахуються з меж блоків у GeometryStore).
+
+    Повертає: (координати_порту, ID_блоку, тип_об'єкта)
+    """
+    snapped, owners = ctx.geometry.nearest_ports([(x, y)], PORT_SNAPPING_TOLERANCE)
+    if owners[0] >= 0:
+        # Повертаємо центр порту та ID блоку
+        return tuple(snapped[0].tolist()), int(owners[0]), "port"
+
+    # Якщо нічого не знайдено, повертаємо вихідні координати
+    return (x, y), None, None
 
-    # 4.1. Видаляємо старий Source (якщо він змінився або був розірваний)
-    if old_source_tag and old_source_tag != new_source_tag and \
-            old_source_tag in BLOCK_TO_ARROWS and \
-            arrow_id_int in BLOCK_TO_ARROWS[old_source_tag]:
 
-        BLOCK_TO_ARROWS[old_source_tag].remove(arrow_id_int)
-        if not BLOCK_TO_ARROWS[old_source_tag]:
-            del BLOCK_TO_ARROWS[old_source_tag]
+def _auto_snap_all_arrows(ctx):
+    """
+    Викликається після першого малювання.
+    "Приклеює" кінці всіх стрілок до найближчих портів блоків
+    (пошук портів - одним векторним запитом для всіх кінців).
+    """
+    canvas = ctx.canvas
+    geometry = ctx.geometry
+    edge_count = len(geometry.edge_ids)
+    if not edge_count:
+        return
 
-    # 4.2. Видаляємо старий Target (якщо він змінився або був розірваний)
-    if old_target_tag and old_target_tag != new_target_tag and \
-            old_target_tag in BLOCK_TO_ARROWS and \
-            arrow_id_int in BLOCK_TO_ARROWS[old_target_tag]:
+    # 1. Прив'язка початків (Source) та кінців (Target) усіх стрілок
+    starts, ends = geometry.edge_endpoints()
+    snapped, owners = geometry.nearest_ports(np.concatenate((starts, ends)), PORT_SNAPPING_TOLERANCE)
 
-        BLOCK_TO_ARROWS[old_target_tag].remove(arrow_id_int)
-        if not BLOCK_TO_ARROWS[old_target_tag]:
-            del BLOCK_TO_ARROWS[old_target_tag]
+    for index, arrow_id in enumerate(geometry.edge_ids):
+        source_id = int(owners[index])
+        target_id = int(owners[edge_count + index])
+        if source_id < 0 and target_id < 0:
+            continue
 
-    # 5. Додаємо нові зв'язки у зворотний словник
-    if new_source_tag:
-        if new_source_tag not in BLOCK_TO_ARROWS:
-            BLOCK_TO_ARROWS[new_source_tag] = []
-        if arrow_id_int not in BLOCK_TO_ARROWS[new_source_tag]:
-            BLOCK_TO_ARROWS[new_source_tag].append(arrow_id_int)
+        # 2. Оновлення координат стрілки у сховищі та на полотні
+        points = geometry.edge_points(arrow_id)
+        if source_id >= 0:
+            points[0] = snapped[index]
+        if target_id >= 0:
+            points[-1] = snapped[edge_count + index]
+        canvas.coords(arrow_id, *points.ravel().tolist())
 
-    if new_target_tag:
-        if new_target_tag not in BLOCK_TO_ARROWS:
-            BLOCK_TO_ARROWS[new_target_tag] = []
-        if arrow_id_int not in BLOCK_TO_ARROWS[new_target_tag]:
-            BLOCK_TO_ARROWS[new_target_tag].append(arrow_id_int)
+        # 3. Оновлення логіки зв'язків
+        _update_arrow_mapping(ctx, arrow_id,
+                              source=source_id if source_id >= 0 else None,
+                              target=target_id if target_id >= 0 else None)
 
 
-def _snap_to_closest_block_point(canvas, x, y):
+def _move_block_with_arrows(ctx, block_id, dx, dy):
+    """
+    Переміщує блок (усі його елементи з реєстру) та точки приєднаних до нього стрілок.
     """
-    Шукає найближчий невидимий порт ("block_port") у радіусі 'tolerance'.
+    canvas = ctx.canvas
+    geometry = ctx.geometry
+    block = ctx.blocks[block_id]
+    for item_id in block.items:
+        canvas.move(item_id, dx, dy)
+    geometry.translate_block(block_id, dx, dy)
+
+    # Ручне переміщення *приєднаних* до блоку стрілок
+    for arrow_id in block.edges:
+        conn = ctx.arrow_connections.get(arrow_id, {})
+        is_source = (conn.get('source') == block_id)
+        is_target = (conn.get('target') == block_id)
+        if not (is_source or is_target):
+            continue
+
+        points = geometry.edge_points(arrow_id)
+        # (Проміжні точки рухаються, якщо хоча б один кінець приєднаний)
+        points[1:-1] += (dx, dy)
+        # Кінці рухаються, лише якщо прив'язані до *цього* блоку
+        # (інший кінець, приєднаний до іншого блоку, не рухається)
+        if is_source:
+            points[0] += (dx, dy)
+        if is_target:
+            points[-1] += (dx, dy)
+        canvas.coords(arrow_id, *points.ravel().tolist())
+
 
-    Повертає: (координати_порту, тег_групи_блоку, тип_об'єкта)
+def _collect_block_positions(ctx):
     """
-    tolerance = PORT_SNAPPING_TOLERANCE
+    Знімає позиції центрів усіх блоків з реєстру.
 
-    # Шукаємо об'єкти в квадраті навколо (x, y)
-    overlapping = canvas.find_overlapping(
-        x - tolerance, y - tolerance,
-        x + tolerance, y + tolerance
-    )
+    Ідентичність блоку (що не залежить від розкладки): (тип, текст, порядковий
+    номер серед блоків з тим самим типом і текстом).
+    Повертає {ідентичність: (block_id, center_x, center_y)} (світові координати).
+    """
+    positions = {}
+    seen = {}
+    for block in ctx.blocks.values():
+        if not block.rect:
+            continue
+        base_identity = (block.kind, block.text)
+        ordinal = seen.get(base_identity, 0)
+        seen[base_identity] = ordinal + 1
+        center_x, center_y = block.center()
+        positions[base_identity + (ordinal,)] = (block.block_id, center_x + ctx.origin_x, center_y + ctx.origin_y)
+    return positions
 
-    closest_port_obj_id = None
-    min_distance = float('inf')
 
-    # Шукаємо серед знайдених *тільки* порти
-    for obj_id in reversed(overlapping):
-        tags = canvas.gettags(obj_id)
-        if "block_port" in tags:
-            coords = canvas.coords(obj_id)
-            if len(coords) != 4: continue
+# --- 8.1. КЕШ СЦЕН (LRU) ---
 
-            # Центр порту
-            port_x = (coords[0] + coords[2]) / 2
-            port_y = (coords[1] + coords[3]) / 2
+def _hash_code_list(code_list):
+    """Повертає стабільний хеш тіла функції (списку рядків псевдокоду)."""
+    return hashlib.blake2b("\n".join(code_list).encode("utf-8"), digest_size=16).hexdigest()
 
-            distance = ((x - port_x) ** 2 + (y - port_y) ** 2) ** 0.5
 
-            if distance < min_distance:
-                min_distance = distance
-                closest_port_obj_id = obj_id
+def _scene_links(ctx, index_of):
+    """
+    Реєстр блоків, стрілки та їх зв'язки у форматі сцени: елементи полотна
+    вказуються індексом у списку items сцени (index_of), а не ID полотна.
+    """
+    blocks = [(block.block_id, block.kind, block.text, block.rect,
+               bool(ctx.geometry.four_ports[block.block_id]), [index_of[i] for i in block.items])
+              for block in ctx.blocks.values()]
+    edges = [index_of[arrow_id] for arrow_id in ctx.geometry.edge_ids if arrow_id in index_of]
+    connections = {}
+    for arrow_id, conn in ctx.arrow_connections.items():
+        if arrow_id in index_of:
+            connections[index_of[arrow_id]] = (conn['source'], conn['target'])
+    return blocks, edges, connections
 
-    if closest_port_obj_id:
-        # Знайшли порт. Тепер треба знайти тег його "батьківського" блоку.
-        port_tags = canvas.gettags(closest_port_obj_id)
-        group_tag = next(
-            (tag for tag in port_tags if tag.startswith(("sub_", "rect_", "rhombus_", "ell_", "para_", "hex_"))),
-            None)
 
-        if group_tag:
-            # Повертаємо центр порту та тег блоку
-            port_coords = canvas.coords(closest_port_obj_id)
-            px = (port_coords[0] + port_coords[2]) / 2
-            py = (port_coords[1] + port_coords[3]) / 2
+def _full_scene_cache_key(ctx, cache_key, code_list, page=None, page_height=PAGE_HEIGHT_DEFAULT):
+    """Ключ кешу сцен з урахуванням згорнутих вузлів функції та сторінки (вони теж визначають сцену)."""
+    return cache_key + (frozenset(ctx.collapsed.get(_hash_code_list(code_list), ())),
+                        page, page_height if page is not None else None)
 
-            return (px, py), group_tag, "port"
 
-    # Якщо нічого не знайдено, повертаємо вихідні координати
-    return (x, y), None, None
+def _scene_cache_get(cache_key):
+    """Повертає сцену з кешу (і позначає її як нещодавно використану) або None."""
+    scene = SCENE_CACHE.get(cache_key)
+    if scene is not None:
+        SCENE_CACHE.move_to_end(cache_key)
+    PERF.count("scene_cache_hits" if scene is not None else "scene_cache_misses")
+    return scene
 
 
-def _auto_snap_all_arrows(canvas):
+def _scene_cache_put(cache_key, scene):
     """
-    Викликається після першого малювання.
-    Пробігає по всіх стрілках і автоматично "приклеює" їхні кінці
-    до найближчих портів блоків.
+    Додає сцену до кешу. Найстаріші сцени витісняються, поки сумарна
+    кількість елементів не вкладеться у SCENE_CACHE_MAX_ITEMS.
     """
-    all_arrows = canvas.find_withtag("flow_arrow")
+    SCENE_CACHE[cache_key] = scene
+    SCENE_CACHE.move_to_end(cache_key)
 
-    for arrow_id_str in all_arrows:
-        try:
-            arrow_id = int(arrow_id_str)
-        except ValueError:
-            continue
+    total_items = sum(len(s["items"]) for s in SCENE_CACHE.values())
+    while total_items > SCENE_CACHE_MAX_ITEMS and len(SCENE_CACHE) > 1:
+        _, evicted = SCENE_CACHE.popitem(last=False)
+        total_items -= len(evicted["items"])
 
-        coords = list(canvas.coords(arrow_id))
-        if len(coords) < 4: continue
 
-        x_start, y_start = coords[0], coords[1]
-        x_end, y_end = coords[-2], coords[-1]
+# --- 8.2. ЗАПИС СЦЕНИ ТА ПОСТУПОВИЙ РЕНДЕРИНГ ---
+
+def _flatten_coords(coords):
+    """Координати у будь-якій формі tk.Canvas ((x, y), [(x, y), ...], x, y, ...) -> плоский список."""
+    flat = []
+    for value in coords:
+        if isinstance(value, (list, tuple)):
+            for point in value:
+                if isinstance(point, (list, tuple)):
+                    flat.extend(point)
+                else:
+                    flat.append(point)
+        else:
+            flat.append(value)
+    return [float(v) for v in flat]
+
 
-        new_coords = list(coords)
-        source_tag = None
-        target_tag = None
+class SceneRecorder:
+    """
+    Замінник полотна на час розкладки: приймає ті самі виклики tk.Canvas, що й
+    примітиви малювання, але лише записує елементи (тип, координати, опції).
+    Справжні елементи потім створює SceneRenderer - одразу або частинами.
 
-        # 1. Прив'язка початку (Source)
-        snap_point_s, block_tag_s, _ = _snap_to_closest_block_point(canvas, x_start, y_start)
-        if block_tag_s:
-            new_coords[0], new_coords[1] = snap_point_s
-            source_tag = block_tag_s
+    Висоту перенесеного тексту знає лише Tk, тому bbox() тексту вимірюється
+    одним допоміжним невидимим текстовим елементом справжнього полотна.
+    """
 
-        # 2. Прив'язка кінця (Target)
-        snap_point_t, block_tag_t, _ = _snap_to_closest_block_point(canvas, x_end, y_end)
-        if block_tag_t:
-            new_coords[-2], new_coords[-1] = snap_point_t
-            target_tag = block_tag_t
+    def __init__(self, canvas):
+        self.canvas = canvas  # Справжнє полотно (для вимірювання тексту)
+        self.types = []
+        self.coords_list = []
+        self.options = []
+        self.z_order = []  # Порядок накладання кожного елемента (більше - вище)
+        self._z_counter = 0
+        self._measure_id = None
+
+    def _next_z(self):
+        self._z_counter += 1
+        return self._z_counter
+
+    def _create(self, item_type, coords, options):
+        self.types.append(item_type)
+        self.coords_list.append(_flatten_coords(coords))
+        self.options.append(options)
+        self.z_order.append(self._next_z())
+        return len(self.types)  # ID елемента = номер запису (з 1, як у Tk)
+
+    def create_line(self, *coords, **options):
+        return self._create("line", coords, options)
+
+    def create_oval(self, *coords, **options):
+        return self._create("oval", coords, options)
+
+    def create_polygon(self, *coords, **options):
+        return self._create("polygon", coords, options)
+
+    def create_rectangle(self, *coords, **options):
+        return self._create("rectangle", coords, options)
+
+    def create_text(self, *coords, **options):
+        return self._create("text", coords, options)
+
+    def coords(self, item_id, *coords):
+        if coords:
+            self.coords_list[item_id - 1] = _flatten_coords(coords)
+            return None
+        return list(self.coords_list[item_id - 1])
+
+    def itemconfigure(self, item_id, **options):
+        self.options[item_id - 1].update(options)
+
+    itemconfig = itemconfigure
+
+    def gettags(self, item_id):
+        tags = self.options[item_id - 1].get("tags", ())
+        return tuple(tags.split()) if isinstance(tags, str) else tuple(tags)
+
+    def tag_raise(self, item_id):
+        self.z_order[item_id - 1] = self._next_z()
+
+    def bbox(self, item_id):
+        index = item_id - 1
+        coords = self.coords_list[index]
+        if self.types[index] != "text":
+            return min(coords[0::2]), min(coords[1::2]), max(coords[0::2]), max(coords[1::2])
+
+        if self._measure_id is None:
+            self._measure_id = self.canvas.create_text(0, 0, fill="")
+        options = self.options[index]
+        self.canvas.coords(self._measure_id, *coords)
+        self.canvas.itemconfigure(self._measure_id, text=options.get("text", ""),
+                                  font=options.get("font", "TkDefaultFont"),
+                                  width=options.get("width", 0), anchor=options.get("anchor", "center"))
+        return self.canvas.bbox(self._measure_id)
+
+    def close(self):
+        """Видаляє допоміжний елемент вимірювання з полотна."""
+        if self._measure_id is not None:
+            self.canvas.delete(self._measure_id)
+            self._measure_id = None
+
+    def scene(self, ctx):
+        """Сцена (формат кешу сцен) із записаних елементів та реєстру контексту."""
+        order = sorted(range(len(self.types)), key=self.z_order.__getitem__)
+        items = [(self.types[i], tuple(self.coords_list[i]), self.options[i]) for i in order]
+        index_of = {i + 1: position for position, i in enumerate(order)}
+        blocks, edges, connections = _scene_links(ctx, index_of)
+        return {"items": items, "blocks": blocks, "edges": edges, "connections": connections,
+                "bounds": ctx.geometry.bounds(), "block_nodes": dict(ctx.block_nodes),
+                "block_lines": dict(ctx.block_lines)}
+
+
+def _record_flowchart_scene(ctx, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors,
+                            skip_init, page=None, page_height=PAGE_HEIGHT_DEFAULT):
+    """
+    Вимірює та "малює" дерево конструкцій (без тіл згорнутих вузлів) у
+    SceneRecorder, приклеює стрілки до портів і повертає готову сцену.
+    Полотно не змінюється.
 
-        # 3. Оновлення координат стрілки на полотні
-        if new_coords != coords:
-            canvas.coords(arrow_id, *new_coords)
+    page - номер сторінки (з 0, див. _flow_pages): записується лише вона,
+    з власною розкладкою та міжсторінковими з'єднувачами.
+    """
+    flow_tree = _flow_tree_for(ctx, code_list, skip_init)["nodes"]
+    if page is not None:
+        pages = _flow_pages(ctx, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor, skip_init,
+                            page_height)
+        flow_tree = _page_sequence(flow_tree, pages, min(page, len(pages) - 1))
+    return _record_flow_nodes_scene(ctx, flow_tree, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors)
+
+
+def _record_flow_nodes_scene(ctx, flow_tree, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors):
+    """Записує сцену готової послідовності вузлів дерева (див. _record_flowchart_scene)."""
+    recorder = SceneRecorder(ctx.canvas)
+    ctx.canvas = recorder
+    try:
+        with PERF.span("layout"):
+            left_extent, _ = layout_flow_tree(ctx, flow_tree, h_scale, v_scale, loop_offset_factor,
+                                              if_offset_factor)
+        # (Вісь - так, щоб найлівіша гілка/лінія циклу не виходила за початок полотна)
+        x_center = max(X_CENTER_DEFAULT, left_extent + 2 * GRID_SIZE)
+        with PERF.span("draw"):
+            draw_flow_tree(ctx, flow_tree, Y_START, x_center, h_scale, v_scale, colors)
+        with PERF.span("_auto_snap_all_arrows"):
+            _auto_snap_all_arrows(ctx)
+    finally:
+        ctx.canvas = recorder.canvas
+        recorder.close()
+    return recorder.scene(ctx)
 
-        # 4. Оновлення логіки зв'язків
-        if source_tag or target_tag:
-            _update_arrow_mapping(arrow_id, source_tag=source_tag, target_tag=target_tag)
 
+# Індекс кольору (у кортежі colors) для фігури блоку кожного типу
+_SCENE_FILL_INDEX = {"ell": 0, "rect": 1, "rhombus": 2, "sub": 3, "para": 3, "hex": 4, "fold": 2}
 
-def draw_flowchart_with_offset(canvas, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors,
-                               skip_init, is_grid_visible):
+
+def _scene_fill_overrides(scene, colors):
+    """{індекс фігури блоку: колір} - кольори не входять до ключа кешу сцен."""
+    return {item_indexes[0]: colors[_SCENE_FILL_INDEX[kind]]
+            for _, kind, _, _, _, item_indexes in scene["blocks"]
+            if item_indexes and kind in _SCENE_FILL_INDEX}
+
+
+def _scene_units(scene, viewport=None):
     """
-    Головна "обгортка" для малювання.
+    Розбиває сцену на одиниці рендерингу: блок (усі його елементи) або окремий
+    елемент (стрілка, підпис). Без viewport - у порядку накладання, інакше -
+    від найближчих до центру видимої області (x0, y0, x1, y1).
 
-    1. Очищує полотно та глобальні словники.
-    2. Викликає рекурсивне малювання.
-    3. Викликає автоматичне "прилипання" стрілок.
-    4. Динамічно налаштовує розмір сітки та scrollregion.
+    Повертає список (індекси_елементів, запис_блоку_сцени або None).
     """
-    canvas.delete("all")
+    items = scene["items"]
+    owned = set()
+    first_of_block = {}
+    for entry in scene["blocks"]:
+        if entry[5]:
+            owned.update(entry[5])
+            first_of_block[min(entry[5])] = entry
+
+    keyed_units = []
+    for index in range(len(items)):
+        entry = first_of_block.get(index)
+        if entry is not None:
+            x0, y0, x1, y1 = entry[3]
+            keyed_units.append(((x0 + x1) / 2, (y0 + y1) / 2, index, (sorted(entry[5]), entry)))
+        elif index not in owned:
+            coords = items[index][1]
+            center_x = (min(coords[0::2]) + max(coords[0::2])) / 2
+            center_y = (min(coords[1::2]) + max(coords[1::2])) / 2
+            keyed_units.append((center_x, center_y, index, ([index], None)))
+
+    if viewport is not None:
+        view_x = (viewport[0] + viewport[2]) / 2
+        view_y = (viewport[1] + viewport[3]) / 2
+        # (При рівній відстані - порядок накладання)
+        keyed_units.sort(key=lambda unit: ((unit[0] - view_x) ** 2 + (unit[1] - view_y) ** 2, unit[2]))
+    return [unit[3] for unit in keyed_units]
+
+
+class SceneRenderer:
+    """
+    Створює елементи сцени на полотні та відновлює для них реєстр блоків
+    (з тими самими ID), геометрію та зв'язки стрілок.
 
-    # --- КРОК 1: Скидання стану ---
-    global ARROW_CONNECTIONS
-    global BLOCK_TO_ARROWS
-    global BLOCK_TEXT_MAP
-    global BLOCK_ID_COUNTER
+    run() - усе одразу. start() - частинами з обмеженням часу на частину
+    (RENDER_CHUNK_BUDGET_MS) через canvas.after, від блоків, найближчих до
+    видимої області; між частинами вікно обробляє події. Незавершений
+    рендеринг зберігається у ctx.render_job і скасовується cancel().
+    """
 
-    ARROW_CONNECTIONS.clear()
-    BLOCK_TO_ARROWS.clear()
-    BLOCK_TEXT_MAP.clear()
-    BLOCK_ID_COUNTER = 0
+    def __init__(self, ctx, scene, colors=None, viewport=None, on_progress=None, on_complete=None):
+        self.ctx = ctx
+        self.scene = scene
+        self.units = _scene_units(scene, viewport)
+        self.position = 0  # Наступна одиниця рендерингу
+        self.created_items = 0
+        self.total_items = len(scene["items"])
+        self.fills = _scene_fill_overrides(scene, colors) if colors else {}
+        self.edge_indexes = set(scene["edges"])
+        self.scale_factor = 1.0  # Зум, застосований до вже створених елементів під час рендерингу
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.job = None
+
+        # Межі блоків відомі одразу - реєструємо блоки до появи їхніх елементів
+        # (сцена - у світових координатах, полотно - зі зсувом на початок координат)
+        for block_id, kind, text, (x0, y0, x1, y1), four_ports, _ in scene["blocks"]:
+            block = ctx.new_block(kind, text, block_id=block_id)
+            ctx.register_block_items(block, (x0 - ctx.origin_x, y0 - ctx.origin_y, x1 - ctx.origin_x,
+                                             y1 - ctx.origin_y), [], four_ports)
+        ctx.block_nodes.update(scene["block_nodes"])
+        ctx.block_lines.update(scene["block_lines"])
+
+    def set_colors(self, colors):
+        """Нові кольори для блоків, які ще не створені."""
+        self.fills = _scene_fill_overrides(self.scene, colors)
+
+    def scale(self, factor):
+        """Зум під час рендерингу: ще не створені елементи масштабуються так само (початок координат - у ctx)."""
+        self.scale_factor *= factor
+
+    def _render_unit(self, unit):
+        ctx = self.ctx
+        canvas = ctx.canvas
+        items = self.scene["items"]
+        indexes, block_entry = unit
+        created = {}
+        # Світові координати (з урахуванням зуму під час рендерингу) -> координати полотна
+        origin = (ctx.origin_x, ctx.origin_y)
+        for index in indexes:
+            item_type, coords, options = items[index]
+            coords = [value * self.scale_factor - origin[i % 2] for i, value in enumerate(coords)]
+            fill = self.fills.get(index)
+            if fill is not None:
+                options = dict(options, fill=fill)
+            item_id = getattr(canvas, f"create_{item_type}")(*coords, **options)
+            created[index] = item_id
+
+            if index in self.edge_indexes:
+                ctx.geometry.add_edge(item_id, coords)
+            connection = self.scene["connections"].get(index)
+            if connection is not None:
+                source, target = connection
+                _update_arrow_mapping(ctx, item_id,
+                                      source=False if source is None else source,
+                                      target=False if target is None else target)
+
+        if block_entry is not None:
+            block = ctx.blocks[block_entry[0]]
+            ctx.register_block_items(block, block.rect, [created[i] for i in block_entry[5]], block_entry[4])
+        self.created_items += len(indexes)
+        PERF.count("tk_items", len(indexes))
+
+    def run(self):
+        """Створює всі (решту) елементів одразу."""
+        with PERF.span("render"):
+            while self.position < len(self.units):
+                self._render_unit(self.units[self.position])
+                self.position += 1
+        self._complete()
+
+    def start(self):
+        """Запускає рендеринг частинами (перша частина - одразу)."""
+        self.ctx.render_job = self
+        self._step()
+
+    def _step(self):
+        self.job = None
+        with PERF.span("render"):
+            deadline = time.perf_counter() + RENDER_CHUNK_BUDGET_MS / 1000
+            while self.position < len(self.units):
+                self._render_unit(self.units[self.position])
+                self.position += 1
+                if time.perf_counter() >= deadline:
+                    break
+
+        if self.position < len(self.units):
+            if self.on_progress is not None:
+                self.on_progress(self.created_items, self.total_items)
+            self.job = self.ctx.canvas.after(RENDER_CHUNK_DELAY_MS, self._step)
+        else:
+            self._complete()
 
-    # Початковий (великий) розмір полотна
-    EXTENDED_SIZE_INITIAL = 2000
-    canvas.config(scrollregion=(0, 0, EXTENDED_SIZE_INITIAL, EXTENDED_SIZE_INITIAL))
+    def cancel(self):
+        """Зупиняє рендеринг (створені елементи залишаються на полотні)."""
+        if self.job is not None:
+            self.ctx.canvas.after_cancel(self.job)
+            self.job = None
+        if self.ctx.render_job is self:
+            self.ctx.render_job = None
 
-    # --- КРОК 2: Рекурсивне малювання ---
-    _draw_flowchart_recursive(canvas, code_list, Y_START, EXTENDED_SIZE_INITIAL / 2, h_scale, v_scale,
-                              loop_offset_factor,
-                              if_offset_factor, colors, skip_init, nesting_level=0)
+    def finish(self):
+        """Домальовує решту сцени одразу (наприклад, перед експортом)."""
+        self.cancel()
+        self.run()
+
+    def _complete(self):
+        if self.ctx.render_job is self:
+            self.ctx.render_job = None
+        if self.on_complete is not None:
+            self.on_complete()
 
-    canvas.update_idletasks()
 
-    # --- КРОК 3: Автоматична прив'язка стрілок ---
-    _auto_snap_all_arrows(canvas)
+def _cancel_scene_render(ctx):
+    """Скасовує незавершений поступовий рендеринг контексту (якщо є)."""
+    if ctx.render_job is not None:
+        ctx.render_job.cancel()
 
-    # --- КРОК 4: Налаштування ScrollRegion та Сітки ---
 
-    # Знаходимо межі *тільки* блоків та стрілок (ігноруючи сітку)
-    content_items = canvas.find_withtag("block") + canvas.find_withtag("flow_arrow")
-    actual_bbox = canvas.bbox(*content_items) if content_items else None
+def _finish_scene_render(ctx):
+    """Домальовує незавершений поступовий рендеринг (якщо є) - для експорту."""
+    if ctx.render_job is not None:
+        ctx.render_job.finish()
+
+
+@PERF.timed("draw_flowchart_with_offset")
+def draw_flowchart_with_offset(ctx, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors,
+                               skip_init, is_grid_visible, cache_key=None, on_progress=None, on_complete=None,
+                               page=None, page_height=PAGE_HEIGHT_DEFAULT, diff_with=None):
+    """
+    Головна "обгортка" для малювання.
+
+    1. Скасовує незавершений рендеринг, очищує полотно та стан сцени у контексті.
+    2. Записує сцену: будує та вимірює дерево конструкцій, "малює" його
+       у SceneRecorder і приклеює стрілки (або бере сцену з кешу за cache_key).
+    3. Налаштовує scrollregion за межами сцени (без обмеження розміру: сцена
+       у світових координатах, полотно - зі зсувом на ctx.origin_x/origin_y)
+       та сітку у вікні навколо початку координат.
+    4. Створює елементи полотна: одразу, а для великих сцен
+       (PROGRESSIVE_RENDER_MIN_ITEMS) - частинами через canvas.after,
+       від найближчих до видимої області.
+
+    on_progress(створено, всього) викликається після кожної частини,
+    on_complete() - коли сцена намальована повністю.
+
+    page - номер сторінки (з 0) у режимі сторінок (див. _flow_pages)
+    або None - уся схема.
+
+    diff_with - псевдокод попередньої версії функції: малюється об'єднана
+    схема обох версій з виділеними змінами (див. structural_diff), page
+    тоді ігнорується.
+
+    Повертає сцену (з "diff" - лічильниками змін - у режимі порівняння).
+    """
+    canvas = ctx.canvas
+    _cancel_scene_render(ctx)
+    canvas.delete("all")
+
+    # --- КРОК 1: Скидання стану ---
+    ctx.reset_scene()
+
+    # --- КРОК 2: Сцена з кешу або запис нової (розкладка, малювання, прив'язка стрілок) ---
+    if diff_with is not None:
+        page = None
+    if cache_key is not None:
+        cache_key = _full_scene_cache_key(ctx, cache_key, code_list, page, page_height)
+        if diff_with is not None:
+            cache_key += ("diff", _hash_code_list(diff_with))
+    scene = _scene_cache_get(cache_key) if cache_key is not None else None
+    if scene is None:
+        if diff_with is not None:
+            scene = _record_diff_scene(ctx, diff_with, code_list, h_scale, v_scale, loop_offset_factor,
+                                       if_offset_factor, colors, skip_init)
+        else:
+            scene = _record_flowchart_scene(ctx, code_list, h_scale, v_scale, loop_offset_factor,
+                                            if_offset_factor, colors, skip_init, page, page_height)
+        ctx.reset_scene()
+        if cache_key is not None:
+            _scene_cache_put(cache_key, scene)
+
+    # --- КРОК 3: Налаштування ScrollRegion та Сітки ---
+
+    # Межі *тільки* блоків та стрілок (без сітки)
+    actual_bbox = scene["bounds"]
 
     if actual_bbox:
         x0, y0, x1, y1 = actual_bbox
@@ -1720,47 +3619,795 @@ def draw_flowchart_with_offset(canvas, code_list, h_scale, v_scale, loop_offset_
 
         max_x = max(MIN_SIZE, x1 + PADDING)
         max_y = max(MIN_SIZE, y1 + PADDING)
+        if page is not None and x1 - x0 > PAGE_WIDTH_DEFAULT:
+            print(f"Увага: сторінка ширша за {PAGE_WIDTH_DEFAULT} px ({x1 - x0:.0f} px) - зменшіть ширину або зсуви.")
 
-        # (Обмеження, щоб уникнути проблем з рендерингом Tkinter)
-        MAX_CANVAS_LIMIT = 8000
-        final_x = min(MAX_CANVAS_LIMIT, max_x)
-        final_y = min(MAX_CANVAS_LIMIT, max_y)
+        # 3.1. Встановлюємо scrollregion за розміром вмісту + відступи (у координатах полотна)
+        scroll_region = (x0 - PADDING - ctx.origin_x, y0 - PADDING - ctx.origin_y,
+                         max_x - ctx.origin_x, max_y - ctx.origin_y)
+        canvas.config(scrollregion=scroll_region)
 
-        # 4.1. Встановлюємо scrollregion за розміром вмісту + відступи
-        canvas.config(scrollregion=(
-            x0 - PADDING,
-            y0 - PADDING,
-            final_x,
-            final_y
-        ))
-
-        # 4.2. Малюємо сітку, що покриває всю область
-        draw_grid_lines(canvas, GRID_SIZE, int(max(final_x, final_y)), is_grid_visible)
+        # 3.2. Малюємо сітку у вікні навколо початку координат
+        draw_grid_lines(canvas, GRID_SIZE, 0, is_grid_visible, region=grid_region(scroll_region))
 
     else:
         # Полотно порожнє
         canvas.config(scrollregion=(0, 0, 800, 800))
         draw_grid_lines(canvas, GRID_SIZE, 800, is_grid_visible)
 
+    # --- КРОК 4: Створення елементів полотна ---
+    if len(scene["items"]) < PROGRESSIVE_RENDER_MIN_ITEMS:
+        SceneRenderer(ctx, scene, colors, on_complete=on_complete).run()
+    else:
+        view_x, view_y = canvas.canvasx(0) + ctx.origin_x, canvas.canvasy(0) + ctx.origin_y
+        viewport = (view_x, view_y, view_x + canvas.winfo_width(), view_y + canvas.winfo_height())
+        SceneRenderer(ctx, scene, colors, viewport, on_progress, on_complete).start()
+    return scene
+
+
+def _update_colors_only(canvas, colors):
+    """Швидко оновлює кольори існуючих блоків без перемальовування."""
+    (color_ellipse, color_rect, color_rhombus, color_sub, color_hex) = colors
+
+    # Використовуємо теги типів, присвоєні при малюванні
+    canvas.itemconfig("ellipse", fill=color_ellipse)
+    canvas.itemconfig("rect", fill=color_rect)
+    canvas.itemconfig("rhombus", fill=color_rhombus)
+    canvas.itemconfig("sub", fill=color_sub)
+    canvas.itemconfig("para", fill=color_sub)  # Паралелограми (Ввід/Вивід)
+    canvas.itemconfig("hex", fill=color_hex)
+    canvas.itemconfig("fold", fill=color_rhombus)  # Згорнуті конструкції
+
+
+# --- 8.3. ЗАПИС ТА ВІДТВОРЕННЯ ВЗАЄМОДІЇ (ЗАТРИМКИ ОБРОБНИКІВ) ---
+
+INTERACTION_FRAME_MS = 1000 / 60  # Тривалість кадру: довший простій циклу подій - пропущені кадри
+INTERACTION_RECORDER_TAG = "InteractionRecorder"  # Bindtag запису (не заважає прив'язкам вікна)
+INTERACTION_SETTLE_TIMEOUT_MS = 30000  # Макс. очікування завершення рендерингу після останньої події
+
+
+def _percentiles(values):
+    """{"count", "p50_ms", "p90_ms", "p99_ms", "max_ms"} для списку тривалостей, мс."""
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0}
+
+    def _rank(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {"count": len(ordered), "p50_ms": _rank(0.5), "p90_ms": _rank(0.9), "p99_ms": _rank(0.99),
+            "max_ms": ordered[-1]}
+
+
+def _event_sequence(event):
+    """Послідовність Tk для event_generate з записаної події (модифікатори - у state)."""
+    if event["type"] in ("ButtonPress", "ButtonRelease"):
+        return f"<{event['type']}-{event['num']}>"
+    return f"<{event['type']}>"
+
+
+class InteractionRecorder:
+    """
+    Записує події миші (натискання, відпускання, рух з натиснутою кнопкою,
+    колесо) іменованих віджетів: тип, кнопка, координати, модифікатори
+    (state), delta колеса та час від початку запису, мс.
+
+    Запис іде через власний bindtag на початку bindtags віджета, тому
+    прив'язки вікна не змінюються і після stop() залишаються як були.
+    """
+
+    def __init__(self, widgets):
+        self.widgets = widgets  # {назва: віджет}
+        self.events = []
+        self.started = None
+        for sequence in ("<ButtonPress>", "<ButtonRelease>", "<Motion>", "<MouseWheel>"):
+            next(iter(widgets.values())).bind_class(INTERACTION_RECORDER_TAG, sequence, self._record)
+        self.names = {str(widget): name for name, widget in widgets.items()}
+
+    def start(self):
+        self.events = []
+        self.started = time.perf_counter()
+        for widget in self.widgets.values():
+            widget.bindtags((INTERACTION_RECORDER_TAG,) + widget.bindtags())
+
+    def stop(self):
+        for widget in self.widgets.values():
+            widget.bindtags(tuple(tag for tag in widget.bindtags() if tag != INTERACTION_RECORDER_TAG))
+        self.started = None
+
+    def _record(self, event):
+        if self.started is None:
+            return
+        event_type = getattr(event.type, "name", str(event.type))
+        if event_type == "Motion" and not event.state & 0x1F00:
+            return  # (Рух без натиснутої кнопки нічого не викликає)
+        self.events.append({"widget": self.names.get(str(event.widget), ""), "type": event_type,
+                            "num": event.num if isinstance(event.num, int) else 0,
+                            "x": event.x, "y": event.y, "state": event.state,
+                            "delta": event.delta if isinstance(event.delta, int) else 0,
+                            "t": (time.perf_counter() - self.started) * 1000})
+
+    def recording(self, **state):
+        """Запис для JSON: події та стан вікна на початку (функція, прокрутка, зум...)."""
+        return {"version": 1, "state": state, "events": list(self.events)}
+
+
+class InteractionReplayer:
+    """
+    Відтворює запис (InteractionRecorder.recording) через event_generate з
+    початковими інтервалами (speed - прискорення). Подія обробляється
+    синхронно, тож час event_generate - це затримка обробників події.
+
+    Пропущені кадри рахує "пульс" after(кадр): кожен інтервал між пульсами,
+    довший за кадр, - це кадри, коли цикл подій був зайнятий (обробники,
+    поступовий рендеринг, перемальовування).
+    on_done(звіт) викликається після останньої події та завершення рендерингу.
+    """
+
+    def __init__(self, ctx, widgets, recording, on_done, speed=1.0):
+        self.ctx = ctx
+        self.widgets = widgets
+        self.events = recording["events"]
+        self.on_done = on_done
+        self.speed = speed
+        self.latencies = {}  # {"віджет <послідовність>": [мс]}
+        self.position = 0
+        self.started = None
+        self.last_beat = None
+        self.frame_gaps = []
+        self.dropped_frames = 0
+        self.beat_job = None
+
+    def start(self):
+        self.started = self.last_beat = time.perf_counter()
+        self._beat()
+        self._schedule_next()
+
+    def _beat(self):
+        now = time.perf_counter()
+        gap = (now - self.last_beat) * 1000
+        self.last_beat = now
+        if gap > INTERACTION_FRAME_MS * 1.5:
+            self.dropped_frames += int(gap / INTERACTION_FRAME_MS + 0.5) - 1
+        self.frame_gaps.append(gap)
+        self.beat_job = self.ctx.canvas.after(int(INTERACTION_FRAME_MS), self._beat)
+
+    def _schedule_next(self):
+        if self.position >= len(self.events):
+            self._settle(time.perf_counter())
+            return
+        elapsed = (time.perf_counter() - self.started) * 1000
+        delay = self.events[self.position]["t"] / self.speed - elapsed
+        self.ctx.canvas.after(max(0, int(delay)), self._fire)
+
+    def _fire(self):
+        event = self.events[self.position]
+        self.position += 1
+        widget = self.widgets.get(event["widget"])
+        if widget is not None:
+            sequence = _event_sequence(event)
+            options = {"x": event["x"], "y": event["y"], "state": event["state"]}
+            if event["type"] == "MouseWheel":
+                options["delta"] = event["delta"]
+            start = time.perf_counter()
+            widget.event_generate(sequence, **options)
+            latency = (time.perf_counter() - start) * 1000
+            label = f"{event['widget']} {sequence}" if event["type"] != "Motion" else f"{event['widget']} <Motion>"
+            self.latencies.setdefault(label, []).append(latency)
+        self._schedule_next()
+
+    def _settle(self, finished):
+        """Чекає завершення поступового рендерингу (він теж займає кадри), потім звіт."""
+        waited = (time.perf_counter() - finished) * 1000
+        if self.ctx.render_job is not None and waited < INTERACTION_SETTLE_TIMEOUT_MS:
+            self.ctx.canvas.after(int(INTERACTION_FRAME_MS), lambda: self._settle(finished))
+            return
+        if self.beat_job is not None:
+            self.ctx.canvas.after_cancel(self.beat_job)
+            self.beat_job = None
+        self.on_done(self.report())
+
+    def report(self):
+        """Перцентилі затримки за подіями та разом, пропущені кадри, тривалість."""
+        everything = [value for values in self.latencies.values() for value in values]
+        return {"events": self.position, "duration_ms": (time.perf_counter() - self.started) * 1000,
+                "speed": self.speed, "frame_ms": INTERACTION_FRAME_MS, "dropped_frames": self.dropped_frames,
+                "longest_frame_ms": max(self.frame_gaps, default=0.0),
+                "all": _percentiles(everything),
+                "handlers": {label: _percentiles(values) for label, values in sorted(self.latencies.items())}}
+
+
+# --- 8.4. ОБЛІК ПАМ'ЯТІ ---
+
+# Теги елементів полотна, що рахуються у звіті пам'яті (порти блоків - у GeometryStore, не на полотні)
+MEMORY_REPORT_TAGS = ("block", "block_text", "block_port", "flow_arrow", "grid_line", "arrow_edit_point")
+MEMORY_TOP_FUNCTIONS = 10  # Скільки найбільших розпарсених тіл показувати
+MEMORY_TOP_ALLOCATIONS = 15  # Скільки місць виділення пам'яті (tracemalloc) показувати
+_MEMORY_STATE = {"snapshot": None}  # Попередній знімок tracemalloc (для різниці між звітами)
+
+# Об'єкти, які deep_sizeof не обходить (віджети, модулі, функції, класи - не дані)
+_SIZEOF_OPAQUE = (tk.Misc, type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                  types.MethodType)
+
+
+def start_memory_tracing(frames=1):
+    """Вмикає tracemalloc (у знімках - лише виділення після ввімкнення)."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def deep_sizeof(obj):
+    """
+    Приблизний розмір об'єкта разом з усім вмістом (контейнери, атрибути,
+    масиви NumPy), байт. Спільні об'єкти рахуються один раз.
+    """
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, _SIZEOF_OPAQUE):
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)  # (Для ndarray - разом з власним буфером даних)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif isinstance(item, (str, bytes, int, float, np.ndarray)):
+            continue
+        else:
+            if hasattr(item, "__dict__"):
+                stack.append(vars(item))
+            for slot in getattr(type(item), "__slots__", ()):
+                if hasattr(item, slot):
+                    stack.append(getattr(item, slot))
+    return total
+
+
+def _function_map_parts(function_map):
+    """
+    (тіла токенів {ім'я: дані}, розпарсені тіла {ім'я: псевдокод}) для
+    LazyFunctionCodeMap, ProjectCodeMap (лише завантажені файли) або dict.
+    """
+    if isinstance(function_map, ProjectCodeMap):
+        bodies, parsed = {}, {}
+        for file_path, code_map in function_map.loaded_files().items():
+            file_bodies, file_parsed = _function_map_parts(code_map)
+            relative = function_map.relative_path(file_path)
+            bodies.update((f"{name} [{relative}]", data) for name, data in file_bodies.items())
+            parsed.update((f"{name} [{relative}]", code_list) for name, code_list in file_parsed.items())
+        return bodies, parsed
+    if isinstance(function_map, LazyFunctionCodeMap):
+        return function_map._function_map, dict(function_map._parsed)
+    return {}, dict(function_map)
+
+
+def memory_report(function_map=None, ctx=None):
+    """
+    Звіт пам'яті для вибору розмірів кешів:
+    - structures: сховище токенів, розпарсені тіла (разом і найбільші),
+      кеш сцен, дерево конструкцій з вимірами, реєстр блоків, геометрія;
+    - canvas: кількість елементів полотна всього та за тегами;
+    - tracemalloc: поточний/піковий обсяг, найбільші місця виділення та
+      різниця з попереднім звітом (якщо tracemalloc увімкнено).
+    Розміри компонентів рахуються окремо (спільні рядки можуть увійти в кілька).
+    """
+    structures = {}
+    if function_map is not None:
+        bodies, parsed = _function_map_parts(function_map)
+        structures["token_store"] = {"bytes": deep_sizeof(bodies), "functions": len(bodies),
+                                     "tokens": sum(len(data["body"]) for data in bodies.values())}
+        per_function = sorted(((deep_sizeof(code_list), name, len(code_list)) for name, code_list in parsed.items()),
+                              reverse=True)
+        structures["parsed_bodies"] = {
+            "bytes": sum(size for size, _, _ in per_function), "functions": len(per_function),
+            "lines": sum(lines for _, _, lines in per_function),
+            "largest": [{"function": name, "bytes": size, "lines": lines}
+                        for size, name, lines in per_function[:MEMORY_TOP_FUNCTIONS]]}
+
+    structures["scene_cache"] = {"bytes": deep_sizeof(SCENE_CACHE), "entries": len(SCENE_CACHE),
+                                 "items": sum(len(scene["items"]) for scene in SCENE_CACHE.values())}
+
+    canvas = {}
+    if ctx is not None:
+        tree = ctx.flow_tree or {}
+        structures["layout_tree"] = {"bytes": deep_sizeof(tree.get("nodes", [])), "nodes": len(tree.get("index", {}))}
+        structures["block_registry"] = {"bytes": deep_sizeof((ctx.blocks, ctx.item_to_block, ctx.arrow_connections,
+                                                              ctx.block_nodes, ctx.block_lines)), "blocks": len(ctx.blocks)}
+        structures["geometry"] = {"bytes": deep_sizeof(ctx.geometry), "edges": len(ctx.geometry.edge_ids)}
+        canvas = {"items": len(ctx.canvas.find_all()),
+                  "by_tag": {tag: len(ctx.canvas.find_withtag(tag)) for tag in MEMORY_REPORT_TAGS}}
+
+    traced = {"tracing": tracemalloc.is_tracing()}
+    if traced["tracing"]:
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+        traced.update({"current_bytes": current, "peak_bytes": peak,
+                       "top": [{"where": str(stat.traceback), "bytes": stat.size, "blocks": stat.count}
+                               for stat in snapshot.statistics("lineno")[:MEMORY_TOP_ALLOCATIONS]]})
+        if _MEMORY_STATE["snapshot"] is not None:
+            traced["growth"] = [{"where": str(stat.traceback), "bytes": stat.size_diff, "blocks": stat.count_diff}
+                                for stat in snapshot.compare_to(_MEMORY_STATE["snapshot"], "lineno")
+                                [:MEMORY_TOP_ALLOCATIONS]]
+        _MEMORY_STATE["snapshot"] = snapshot
+
+    return {"structures": structures, "canvas": canvas, "tracemalloc": traced}
+
+
+def format_memory_report(report):
+    """Текст звіту пам'яті (для вікна та консолі)."""
+
+    def _size(value):
+        if value >= 1024 * 1024:
+            return f"{value / 1024 / 1024:9.2f} МБ"
+        return f"{value / 1024:9.1f} КБ"
+
+    lines = ["Структури даних:"]
+    for name, entry in report["structures"].items():
+        details = ", ".join(f"{key}={value}" for key, value in entry.items() if key not in ("bytes", "largest"))
+        lines.append(f"  {name:<16}{_size(entry['bytes'])}  ({details})")
+        for function in entry.get("largest", []):
+            lines.append(f"      {function['function']:<30}{_size(function['bytes'])}  ({function['lines']} рядків)")
+    if report["canvas"]:
+        lines.append("")
+        lines.append(f"Елементи полотна: {report['canvas']['items']}")
+        lines.extend(f"  {tag:<18}{count:>8}" for tag, count in report["canvas"]["by_tag"].items())
+    traced = report["tracemalloc"]
+    lines.append("")
+    if not traced["tracing"]:
+        lines.append("tracemalloc вимкнено (увімкніть або запустіть з AUTOASD_TRACEMALLOC=1).")
+        return "\n".join(lines)
+    lines.append(f"tracemalloc: зараз {_size(traced['current_bytes'])}, пік {_size(traced['peak_bytes'])}")
+    lines.extend(f"  {_size(stat['bytes'])}  {stat['where']}" for stat in traced["top"])
+    if "growth" in traced:
+        lines.append("Зміна з попереднього звіту:")
+        lines.extend(f"  {stat['bytes'] / 1024:+10.1f} КБ  {stat['where']}" for stat in traced["growth"])
+    return "\n".join(lines)
+
+
+# --- 8.5. ГРАФ ВИКЛИКІВ ТА ПОПЕРЕДНЄ ЗАПИСУВАННЯ СЦЕН ---
+
+CALL_PREFETCH_MAX = 8  # Скільки прямих викликаних функцій готувати заздалегідь
+CALL_PREFETCH_DELAY_MS = 30  # Пауза між підготовкою сцен (вікно обробляє події), мс
+_CALL_PATTERN = re.compile(r"\b([A-Za-z_]\w*)\s*\(")  # Ім'я перед '(' у рядку псевдокоду
+
+
+def call_target_name(block_text):
+    """Ім'я функції з тексту блоку виклику ("func(a, b)" -> "func")."""
+    match = _CALL_PATTERN.match(block_text.strip())
+    return match.group(1) if match else None
+
+
+def resolve_function_key(function_map, caller_key, name):
+    """
+    Ключ викликаної функції name у function_map або None. У проекті
+    (ProjectCodeMap) однакове ім'я з файлу того, хто викликає, має перевагу.
+    """
+    if isinstance(function_map, ProjectCodeMap) and caller_key in function_map:
+        caller_file = function_map.location(caller_key)["file"]
+        local_key = f"{name} [{function_map.relative_path(caller_file)}]"
+        if local_key in function_map:
+            return local_key
+    return name if name in function_map else None
+
+
+class CallGraph:
+    """
+    Граф викликів, побудований з розпарсених тіл: {функція: [прямо викликані
+    функції проекту]} у порядку першого виклику. Функція індексується при
+    першому запиті (і заново - якщо її тіло змінилось).
+    """
+
+    def __init__(self):
+        self._callees = {}  # {ключ: (хеш тіла, [ключі викликаних])}
+
+    def callees(self, function_map, key):
+        code_list = function_map.get(key, [])
+        body_hash = _hash_code_list(code_list)
+        cached = self._callees.get(key)
+        if cached is not None and cached[0] == body_hash:
+            return cached[1]
+        callees = []
+        for line in code_list:
+            for name in _CALL_PATTERN.findall(line):
+                callee = resolve_function_key(function_map, key, name)
+                if callee is not None and callee != key and callee not in callees:
+                    callees.append(callee)
+        self._callees[key] = (body_hash, callees)
+        return callees
+
+
+@PERF.timed("prefetch")
+def prefetch_flowchart_scene(ctx, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors,
+                             skip_init, cache_key, page=None, page_height=PAGE_HEIGHT_DEFAULT):
+    """
+    Записує сцену функції в кеш сцен (якщо її там ще немає), не чіпаючи
+    полотно та стан ctx: розкладка йде в окремому контексті, який бере з
+    ctx лише масштаб тексту та згорнуті вузли. page - як у
+    draw_flowchart_with_offset (ключ кешу той самий). Повертає True, якщо сцену записано.
+    """
+    cache_key = _full_scene_cache_key(ctx, cache_key, code_list, page, page_height)
+    if cache_key in SCENE_CACHE:
+        return False
+    scratch = DiagramContext(ctx.canvas)
+    scratch.text_scale = ctx.text_scale
+    scratch.collapsed = ctx.collapsed
+    scene = _record_flowchart_scene(scratch, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor,
+                                    colors, skip_init, page, page_height)
+    _scene_cache_put(cache_key, scene)
+    return True
+
+
+# --- 8.6. ПОВНОТЕКСТОВИЙ ПОШУК ПО БЛОКАХ (ІНВЕРТОВАНИЙ ІНДЕКС) ---
+
+SEARCH_MAX_RESULTS = 500  # Скільки знайдених блоків показувати
+SEARCH_INDEX_BUDGET_MS = 30  # Час на одну порцію індексування (вікно між порціями обробляє події), мс
+SEARCH_DEBOUNCE_MS = 150  # Пауза після введення запиту перед пошуком, мс
+SEARCH_HIGHLIGHT_MS = 1500  # Скільки виділено знайдений блок, мс
+_SEARCH_TOKEN = re.compile(r"\w+")  # Токен пошуку: ідентифікатор, число або слово (без урахування регістру)
+
+
+def _search_tokens(text):
+    return _SEARCH_TOKEN.findall(text.lower())
+
+
+def _is_searchable_line(line):
+    """Чи показується рядок псевдокоду окремим блоком (кінці конструкцій та "Інакше" - ні)."""
+    return bool(line) and line != "Інакше" and line != "Повторити доки (початок)" and \
+        not line.startswith("Все") and not line.startswith("Завершення:")
+
+
+class SearchIndex:
+    """
+    Інвертований індекс токенів рядків псевдокоду всіх функцій:
+    {токен: {ключ функції: (рядки, ...)}}. Запит - токени, які всі мають
+    бути в одному рядку (останній - як початок токена, для пошуку під час
+    введення).
+
+    Мапи функцій не змінюються (live reload створює нову), тому update()
+    для тієї самої мапи лише доіндексовує решту функцій, а для нової -
+    переіндексовує лише функції зі зміненим тілом і вилучає зниклі.
+    """
+
+    def __init__(self):
+        self._postings = {}  # {токен: {ключ: (індекси рядків,)}}
+        self._entries = {}  # {ключ: (хеш тіла, [токени функції])}
+        self._order = {}  # {ключ: позиція у мапі} - порядок результатів
+        self._vocabulary = None  # Відсортовані токени (для пошуку за початком) або None - застарів
+        self._function_map = None
+        self._pending = []  # Ключі мапи, що ще не перевірені update()
+
+    def is_complete(self, function_map):
+        return self._function_map is function_map and not self._pending
+
+    def progress(self):
+        """(перевірено функцій, усього) для поточної мапи."""
+        return len(self._order) - len(self._pending), len(self._order)
+
+    def update(self, function_map, budget_ms=None):
+        """
+        Індексує функції function_map (парсить ще не розпарсені тіла), поки не
+        вичерпано budget_ms (None - без обмеження). Повертає True, якщо індекс
+        відповідає мапі повністю.
+        """
+        if self._function_map is not function_map:
+            self._function_map = function_map
+            self._order = {key: position for position, key in enumerate(function_map)}
+            for key in [key for key in self._entries if key not in self._order]:
+                self._remove(key)
+            self._pending = list(reversed(self._order))
+
+        deadline = None if budget_ms is None else time.perf_counter() + budget_ms / 1000.0
+        with PERF.span("search_index"):
+            while self._pending:
+                key = self._pending.pop()
+                code_list = function_map[key]
+                body_hash = _hash_code_list(code_list)
+                entry = self._entries.get(key)
+                if entry is None or entry[0] != body_hash:
+                    if entry is not None:
+                        self._remove(key)
+                    self._add(key, code_list, body_hash)
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+        return not self._pending
+
+    def _add(self, key, code_list, body_hash):
+        lines_of = {}  # {токен: [рядки]}
+        for line_index, line in enumerate(code_list):
+            if _is_searchable_line(line.strip()):
+                for token in set(_search_tokens(line)):
+                    lines_of.setdefault(token, []).append(line_index)
+        for token, lines in lines_of.items():
+            if token not in self._postings:
+                self._postings[token] = {}
+                self._vocabulary = None
+            self._postings[token][key] = tuple(lines)
+        self._entries[key] = (body_hash, list(lines_of))
+
+    def _remove(self, key):
+        _, tokens = self._entries.pop(key)
+        for token in tokens:
+            postings = self._postings[token]
+            del postings[key]
+            if not postings:
+                del self._postings[token]
+                self._vocabulary = None
+
+    def _lines_for(self, token, is_prefix):
+        """{ключ: множина рядків} з токеном token (або з токенами, що з нього починаються)."""
+        if not is_prefix:
+            return {key: set(lines) for key, lines in self._postings.get(token, {}).items()}
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        result = {}
+        position = bisect.bisect_left(self._vocabulary, token)
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(token):
+            for key, lines in self._postings[self._vocabulary[position]].items():
+                result.setdefault(key, set()).update(lines)
+            position += 1
+        return result
+
+    @PERF.timed("search")
+    def search(self, query, limit=SEARCH_MAX_RESULTS):
+        """
+        Рядки, що містять усі токени запиту: ([(ключ, індекс рядка)], усього
+        знайдено) - у порядку функцій мапи та рядків; не більше limit.
+        """
+        tokens = _search_tokens(query)
+        if not tokens:
+            return [], 0
+        # (Останній токен - можливо, ще не дописаний; спершу - найрідкісніші токени)
+        candidates = [self._lines_for(token, False) for token in dict.fromkeys(tokens[:-1])]
+        candidates.append(self._lines_for(tokens[-1], True))
+        candidates.sort(key=len)
+        matches = candidates[0]
+        for other in candidates[1:]:
+            matches = {key: lines & other[key] for key, lines in matches.items() if key in other}
+            matches = {key: lines for key, lines in matches.items() if lines}
+        hits = sorted((self._order.get(key, len(self._order)), line, key)
+                      for key, lines in matches.items() for line in lines)
+        return [(key, line) for _, line, key in hits[:limit]], len(hits)
+
+
+def block_at_line(ctx, line):
+    """
+    ID намальованого блоку рядка псевдокоду line: блок самого рядка або,
+    якщо рядок прихований у згорнутому вузлі, найближчий блок над ним
+    (заголовок згорнутого вузла). None - на схемі немає відповідного блоку.
+    """
+    best = None
+    for block_lines in (ctx.block_lines, ctx.block_nodes):
+        for block_id, block_line in block_lines.items():
+            if block_line <= line and (best is None or block_line > best[0]):
+                best = (block_line, block_id)
+    return best[1] if best is not None else None
+
+
+def page_of_line(ctx, code_list, pages, skip_init, line):
+    """Номер сторінки (з 0, див. _flow_pages), на якій лежить вузол верхнього рівня з рядком line."""
+    nodes = _flow_tree_for(ctx, code_list, skip_init)["nodes"]
+    top_index = 0
+    for index, node in enumerate(nodes):
+        if node.get("line", node.get("source_line", line + 1)) <= line:
+            top_index = index
+    for page, (start, end) in enumerate(pages):
+        if start <= top_index < end:
+            return page
+    return 0
+
+
+# --- 8.7. СТРУКТУРНЕ ПОРІВНЯННЯ ДВОХ ВЕРСІЙ ФУНКЦІЇ (DIFF) ---
+
+DIFF_COLORS = {"added": "#2CA02C", "removed": "#D62728", "modified": "#FF8C00"}  # Контур блоку за станом
+DIFF_OUTLINE_WIDTH = 3
+DIFF_REMOVED_DASH = (6, 3)  # (Вилучені блоки - пунктиром)
+DIFF_MENU_MARKS = {"added": "+ ", "modified": "* "}  # Позначки функцій у меню під час порівняння
+_FLOW_CHILD_KEYS = {"if": ("true", "false"), "for": ("body",), "while": ("body",), "do": ("body",)}
+
+
+def _flow_subtree_hashes(nodes):
+    """
+    Записує у кожен вузол дерева "hash" - хеш його піддерева (тип, текст та
+    хеші дочірніх послідовностей). Вузли, що вже мають хеш, пропускаються
+    разом з піддеревом (дерево будується заново для іншого коду).
+    """
+    order = []
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if "hash" in node:
+            continue
+        order.append(node)
+        for child_nodes in _flow_children(node):
+            stack.extend(child_nodes)
+
+    # (Зворотний прямий порядок - діти раніше за батьків)
+    for node in reversed(order):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{node['kind']}\x00{node['text']}".encode("utf-8"))
+        for child_nodes in _flow_children(node):
+            digest.update(b"\x01")
+            for child in child_nodes:
+                digest.update(child["hash"])
+        node["hash"] = digest.digest()
+
+
+def _node_lines(node):
+    """Рядки псевдокоду вузла, за якими знаходяться його блоки (див. draw_flow_tree)."""
+    return [node[key] for key in ("line", "source_line", "end_line") if key in node]
+
+
+def _align_flow_sequences(old_nodes, new_nodes):
+    """
+    Вирівнює дві послідовності вузлів за хешами піддерев: спільні початок і
+    кінець відкидаються одразу, решта - difflib.SequenceMatcher. Вузли того
+    самого типу на місці один одного - "changed" (порівнюються глибше).
+
+    Повертає [(операція, старий вузол або None, новий вузол або None)], де
+    операція - "same", "changed", "removed" або "added".
+    """
+    old_hashes = [node["hash"] for node in old_nodes]
+    new_hashes = [node["hash"] for node in new_nodes]
+    size = min(len(old_hashes), len(new_hashes))
+    start = 0
+    while start < size and old_hashes[start] == new_hashes[start]:
+        start += 1
+    end = 0
+    while end < size - start and old_hashes[-1 - end] == new_hashes[-1 - end]:
+        end += 1
+
+    ops = [("same", old, new) for old, new in zip(old_nodes[:start], new_nodes[:start])]
+    matcher = difflib.SequenceMatcher(None, old_hashes[start:len(old_hashes) - end],
+                                      new_hashes[start:len(new_hashes) - end], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        olds = old_nodes[start + i1:start + i2]
+        news = new_nodes[start + j1:start + j2]
+        if tag == "equal":
+            ops.extend(("same", old, new) for old, new in zip(olds, news))
+            continue
+        for index in range(max(len(olds), len(news))):
+            old = olds[index] if index < len(olds) else None
+            new = news[index] if index < len(news) else None
+            if old is not None and new is not None and old["kind"] == new["kind"]:
+                ops.append(("changed", old, new))
+                continue
+            if old is not None:
+                ops.append(("removed", old, None))
+            if new is not None:
+                ops.append(("added", None, new))
+    ops.extend(("same", old, new) for old, new in zip(old_nodes[len(old_nodes) - end:],
+                                                        new_nodes[len(new_nodes) - end:]))
+    return ops
+
+
+def structural_diff(old_nodes, new_nodes):
+    """
+    Порівнює дерева конструкцій двох версій функції (build_flow_tree) і
+    будує об'єднане дерево: вузли нової версії та вставлені на свої місця
+    вилучені вузли старої.
+
+    Незмінені піддерева (однаковий хеш) не обходяться - в об'єднане дерево
+    потрапляють ті самі вузли нової версії разом з уже виміряною розкладкою;
+    копіюються лише змінені складені вузли (з новими списками дочірніх).
+    Вузли старої версії змінюються: їхні рядки стають від'ємними (-1 - рядок),
+    щоб не збігатися з рядками нової.
+
+    Повертає (вузли, {рядок: "added" | "removed" | "modified"},
+    {"added": n, "removed": n, "modified": n}).
+    """
+    _flow_subtree_hashes(old_nodes)
+    _flow_subtree_hashes(new_nodes)
+    statuses = {}
+    counts = {"added": 0, "removed": 0, "modified": 0}
+
+    def _mark_subtree(node, status):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if status == "removed":
+                for key in ("line", "source_line", "end_line"):
+                    if key in node:
+                        node[key] = -1 - node[key]
+            for line in _node_lines(node):
+                statuses[line] = status
+            counts[status] += 1
+            for child_nodes in _flow_children(node):
+                stack.extend(child_nodes)
+
+    result = {"nodes": None}
+    work = [(old_nodes, new_nodes, result, "nodes")]  # (стара, нова послідовність, куди записати об'єднану)
+    while work:
+        old_sequence, new_sequence, holder, key = work.pop()
+        merged = []
+        for op, old, new in _align_flow_sequences(old_sequence, new_sequence):
+            if op == "same":
+                merged.append(new)
+            elif op == "added":
+                _mark_subtree(new, "added")
+                merged.append(new)
+            elif op == "removed":
+                _mark_subtree(old, "removed")
+                merged.append(old)
+            else:
+                node = dict(new)
+                node.pop("layout_key", None)  # (Копія з іншими дочірніми - вимірюється заново)
+                if old["text"] != new["text"]:
+                    for line in _node_lines(new):
+                        statuses[line] = "modified"
+                    counts["modified"] += 1
+                for child_key in _FLOW_CHILD_KEYS.get(new["kind"], ()):
+                    work.append((old[child_key], new[child_key], node, child_key))
+                merged.append(node)
+        holder[key] = merged
+    return result["nodes"], statuses, counts
+
+
+def _mark_diff_scene(scene, statuses):
+    """Контури фігур доданих, вилучених та змінених блоків сцени - кольором стану (DIFF_COLORS)."""
+    items = scene["items"]
+    for block_id, _, _, _, _, item_indexes in scene["blocks"]:
+        status = statuses.get(scene["block_lines"].get(block_id)) or \
+            statuses.get(scene["block_nodes"].get(block_id))
+        if status is None or not item_indexes:
+            continue
+        item_type, coords, options = items[item_indexes[0]]
+        options = dict(options, outline=DIFF_COLORS[status], width=DIFF_OUTLINE_WIDTH)
+        if status == "removed":
+            options["dash"] = DIFF_REMOVED_DASH
+        items[item_indexes[0]] = (item_type, coords, options)
+
+
+@PERF.timed("diff")
+def _record_diff_scene(ctx, old_code_list, code_list, h_scale, v_scale, loop_offset_factor, if_offset_factor,
+                       colors, skip_init):
+    """
+    Сцена порівняння: об'єднане дерево (structural_diff) старої версії та
+    дерева поточної з кешу контексту (з його розкладкою та згорнутими
+    вузлами), з виділеними змінами. Лічильники змін - у scene["diff"].
+    """
+    new_nodes = _flow_tree_for(ctx, code_list, skip_init)["nodes"]
+    nodes, statuses, counts = structural_diff(build_flow_tree(old_code_list, skip_init), new_nodes)
+    scene = _record_flow_nodes_scene(ctx, nodes, h_scale, v_scale, loop_offset_factor, if_offset_factor, colors)
+    _mark_diff_scene(scene, statuses)
+    scene["diff"] = counts
+    return scene
+
 
-def _update_colors_only(canvas, colors):
-    """Швидко оновлює кольори існуючих блоків без перемальовування."""
-    (color_ellipse, color_rect, color_rhombus, color_sub, color_hex) = colors
+def _function_body_hash(function_map, key):
+    if isinstance(function_map, (LazyFunctionCodeMap, ProjectCodeMap)):
+        return function_map.body_hash(key)  # (Хеш токенів - без парсингу тіла)
+    return _hash_code_list(function_map[key])
 
-    # Використовуємо теги типів, присвоєні при малюванні
-    canvas.itemconfig("ellipse", fill=color_ellipse)
-    canvas.itemconfig("rect", fill=color_rect)
-    canvas.itemconfig("rhombus", fill=color_rhombus)
-    canvas.itemconfig("sub", fill=color_sub)
-    canvas.itemconfig("para", fill=color_sub)  # Паралелограми (Ввід/Вивід)
-    canvas.itemconfig("hex", fill=color_hex)
+
+def diff_function_maps(old_map, new_map):
+    """
+    Порівняння функцій двох версій файлу за хешами тіл: ({ключ: "added" |
+    "modified" | "same"} для функцій new_map, [ключі вилучених функцій]).
+    """
+    statuses = {}
+    for key in new_map:
+        if key not in old_map:
+            statuses[key] = "added"
+        elif _function_body_hash(old_map, key) == _function_body_hash(new_map, key):
+            statuses[key] = "same"
+        else:
+            statuses[key] = "modified"
+    return statuses, [key for key in old_map if key not in new_map]
 
 
 # --- 9. ГОЛОВНЕ ВІКНО GUI ТА ОБРОБНИКИ ПОДІЙ ---
 
-def draw_flowchart_window(root, function_map):
+def draw_flowchart_window(root, function_map, source_path=None, diff_path=None):
     """
     Створює та керує головним вікном редактора блок-схем.
+
+    source_path - шлях до вихідного файлу (для режиму стеження за змінами).
+    diff_path - попередня версія файлу: вікно відкривається в режимі порівняння з нею.
+    Повертає {"window", "ctx", "start_replay"} (або None, якщо немає 'main').
     """
     SNAP_THRESHOLD = 5  # Допуск "прилипання" стрілки до сітки (px)
     ARROW_GRID_SIZE = 25  # Крок сітки для точок стрілок
@@ -1768,7 +4415,9 @@ def draw_flowchart_window(root, function_map):
     grid_visible_var = tk.BooleanVar(value=True)  # Стан чекбоксу "Сітка"
     arrow_data = {"id": None, "coords": [], "points_vis": []}  # Для редагування стрілок
 
-    if "main" not in function_map:
+    # (У проекті без 'main' показуємо першу знайдену функцію)
+    is_project = isinstance(function_map, ProjectCodeMap)
+    if "main" not in function_map and not (is_project and len(function_map)):
         print("Не можу намалювати: функція 'main' не знайдена.")
         root.destroy()
         return
@@ -1776,12 +4425,14 @@ def draw_flowchart_window(root, function_map):
     # --- 1. Налаштування вікна ---
     draw_window = tk.Toplevel(root)
     draw_window.title("Блок-схема")
+    if is_project:
+        draw_window.title(f"Блок-схема - проект {os.path.basename(os.path.abspath(function_map.root))} "
+                          f"({function_map.file_count} файлів, {len(function_map)} функцій)")
     draw_window.geometry("1400x800")
     draw_window.protocol("WM_DELETE_WINDOW", root.destroy)  # Закрити все при виході
 
     # --- 2. Розмітка GUI (Панелі) ---
     # 2.1. Ліва панель інструментів (кнопки)
-    zoom_display_var = tk.StringVar(draw_window, value=f"{GLOBAL_SCALE_FACTOR_X:.2f}x")
     left_toolbar_frame = tk.Frame(draw_window, width=170, bd=1, relief="raised");
     left_toolbar_frame.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=5);
     left_toolbar_frame.pack_propagate(False)  # Фіксована ширина
@@ -1805,7 +4456,8 @@ def draw_flowchart_window(root, function_map):
     # --- 3. Глобальні змінні Tkinter (Controls) ---
     function_names = list(function_map.keys());
     selected_func = tk.StringVar(draw_window);
-    selected_func.set("main");
+    selected_func.set("main" if "main" in function_map else function_names[0]);
+    function_filter_var = tk.StringVar(draw_window)  # Пошук у меню функцій (у проекті - по всіх файлах)
     show_minimap_var = tk.BooleanVar(value=True)
 
     # 3.1. Скролбари та Полотно (Canvas)
@@ -1815,6 +4467,11 @@ def draw_flowchart_window(root, function_map):
     h_scroll.pack(side=tk.BOTTOM, fill=tk.X)
     canvas = tk.Canvas(canvas_frame, bg="white", yscrollcommand=v_scroll.set, xscrollcommand=h_scroll.set);
     canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=1)
+    canvas.tk = TclCallCounter(canvas.tk, PERF)  # (Лічильник викликів Tcl полотна - для панелі продуктивності)
+
+    # Стан діаграми цього вікна (стрілки, тексти блоків, масштаб, перетягування)
+    ctx = DiagramContext(canvas)
+    zoom_display_var = tk.StringVar(draw_window, value=f"{ctx.scale_x:.2f}x")
 
     # 3.2. Налаштування міні-карти
     MINIMAP_W, MINIMAP_H = 200, 160
@@ -1833,10 +4490,51 @@ def draw_flowchart_window(root, function_map):
     rhombus_color_var = tk.StringVar(value="#FFFFE0");
     sub_color_var = tk.StringVar(value="#CCEEFF");
     hex_color_var = tk.StringVar(value="#D8BFD8");
-    global_text_scale_var = tk.DoubleVar(value=GLOBAL_TEXT_SCALE_FACTOR)
+    global_text_scale_var = tk.DoubleVar(value=ctx.text_scale)
 
     # 3.5. Змінні для чекбоксів
     skip_init_var = tk.BooleanVar(value=False)
+    watch_var = tk.BooleanVar(value=False)  # Стеження за змінами файлу (live reload)
+
+    # 3.6. Стан стеження за файлом
+    watch_state = {"job": None, "signature": None, "lexed": None, "layout_positions": {}}
+
+    # 3.7. Заголовок панелі помилок розбору
+    diagnostics_title_var = tk.StringVar(value="Помилки розбору")
+
+    # 3.8. Хід поступового рендерингу великої схеми
+    render_progress_var = tk.DoubleVar(value=0.0)
+    render_status_var = tk.StringVar(value="")
+
+    # 3.9. Режим сторінок (номер поточної сторінки - з 1)
+    page_mode_var = tk.BooleanVar(value=False)
+    page_var = tk.IntVar(value=1)
+    page_count_var = tk.StringVar(value="/ 1")
+    page_state = {"count": 1}
+
+    # 3.10. Панель продуктивності
+    show_perf_var = tk.BooleanVar(value=False)
+    PERF_PANEL_REFRESH_MS = 1000
+    perf_state = {"job": None}
+
+    # 3.11. Запис та відтворення взаємодії (recorder створюється після віджетів)
+    record_var = tk.BooleanVar(value=False)
+    interaction = {"recorder": None, "widgets": {}}
+
+    # 3.12. Навігація за викликами (історія назад/вперед) та підготовка сцен викликаних функцій
+    call_graph = CallGraph()
+    nav_state = {"current": None, "back": [], "forward": [], "prefetch_job": None, "prefetch_queue": []}
+
+    # 3.13. Пошук по блоках (індекс будується при першому відкритті вікна пошуку)
+    search_index = SearchIndex()
+    search_query_var = tk.StringVar(draw_window)
+    search_status_var = tk.StringVar(draw_window, value="")
+    search_state = {"window": None, "entry": None, "listbox": None, "job": None, "hits": []}
+
+    # 3.14. Порівняння з попередньою версією файлу (стани функцій - для поточної мапи)
+    diff_var = tk.BooleanVar(value=False)
+    diff_status_var = tk.StringVar(draw_window, value="")
+    diff_state = {"old_map": None, "old_path": None, "new_map": None, "functions": {}, "removed": []}
 
     # --- 4. ДОПОМІЖНІ ФУНКЦІЇ (ЗАМИКАННЯ GUI) ---
     # (Ці функції мають доступ до 'canvas', 'h_scale_var' тощо)
@@ -1923,18 +4621,18 @@ def draw_flowchart_window(root, function_map):
 
             canvas.xview_moveto(new_x_start);
             canvas.yview_moveto(new_y_start);
+            _rebase_view_origin()
             _update_minimap_viewport()  # Миттєве оновлення
         except Exception as e:
             print(f"Помилка кліку по міні-карті: {e}")
 
     def update_text_scale_and_redraw(*args):
-        """Оновлює глобальний масштаб тексту та викликає перемальовування."""
-        global GLOBAL_TEXT_SCALE_FACTOR
+        """Оновлює масштаб тексту діаграми та викликає перемальовування."""
         try:
-            GLOBAL_TEXT_SCALE_FACTOR = global_text_scale_var.get()
+            ctx.text_scale = global_text_scale_var.get()
         except tk.TclError:
-            GLOBAL_TEXT_SCALE_FACTOR = 1.0
-        update_drawing()  # Викликати повне оновлення
+            ctx.text_scale = 1.0
+        update_drawing(trigger="text_scale")  # Викликати повне оновлення
 
     # --- 4.1. Обробники навігації (Pan/Zoom/Scroll) ---
 
@@ -1950,14 +4648,41 @@ def draw_flowchart_window(root, function_map):
     def _on_pan_end(event):
         """Завершення панорамування."""
         canvas.config(cursor="");
+        _rebase_view_origin()
         _update_minimap_viewport()  # Оновлюємо карту після руху
 
+    def _rebase_view_origin(*args):
+        """
+        Плаваючий початок координат: якщо видима область відійшла від (0, 0)
+        полотна далі ніж на ORIGIN_REBASE_DISTANCE, переносить початок координат
+        до неї (зсув кратний кроку сітки). Вигляд на екрані не змінюється.
+        """
+        if ctx.drag["item"] is not None or ctx.drag["arrow_id"] is not None:
+            return  # (Координати перетягування - у старій системі)
+        view_x, view_y = canvas.canvasx(0), canvas.canvasy(0)
+        if max(abs(view_x), abs(view_y)) < ORIGIN_REBASE_DISTANCE:
+            return
+        try:
+            x0, y0, x1, y1 = (float(v) for v in canvas.cget("scrollregion").split())
+        except ValueError:
+            return
+        dx = round(view_x / GRID_SIZE) * GRID_SIZE
+        dy = round(view_y / GRID_SIZE) * GRID_SIZE
+
+        ctx.rebase_origin(dx, dy)
+        scroll_region = (x0 - dx, y0 - dy, x1 - dx, y1 - dy)
+        canvas.config(scrollregion=scroll_region)
+        draw_grid_lines(canvas, GRID_SIZE, 0, grid_visible_var.get(), region=grid_region(scroll_region))
+
+        # (Та сама частина сцени - тепер біля (0, 0) полотна)
+        if x1 > x0 and y1 > y0:
+            canvas.xview_moveto((view_x - x0) / (x1 - x0))
+            canvas.yview_moveto((view_y - y0) / (y1 - y0))
+
     def _on_mouse_wheel(event):
         """
         Масштабування (Zoom) вмісту Canvas (Ctrl + Колесо миші) з фіксованим кроком.
         """
-        global GLOBAL_SCALE_FACTOR_X
-        global GLOBAL_SCALE_FACTOR_Y
 
         # Перевіряємо, чи натиснуто Ctrl
         if event.state & 4:
@@ -1970,30 +4695,40 @@ def draw_flowchart_window(root, function_map):
 
             # --- ОСЬ ЗМІНА ---
 
-            new_scale_factor = GLOBAL_SCALE_FACTOR_X * scale_change
+            new_scale_factor = ctx.scale_x * scale_change
 
             # Обмеження мінімального масштабу (наприклад, до 0.1x)
             if new_scale_factor < 0.1:
                 # Розраховуємо точний множник, щоб дійти до 0.1
-                final_scale_change = 0.1 / GLOBAL_SCALE_FACTOR_X
-                if GLOBAL_SCALE_FACTOR_X <= 0.1: return  # Вже на мінімумі або нижче
-                GLOBAL_SCALE_FACTOR_X = 0.1
-                GLOBAL_SCALE_FACTOR_Y = 0.1
+                final_scale_change = 0.1 / ctx.scale_x
+                if ctx.scale_x <= 0.1: return  # Вже на мінімумі або нижче
+                ctx.scale_x = 0.1
+                ctx.scale_y = 0.1
                 scale_change = final_scale_change  # Використовуємо точний множник
             else:
-                GLOBAL_SCALE_FACTOR_X = new_scale_factor
-                GLOBAL_SCALE_FACTOR_Y = new_scale_factor
+                ctx.scale_x = new_scale_factor
+                ctx.scale_y = new_scale_factor
 
             # 1. Застосовуємо масштабування лише на РІЗНИЦЮ
             # Це не викликає миготіння, оскільки ми не скидаємо до 1.0х
             canvas.scale("all", 0, 0, scale_change, scale_change)
+            ctx.geometry.scale(scale_change)
+            ctx.scale_origin(scale_change)
+            if ctx.render_job is not None:
+                ctx.render_job.scale(scale_change)  # (Ще не створені елементи)
+
+            # (Позиції розкладки масштабуються разом з полотном - це не ручні переміщення)
+            watch_state["layout_positions"] = {
+                identity: (block_id, x * scale_change, y * scale_change)
+                for identity, (block_id, x, y) in watch_state["layout_positions"].items()}
 
             # 2. Оновлюємо GUI
-            zoom_display_var.set(f"{GLOBAL_SCALE_FACTOR_X:.2f}x")
+            zoom_display_var.set(f"{ctx.scale_x:.2f}x")
             # --- КІНЕЦЬ ЗМІНИ ---
 
             # Оновлюємо ScrollRegion
             canvas.configure(scrollregion=canvas.bbox("all"))
+            _rebase_view_origin()
             _update_minimap_viewport()
 
             return
@@ -2011,6 +4746,7 @@ def draw_flowchart_window(root, function_map):
             return
 
         canvas.yview_scroll(delta, "units");
+        _rebase_view_origin()
         _update_minimap_viewport_debounced()  # Оновлення з затримкою
 
     def _on_horizontal_scroll(event):
@@ -2023,6 +4759,7 @@ def draw_flowchart_window(root, function_map):
             return
 
         canvas.xview_scroll(delta, "units");
+        _rebase_view_origin()
         _update_minimap_viewport_debounced()
 
     # --- 4.2. Обробники кнопок ---
@@ -2056,12 +4793,44 @@ def draw_flowchart_window(root, function_map):
        - **Прив'язка стрілки:** Перетягніть кінцеву точку до блоку, поки вона не "прилипне".
        - **Від'єднання стрілки:** Перетягніть кінцеву точку від блоку.
        - **Вирівнювання стрілок:** Проміжні точки стрілки "прилипають" до сітки та до ортогональних (90°) ліній.
+       - **Згортання:** ПКМ по умові або циклу згортає його тіло в один блок (пунктирна рамка),
+         ПКМ по такому блоку - розгортає. Кнопки "Згорнути всі тіла" / "Розгорнути всі" - для всієї функції.
 
     3. Експорт:
        - **Повна БС (.png):** Зберігає всю діаграму, навіть ту, що не видно на екрані (рекомендовано).
        - **Видима БС (.png):** Робить скріншот видимої частини вікна.
        - **Експорт в .drawio:** Зберігає у форматі, сумісному з diagrams.net (Draw.io).
        - **Псевдокод (.txt):** Зберігає псевдокод поточної функції.
+       - **Сторінки (.png + .drawio):** Ділить схему на сторінки (між блоками верхнього рівня,
+         з міжсторінковими з'єднувачами) і зберігає кожну як PNG та сторінку одного .drawio.
+         Галочка "Сторінки" показує схему посторінково (номер сторінки - поруч).
+
+    4. Файл:
+       - **Пошук:** Фільтрує меню функцій за іменем; Enter - показати першу знайдену.
+       - **Виклики:** Подвійний клік по блоку виклику відкриває схему викликаної функції
+         (схеми прямо викликаних функцій готуються заздалегідь, тому перехід миттєвий);
+         ◀ / ▶ (або Alt+Стрілки) - назад / вперед по історії переглянутих функцій.
+       - **Пошук по блоках (Ctrl+F):** Шукає ідентифікатори та слова в блоках усіх функцій
+         (усі слова запиту - в одному блоці, останнє - за початком); подвійний клік або Enter
+         на результаті відкриває функцію з цим блоком у центрі.
+       - **Порівняти з версією (python Main.py --diff OLD.c NEW.c):** Одна схема обох версій функції:
+         додані блоки - зеленим контуром, вилучені - червоним пунктиром, змінені - помаранчевим;
+         у меню функцій "+" - нова, "*" - змінена. Галочка "Порівняння" вмикає/вимикає режим.
+       - **Проект (python Main.py --project [каталог]):** Індексує всі .c файли каталогу паралельно;
+         пошук у меню - по всьому проекту (тіла функцій завантажуються лише при виборі).
+       - **Стежити за файлом:** Після збереження .c файлу схема оновлюється автоматично
+         (перемальовуються лише змінені функції, прокрутка та ручні переміщення зберігаються).
+       - **Продуктивність:** Панель з часом кожного етапу (токенізація, пошук функцій, парсинг,
+         розкладка, малювання, прив'язка стрілок, сітка, рендеринг, експорт), кількістю
+         створених елементів Tk, викликів Tcl та перемальовувань за джерелом; "Зберегти JSON" -
+         знімок вимірів для порівняння між запусками.
+       - **Запис взаємодії / Відтворити запис...:** Записує події миші (перетягування, зум, прокрутка,
+         міні-карта, повзунки) у JSON і відтворює їх, показуючи затримки обробників (p50/p90/p99)
+         та пропущені кадри. Без GUI: python -m benchmarks.replay запис.json файл.c
+       - **Пам'ять...:** Розмір сховища токенів, розпарсених тіл (найбільші функції), кешу сцен,
+         дерева розкладки та реєстру блоків, кількість елементів полотна за тегами; з tracemalloc -
+         найбільші місця виділення та приріст з попереднього оновлення. Без GUI:
+         python -m benchmarks.memory файл.c
     """
         help_text_widget.insert(tk.END, help_text);
         help_text_widget.config(state=tk.DISABLED)
@@ -2091,7 +4860,36 @@ def draw_flowchart_window(root, function_map):
                                                 initialfile=f"flowchart_{selected_func.get()}_full.png",
                                                 defaultextension=".png",
                                                 filetypes=(("PNG files", "*.png"), ("All files", "*.*")))
-        if png_path: save_full_flowchart_as_png_via_pil(canvas, png_path)
+        if png_path: save_full_flowchart_as_png_via_pil(ctx, png_path)
+
+    def save_pages():
+        """
+        Режим сторінок: кожна сторінка - окремий PNG (<ім'я>_p<N>.png) та
+        окрема сторінка у спільному файлі <ім'я>.drawio.
+        """
+        base_path = filedialog.asksaveasfilename(title="Зберегти сторінки схеми (PNG + .drawio)",
+                                                 initialfile=f"flowchart_{selected_func.get()}",
+                                                 defaultextension=".png",
+                                                 filetypes=(("PNG files", "*.png"), ("All files", "*.*")))
+        if not base_path: return
+        root_path, _ = os.path.splitext(base_path)
+        selected_name = selected_func.get()
+        current_page = page_var.get()
+
+        # (Кожна зміна сторінки перемальовує схему через trace)
+        page_mode_var.set(True)
+        pages_xml = []
+        for page_number in range(1, page_state["count"] + 1):
+            page_var.set(page_number)
+            save_full_flowchart_as_png_via_pil(ctx, f"{root_path}_p{page_number}.png")
+            pages_xml.append(_drawio_page_xml(ctx, f"{selected_name} ({page_number})", f"page-{page_number}"))
+        try:
+            with open(f"{root_path}.drawio", 'w', encoding='utf-8') as f:
+                f.write(DRAWIO_FILE_HEADER + "".join(pages_xml) + DRAWIO_FILE_FOOTER)
+            print(f"✅ Сторінки ({len(pages_xml)}) збережені: {root_path}_p*.png, {root_path}.drawio")
+        except OSError as e:
+            print(f"❌ Помилка при збереженні сторінок: {e}")
+        page_var.set(current_page)
 
     def save_visible_diagram_png():
         """Збереження видимої частини (скріншот)."""
@@ -2111,7 +4909,7 @@ def draw_flowchart_window(root, function_map):
                                                            ("All files", "*.*")))
         if not xml_path: return
         try:
-            xml_content = generate_drawio_xml_from_canvas(canvas, selected_name)
+            xml_content = generate_drawio_xml_from_canvas(ctx, selected_name)
             with open(xml_path, 'w', encoding='utf-8') as f:
                 f.write(xml_content)
             print(f"✅ Діаграма успішно збережена у .drawio: {xml_path}")
@@ -2121,9 +4919,26 @@ def draw_flowchart_window(root, function_map):
             traceback.print_exc()
 
     # --- 4.3. Головна функція оновлення ---
-    def update_drawing(*args):
+    def _show_render_progress(created, total):
+        """Показує хід поступового рендерингу (створено елементів з total)."""
+        render_progress_var.set(100.0 * created / total if total else 100.0)
+        render_status_var.set(f"Малювання: {created}/{total}")
+        if not render_progress_bar.winfo_ismapped():
+            render_progress_bar.pack(side=tk.RIGHT, padx=(2, 10), anchor="n")
+            render_status_label.pack(side=tk.RIGHT, anchor="n")
+
+    def _hide_render_progress():
+        """Ховає індикатор рендерингу."""
+        render_progress_bar.pack_forget()
+        render_status_label.pack_forget()
+
+    def update_drawing(*args, on_complete=None, trigger=None):
         """
         Повністю перемальовує полотно та ПОВТОРНО ЗАСТОСОВУЄ ТЕКСТОВИЙ ТА ВІЗУАЛЬНИЙ ЗУМ.
+
+        on_complete() викликається, коли схема намальована повністю (велика
+        схема малюється частинами, і на момент повернення ще не готова).
+        trigger - джерело перемальовування (для панелі продуктивності).
         """
         # 1. Швидке оновлення кольорів
         if len(args) == 3 and isinstance(args[0], str) and ('color_var' in args[0]):
@@ -2131,19 +4946,21 @@ def draw_flowchart_window(root, function_map):
                 colors = (ellipse_color_var.get(), rect_color_var.get(), rhombus_color_var.get(),
                           sub_color_var.get(), hex_color_var.get())
                 _update_colors_only(canvas, colors)
+                if ctx.render_job is not None:
+                    ctx.render_job.set_colors(colors)
                 return
             except tk.TclError:
                 return
 
         # 2. Повне перемалювання
         try:
-            zoom_display_var.set(f"{GLOBAL_SCALE_FACTOR_X:.2f}x")
+            zoom_display_var.set(f"{ctx.scale_x:.2f}x")
             is_grid_visible = grid_visible_var.get()
 
             # --- ОСЬ ЗМІНА ---
             # 1. Об'єднуємо масштаби: (Масштаб повзунків) * (Візуальний Zoom)
-            final_h_scale = h_scale_var.get() * GLOBAL_SCALE_FACTOR_X
-            final_v_scale = v_scale_var.get() * GLOBAL_SCALE_FACTOR_Y
+            final_h_scale = h_scale_var.get() * ctx.scale_x
+            final_v_scale = v_scale_var.get() * ctx.scale_y
             # --- КІНЕЦЬ ЗМІНИ ---
 
             loop_offset_factor = loop_offset_var.get();
@@ -2152,24 +4969,57 @@ def draw_flowchart_window(root, function_map):
             skip_init = skip_init_var.get()
             colors = (ellipse_color_var.get(), rect_color_var.get(), rhombus_color_var.get(), sub_color_var.get(),
                       hex_color_var.get())
+            page_number = page_var.get() if page_mode_var.get() else None
+            is_diff = _diff_active()
         except tk.TclError:
             return
 
+        PERF.redraw(trigger or "інше")
+
         # Використовуємо нові комбіновані змінні у логуванні
         print(
             f"Оновлення: Функція='{selected_name}', Масштаб (ШxВ): {final_h_scale:.2f}x{final_v_scale:.2f}, ... [ПОВНЕ ПЕРЕМАЛЬОВУВАННЯ]")
         code_list = function_map.get(selected_name, [])
 
+        cache_key = _scene_cache_key(selected_name, code_list)
+
+        # Режим порівняння: попередня версія функції (нова функція - порожня), без сторінок
+        diff_with = None
+        if is_diff:
+            diff_with = diff_state["old_map"].get(selected_name, [])
+            page_number = None
+
+        # Режим сторінок: номер сторінки в межах їх кількості
+        page = None
+        if page_number is not None:
+            pages = _flow_pages(ctx, code_list, final_h_scale, final_v_scale, loop_offset_factor, if_offset_factor,
+                                skip_init)
+            page_state["count"] = len(pages)
+            page_count_var.set(f"/ {len(pages)}")
+            page_spinbox.config(to=len(pages))
+            page = min(max(page_number, 1), len(pages)) - 1
+
+        def _on_render_complete():
+            _hide_render_progress()
+            _refresh_perf_panel()
+            if on_complete is not None:
+                on_complete()
+
         # 3. Виклик головної функції малювання з ФІНАЛЬНИМИ масштабами
-        draw_flowchart_with_offset(canvas, code_list,
-                                   final_h_scale, final_v_scale,  # <--- ВИКОРИСТОВУЄМО НОВІ ЗМІННІ
-                                   loop_offset_factor, if_offset_factor, colors,
-                                   skip_init, is_grid_visible)
+        # (Попередній незавершений рендеринг скасовується всередині)
+        scene = draw_flowchart_with_offset(ctx, code_list,
+                                           final_h_scale, final_v_scale,  # <--- ВИКОРИСТОВУЄМО НОВІ ЗМІННІ
+                                           loop_offset_factor, if_offset_factor, colors,
+                                           skip_init, is_grid_visible, cache_key=cache_key,
+                                           on_progress=_show_render_progress, on_complete=_on_render_complete,
+                                           page=page, diff_with=diff_with)
+        _show_diff_status(scene.get("diff"))
 
         # 4. ВИДАЛЯЄМО СТАРИЙ КОД SCALING
         # (Цей блок більше не потрібен, оскільки схема вже намальована у правильному масштабі)
 
         canvas.after(50, _update_minimap_viewport)
+        _show_diagnostics(selected_name)
 
         actual_bbox = canvas.bbox("all")
         if actual_bbox:
@@ -2177,10 +5027,566 @@ def draw_flowchart_window(root, function_map):
                 scrollregion=(actual_bbox[0] - 50, actual_bbox[1] - 50, actual_bbox[2] + 50, actual_bbox[3] + 50))
         else:
             canvas.config(scrollregion=(0, 0, 800, 800))
+
+        # Запам'ятовуємо позиції розкладки (щоб відрізнити ручні переміщення блоків)
+        if watch_var.get():
+            watch_state["layout_positions"] = _collect_block_positions(ctx)
+
+        _on_function_shown(selected_name)
+
+    def _scene_cache_key(func_name, code_list):
+        """Ключ кешу сцени функції: все, що впливає на розкладку (кольори - ні)."""
+        return (func_name, _hash_code_list(code_list), h_scale_var.get() * ctx.scale_x,
+                v_scale_var.get() * ctx.scale_y, loop_offset_var.get(), if_offset_var.get(), ctx.text_scale,
+                skip_init_var.get())
+
+    def _redraw_on(trigger):
+        """Обробник (trace/command) для перемальовування з відомим джерелом."""
+        return lambda *args: update_drawing(*args, trigger=trigger)
+
+    # --- 4.3.2. Панель продуктивності ---
+
+    def _toggle_perf_panel():
+        """Ховає або показує панель продуктивності (поверх полотна, зліва вгорі)."""
+        if show_perf_var.get():
+            perf_frame.place(x=10, y=10, anchor="nw")
+            _refresh_perf_panel()
+        else:
+            perf_frame.place_forget()
+            if perf_state["job"]:
+                draw_window.after_cancel(perf_state["job"])
+                perf_state["job"] = None
+
+    def _refresh_perf_panel():
+        """Оновлює звіт у панелі (і періодично - поки вона показана)."""
+        if perf_state["job"]:
+            draw_window.after_cancel(perf_state["job"])
+            perf_state["job"] = None
+        if not show_perf_var.get():
+            return
+        perf_text.config(state="normal")
+        perf_text.delete("1.0", tk.END)
+        perf_text.insert("1.0", PERF.report())
+        perf_text.config(state="disabled")
+        perf_state["job"] = draw_window.after(PERF_PANEL_REFRESH_MS, _refresh_perf_panel)
+
+    def _reset_perf():
+        PERF.reset()
+        _refresh_perf_panel()
+
+    def save_perf_json():
+        """Зберігає виміри продуктивності в JSON (для порівняння між запусками)."""
+        json_path = filedialog.asksaveasfilename(title="Зберегти виміри продуктивності",
+                                                 initialfile="perf.json", defaultextension=".json",
+                                                 filetypes=(("JSON files", "*.json"), ("All files", "*.*")))
+        if not json_path: return
+        try:
+            PERF.dump_json(json_path)
+            print(f"✅ Виміри продуктивності збережені: {json_path}")
+        except OSError as e:
+            print(f"❌ Помилка при збереженні вимірів: {e}")
+
+    # --- 4.3.3. Запис та відтворення взаємодії ---
+
+    def _interaction_state():
+        """Стан вікна на початку запису (відтворення починається з нього)."""
+        return {"function": selected_func.get(), "zoom": ctx.scale_x,
+                "view": (canvas.xview()[0], canvas.yview()[0]),
+                "canvas_size": (canvas.winfo_width(), canvas.winfo_height())}
+
+    def _toggle_recording():
+        """Галочка "Запис взаємодії": почати запис / зупинити та зберегти JSON."""
+        recorder = interaction["recorder"]
+        if record_var.get():
+            recorder.start()
+            interaction["state"] = _interaction_state()
+            print("Запис взаємодії розпочато.")
+            return
+        recorder.stop()
+        recording = recorder.recording(**interaction.get("state", {}))
+        print(f"Запис взаємодії зупинено: {len(recording['events'])} подій.")
+        json_path = filedialog.asksaveasfilename(title="Зберегти запис взаємодії", initialfile="interaction.json",
+                                                 defaultextension=".json",
+                                                 filetypes=(("JSON files", "*.json"), ("All files", "*.*")))
+        if not json_path: return
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(recording, f, ensure_ascii=False)
+        print(f"✅ Запис взаємодії збережено: {json_path}")
+
+    def start_replay(recording, on_done, speed=1.0):
+        """
+        Відновлює початковий стан запису (функція, прокрутка) і відтворює події;
+        on_done(звіт) - після останньої події та завершення рендерингу.
+        """
+        state = recording.get("state", {})
+        if abs(state.get("zoom", ctx.scale_x) - ctx.scale_x) > 1e-9:
+            print(f"Увага: запис зроблено при зумі {state['zoom']:.2f}x (зараз {ctx.scale_x:.2f}x) - "
+                  f"координати подій можуть не збігатися.")
+
+        def _replay():
+            if state.get("view"):
+                canvas.xview_moveto(state["view"][0])
+                canvas.yview_moveto(state["view"][1])
+            canvas.update_idletasks()
+            InteractionReplayer(ctx, interaction["widgets"], recording, on_done, speed).start()
+
+        if state.get("function", selected_func.get()) != selected_func.get() and \
+                state["function"] in function_map:
+            selected_func.set(state["function"])
+            update_drawing(on_complete=_replay, trigger="replay")
+        elif ctx.render_job is not None:
+            # (Дочекатися поточного рендерингу)
+            previous = ctx.render_job.on_complete
+            ctx.render_job.on_complete = lambda: (previous and previous(), _replay())
+        else:
+            _replay()
+
+    def replay_recording():
+        """Кнопка "Відтворити запис...": відтворює JSON-запис і зберігає звіт затримок."""
+        json_path = filedialog.askopenfilename(title="Відкрити запис взаємодії",
+                                               filetypes=(("JSON files", "*.json"), ("All files", "*.*")))
+        if not json_path: return
+        with open(json_path, encoding='utf-8') as f:
+            recording = json.load(f)
+
+        def _on_replayed(report):
+            summary = report["all"]
+            if summary["count"]:
+                print(f"Відтворення: {report['events']} подій, p50 {summary['p50_ms']:.1f} мс, "
+                      f"p90 {summary['p90_ms']:.1f} мс, p99 {summary['p99_ms']:.1f} мс, "
+                      f"пропущено кадрів: {report['dropped_frames']}")
+            report_path = filedialog.asksaveasfilename(title="Зберегти звіт відтворення",
+                                                       initialfile="replay_report.json", defaultextension=".json",
+                                                       filetypes=(("JSON files", "*.json"), ("All files", "*.*")))
+            if report_path:
+                with open(report_path, 'w', encoding='utf-8') as f:
+                    json.dump(report, f, ensure_ascii=False, indent=2)
+
+        start_replay(recording, _on_replayed)
+
+    # --- 4.3.4. Облік пам'яті ---
+
+    def open_memory_window():
+        """Вікно зі звітом пам'яті (структури даних, елементи полотна, tracemalloc)."""
+        memory_window = tk.Toplevel(draw_window)
+        memory_window.title("Пам'ять")
+        memory_window.geometry("720x520")
+        memory_window.transient(draw_window)
+        buttons = tk.Frame(memory_window)
+        buttons.pack(side=tk.TOP, fill=tk.X, padx=10, pady=(10, 0))
+        text_frame = tk.Frame(memory_window)
+        text_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        scrollbar = tk.Scrollbar(text_frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        report_text = tk.Text(text_frame, wrap=tk.NONE, yscrollcommand=scrollbar.set, font=("Courier", 9))
+        report_text.pack(fill=tk.BOTH, expand=True)
+        scrollbar.config(command=report_text.yview)
+        current = {}
+
+        def _refresh():
+            current["report"] = memory_report(function_map, ctx)
+            report_text.config(state="normal")
+            report_text.delete("1.0", tk.END)
+            report_text.insert("1.0", format_memory_report(current["report"]))
+            report_text.config(state="disabled")
+
+        def _enable_tracing():
+            start_memory_tracing()
+            _refresh()
+
+        def _save_json():
+            json_path = filedialog.asksaveasfilename(title="Зберегти звіт пам'яті", initialfile="memory.json",
+                                                     defaultextension=".json",
+                                                     filetypes=(("JSON files", "*.json"), ("All files", "*.*")))
+            if not json_path: return
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(current["report"], f, ensure_ascii=False, indent=2)
+            print(f"✅ Звіт пам'яті збережено: {json_path}")
+
+        tk.Button(buttons, text="Оновити", command=_refresh).pack(side=tk.LEFT, padx=2)
+        tk.Button(buttons, text="Увімкнути tracemalloc", command=_enable_tracing).pack(side=tk.LEFT, padx=2)
+        tk.Button(buttons, text="Зберегти JSON", command=_save_json).pack(side=tk.LEFT, padx=2)
+        _refresh()
+
+    def _show_diagnostics(func_name):
+        """Показує помилки розбору вибраної функції у лівій панелі."""
+        diagnostics = []
+        if isinstance(function_map, (LazyFunctionCodeMap, ProjectCodeMap)) and func_name in function_map:
+            diagnostics = function_map.diagnostics(func_name)
+        diagnostics_title_var.set(f"Помилки розбору ({len(diagnostics)})")
+        diagnostics_listbox.delete(0, tk.END)
+        for diagnostic in diagnostics:
+            where = f"Рядок {diagnostic['line']}" if diagnostic["line"] is not None else f"Токен {diagnostic['token']}"
+            near = f" (біля '{diagnostic['near']}')" if diagnostic["near"] else ""
+            diagnostics_listbox.insert(tk.END, f"{where}: {diagnostic['message']}{near}")
+
+    # --- 4.3.5. Навігація за викликами ---
+
+    def _on_function_shown(func_name):
+        """Після малювання: історія навігації та підготовка сцен прямо викликаних функцій."""
+        if nav_state["current"] != func_name:
+            if nav_state["current"] is not None:
+                nav_state["back"].append(nav_state["current"])
+                nav_state["forward"].clear()
+            nav_state["current"] = func_name
+            _update_nav_buttons()
+        _schedule_prefetch(func_name)
+
+    def _navigate(func_name, trigger="navigation"):
+        if func_name not in function_map or func_name == selected_func.get():
+            return
+        selected_func.set(func_name)
+        update_drawing(trigger=trigger)
+
+    def navigate_history(direction):
+        """Назад (-1) або вперед (+1) по історії переглянутих функцій."""
+        source, target = (nav_state["back"], nav_state["forward"]) if direction < 0 else \
+            (nav_state["forward"], nav_state["back"])
+        while source and source[-1] not in function_map:
+            source.pop()  # (Функція зникла після live reload)
+        if not source:
+            return
+        target.append(nav_state["current"])
+        nav_state["current"] = source.pop()  # (Тому _on_function_shown не додасть перехід в історію)
+        _navigate(nav_state["current"], trigger="history")
+        _update_nav_buttons()
+
+    def _update_nav_buttons():
+        back_button.config(state="normal" if nav_state["back"] else "disabled")
+        forward_button.config(state="normal" if nav_state["forward"] else "disabled")
+
+    def _on_call_block_double_click(event):
+        """Подвійний клік по блоку виклику - схема викликаної функції."""
+        abs_x, abs_y = canvas.canvasx(event.x), canvas.canvasy(event.y)
+        for block_id in ctx.geometry.blocks_at(abs_x, abs_y):
+            block = ctx.blocks.get(int(block_id))
+            name = call_target_name(block.text) if block is not None and block.kind == "sub" else None
+            if name is not None:  # (Блоки "Початок/Кінець: ..." підпрограм - теж "sub", але не виклики)
+                callee = resolve_function_key(function_map, selected_func.get(), name)
+                if callee is None:
+                    print(f"Функція '{name}' не знайдена (бібліотечна або з іншого файлу).")
+                    return
+                _navigate(callee)
+                return
+
+    def _schedule_prefetch(func_name):
+        """Ставить у чергу підготовку сцен прямо викликаних функцій (по одній, між подіями вікна)."""
+        if nav_state["prefetch_job"] is not None:
+            draw_window.after_cancel(nav_state["prefetch_job"])
+            nav_state["prefetch_job"] = None
+        if _diff_active():
+            nav_state["prefetch_queue"] = []  # (Сцени порівняння не готуються заздалегідь)
+            return
+        nav_state["prefetch_queue"] = call_graph.callees(function_map, func_name)[:CALL_PREFETCH_MAX]
+        if nav_state["prefetch_queue"]:
+            nav_state["prefetch_job"] = draw_window.after(CALL_PREFETCH_DELAY_MS, _prefetch_next)
+
+    def _prefetch_next():
+        nav_state["prefetch_job"] = None
+        if not nav_state["prefetch_queue"]:
+            return
+        if ctx.render_job is None:  # (Поки поточна схема домальовується - чекаємо)
+            func_name = nav_state["prefetch_queue"].pop(0)
+            code_list = function_map.get(func_name, [])
+            colors = (ellipse_color_var.get(), rect_color_var.get(), rhombus_color_var.get(), sub_color_var.get(),
+                      hex_color_var.get())
+            try:
+                h_scale, v_scale = h_scale_var.get() * ctx.scale_x, v_scale_var.get() * ctx.scale_y
+                # (У режимі сторінок перехід відкриє ту саму сторінку, що й update_drawing)
+                page = None
+                if page_mode_var.get():
+                    pages = _flow_pages(ctx, code_list, h_scale, v_scale, loop_offset_var.get(),
+                                        if_offset_var.get(), skip_init_var.get())
+                    page = min(max(page_var.get(), 1), len(pages)) - 1
+                prefetch_flowchart_scene(ctx, code_list, h_scale, v_scale, loop_offset_var.get(),
+                                         if_offset_var.get(), colors, skip_init_var.get(),
+                                         _scene_cache_key(func_name, code_list), page)
+            except tk.TclError:
+                return
+        if nav_state["prefetch_queue"]:
+            nav_state["prefetch_job"] = draw_window.after(CALL_PREFETCH_DELAY_MS, _prefetch_next)
+
+    # --- 4.3.6. Пошук по блоках усіх функцій ---
+
+    def open_search_window():
+        """Вікно пошуку рядка (токенів) по блоках усіх функцій; вибір результату - схема з блоком у центрі."""
+        if search_state["window"] is not None and search_state["window"].winfo_exists():
+            search_state["window"].deiconify()
+            search_state["window"].lift()
+            search_state["entry"].focus_set()
+            return
+        search_window = tk.Toplevel(draw_window)
+        search_window.title("Пошук по блоках")
+        search_window.geometry("560x420")
+        search_window.transient(draw_window)
+        query_frame = tk.Frame(search_window)
+        query_frame.pack(side=tk.TOP, fill=tk.X, padx=10, pady=(10, 0))
+        tk.Label(query_frame, text="Знайти:").pack(side=tk.LEFT)
+        search_entry = ttk.Entry(query_frame, textvariable=search_query_var)
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
+        tk.Label(search_window, textvariable=search_status_var, anchor="w", font=("Arial", 8)).pack(
+            side=tk.TOP, fill=tk.X, padx=10)
+        results_frame = tk.Frame(search_window)
+        results_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        scrollbar = tk.Scrollbar(results_frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        results_listbox = tk.Listbox(results_frame, yscrollcommand=scrollbar.set, font=("Courier", 9),
+                                     activestyle="none")
+        results_listbox.pack(fill=tk.BOTH, expand=True)
+        scrollbar.config(command=results_listbox.yview)
+
+        def _open_selected(event=None):
+            selection = results_listbox.curselection()
+            index = selection[0] if selection else 0
+            if index < len(search_state["hits"]):
+                _open_search_hit(*search_state["hits"][index])
+
+        def _on_close():
+            if search_state["job"] is not None:
+                draw_window.after_cancel(search_state["job"])
+                search_state["job"] = None
+            search_state["window"] = None
+            search_window.destroy()
+
+        search_entry.bind("<Return>", _open_selected)
+        search_entry.bind("<Down>", lambda event: (results_listbox.focus_set(), results_listbox.selection_set(0)))
+        results_listbox.bind("<Double-Button-1>", _open_selected)
+        results_listbox.bind("<Return>", _open_selected)
+        search_window.protocol("WM_DELETE_WINDOW", _on_close)
+        search_state.update(window=search_window, entry=search_entry, listbox=results_listbox)
+        search_entry.focus_set()
+        _run_search()  # (Індекс будується порціями, поки вікно відкрите, навіть без запиту)
+
+    def _schedule_search(*args):
+        if search_state["window"] is None:
+            return
+        if search_state["job"] is not None:
+            draw_window.after_cancel(search_state["job"])
+        search_state["job"] = draw_window.after(SEARCH_DEBOUNCE_MS, _run_search)
+
+    def _run_search():
+        """Доіндексовує порцію функцій (або шукає, якщо індекс повний) та показує результати."""
+        search_state["job"] = None
+        if search_state["window"] is None:
+            return
+        if not search_index.update(function_map, SEARCH_INDEX_BUDGET_MS):
+            done, total = search_index.progress()
+            search_status_var.set(f"Індексування: {done}/{total} функцій")
+            search_state["job"] = draw_window.after(1, _run_search)
+            return
+        hits, total = search_index.search(search_query_var.get())
+        search_state["hits"] = hits
+        listbox = search_state["listbox"]
+        listbox.delete(0, tk.END)
+        for func_name, line in hits:
+            label = function_map.label(func_name) if isinstance(function_map, ProjectCodeMap) else func_name
+            listbox.insert(tk.END, f"{label}: {function_map[func_name][line].strip()}")
+        shown = f" (показано {len(hits)})" if total > len(hits) else ""
+        search_status_var.set(f"Знайдено блоків: {total}{shown}" if search_query_var.get().strip() else
+                              f"Проіндексовано функцій: {len(function_map)}")
+
+    def _open_search_hit(func_name, line):
+        """Показує схему функції (потрібну сторінку) і центрує блок рядка line."""
+        if func_name not in function_map:
+            return
+        selected_func.set(func_name)
+        if page_mode_var.get():
+            code_list = function_map[func_name]
+            pages = _flow_pages(ctx, code_list, h_scale_var.get() * ctx.scale_x, v_scale_var.get() * ctx.scale_y,
+                                loop_offset_var.get(), if_offset_var.get(), skip_init_var.get())
+            page_number = page_of_line(ctx, code_list, pages, skip_init_var.get(), line) + 1
+            if page_var.get() != page_number:
+                page_var.set(page_number)  # (Перемальовування за trace; нижче - вже з кешу сцен)
+        update_drawing(on_complete=lambda: _center_block(block_at_line(ctx, line)), trigger="search")
+
+    def _center_block(block_id):
+        """Прокручує полотно так, щоб блок був у центрі видимої області, і ненадовго виділяє його."""
+        block = ctx.blocks.get(block_id)
+        if block is None:
+            return
+        center_x, center_y = block.center()
+        _scroll_canvas_to(center_x - canvas.winfo_width() / 2, center_y - canvas.winfo_height() / 2)
+        canvas.delete("search_hit")
+        x0, y0, x1, y1 = block.rect
+        canvas.create_rectangle(x0 - 4, y0 - 4, x1 + 4, y1 + 4, outline="red", width=3, tags="search_hit")
+        canvas.after(SEARCH_HIGHLIGHT_MS, lambda: canvas.delete("search_hit"))
+
+    # --- 4.3.7. Порівняння з попередньою версією файлу ---
+
+    def _diff_active():
+        return diff_var.get() and diff_state["old_map"] is not None
+
+    def _diff_function_statuses():
+        """Стани функцій поточної мапи відносно старої версії (заново - лише після live reload)."""
+        if diff_state["new_map"] is not function_map:
+            diff_state["functions"], diff_state["removed"] = diff_function_maps(diff_state["old_map"], function_map)
+            diff_state["new_map"] = function_map
+        return diff_state["functions"]
+
+    def compare_with_version(old_path=None):
+        """Завантажує попередню версію файлу та вмикає порівняння. Без old_path - діалог вибору файлу."""
+        if not old_path:
+            old_path = filedialog.askopenfilename(title="Попередня версія C-файлу",
+                                                  filetypes=(("C files", "*.c"), ("All files", "*.*")))
+        if not old_path:
+            return
+        try:
+            diff_state["old_map"] = load_c_source(old_path)
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Не вдалося прочитати {old_path}: {e}")
+            return
+        diff_state.update(old_path=old_path, new_map=None)
+        statuses = _diff_function_statuses()
+        changed = [name for name, status in statuses.items() if status != "same"]
+        print(f"Порівняння з {old_path}: змінені/нові функції: {', '.join(changed) or '-'}; "
+              f"вилучені: {', '.join(diff_state['removed']) or '-'}")
+        diff_checkbox.config(state="normal")
+        diff_var.set(True)
+        _toggle_diff()
+
+    def _toggle_diff():
+        _refresh_function_menu()
+        update_drawing(trigger="diff")
+
+    def _show_diff_status(counts):
+        """Підсумок порівняння поточної функції та файлу (або нічого поза режимом порівняння)."""
+        if counts is None:
+            diff_status_var.set("")
+            return
+        changed = sum(1 for status in _diff_function_statuses().values() if status != "same")
+        diff_status_var.set(f"Порівняння з {os.path.basename(diff_state['old_path'])}: блоки +{counts['added']} "
+                            f"-{counts['removed']} ~{counts['modified']}; функцій змінено {changed}, "
+                            f"вилучено {len(diff_state['removed'])}")
+
+    # --- 4.3.1. Стеження за файлом (live reload) ---
+
+    def _toggle_watch():
+        """Вмикає або вимикає періодичну перевірку вихідного файлу."""
+        if watch_state["job"]:
+            draw_window.after_cancel(watch_state["job"])
+            watch_state["job"] = None
+        if not watch_var.get() or not source_path:
+            return
+
+        # Повне лексування поточної версії файлу (база для інкрементальних оновлень)
+        watch_state["lexed"] = None
+        watch_state["signature"] = _source_signature()
+        watch_state["layout_positions"] = _collect_block_positions(ctx)
+        _reload_source_file()
+        watch_state["job"] = draw_window.after(WATCH_POLL_MS, _poll_source_file)
+
+    def _source_signature():
+        """(mtime, розмір) файлу або None, якщо файл недоступний."""
+        try:
+            stat = os.stat(source_path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def _poll_source_file():
+        """Періодична перевірка: чи змінився файл з моменту останнього читання."""
+        watch_state["job"] = None
+        if not watch_var.get():
+            return
+        signature = _source_signature()
+        if signature is not None and signature != watch_state["signature"]:
+            watch_state["signature"] = signature
+            _reload_source_file()
+        watch_state["job"] = draw_window.after(WATCH_POLL_MS, _poll_source_file)
+
+    def _reload_source_file():
+        """
+        Перечитує файл (перелексовуючи лише змінені рядки) та перемальовує
+        поточну схему, лише якщо змінилась саме ця функція.
+        """
+        nonlocal function_map
+        global FUNCTION_CODE_MAP
+
+        try:
+            new_map, lexed, changed = reload_c_source(function_map, watch_state["lexed"], source_path)
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Live reload failed: {e}")
+            return
+        watch_state["lexed"] = lexed
+
+        if "main" not in new_map:
+            print("Live reload: функція 'main' не знайдена, схема не оновлюється.")
+            return
+
+        function_map = new_map
+        FUNCTION_CODE_MAP = new_map
+        _refresh_function_menu()
+
+        if changed:
+            print(f"Live reload: змінені функції: {', '.join(changed)}")
+
+        selected_name = selected_func.get()
+        if selected_name not in function_map:
+            selected_func.set("main")
+            _redraw_preserving_view()
+        elif selected_name in changed:
+            _redraw_preserving_view()
+
+    def _refresh_function_menu(*args):
+        """Оновлює список функцій у випадаючому меню (лише ті, що відповідають пошуку)."""
+        menu = dropdown["menu"]
+        menu.delete(0, "end")
+        marks = _diff_function_statuses() if _diff_active() else {}
+        for name in _matching_functions():
+            label = function_map.label(name) if isinstance(function_map, ProjectCodeMap) else name
+            menu.add_command(label=DIFF_MENU_MARKS.get(marks.get(name), "") + label,
+                             command=tk._setit(selected_func, name, _redraw_on("function")))
+
+    def _matching_functions():
+        """Функції для меню: за рядком пошуку (у проекті - за індексом, без завантаження тіл)."""
+        if isinstance(function_map, ProjectCodeMap):
+            return function_map.search(function_filter_var.get())
+        text = function_filter_var.get().strip().lower()
+        return [name for name in function_map if text in name.lower()][:FUNCTION_MENU_MAX_ITEMS]
+
+    def _select_first_match(event=None):
+        """Enter у полі пошуку: показати першу знайдену функцію."""
+        matches = _matching_functions()
+        if matches and matches[0] != selected_func.get():
+            selected_func.set(matches[0])
+            update_drawing(trigger="function")
+
+    def _redraw_preserving_view():
+        """
+        Перемальовує схему, зберігаючи позицію прокрутки та ручні переміщення
+        блоків (для блоків, ідентичність яких збереглася).
+        """
+        # 1. Зсуви блоків, переміщених користувачем відносно розкладки
+        manual_moves = {}
+        layout_positions = watch_state["layout_positions"]
+        for identity, (_, x, y) in _collect_block_positions(ctx).items():
+            if identity in layout_positions:
+                _, layout_x, layout_y = layout_positions[identity]
+                if (x, y) != (layout_x, layout_y):
+                    manual_moves[identity] = (x - layout_x, y - layout_y)
+
+        # 2. Поточна видима точка полотна (лівий верхній кут)
+        view_x, view_y = canvas.canvasx(0), canvas.canvasy(0)
+
+        def _restore_view():
+            # 3. Повторно застосовуємо ручні переміщення
+            new_positions = watch_state["layout_positions"]
+            for identity, (dx, dy) in manual_moves.items():
+                if identity in new_positions:
+                    _move_block_with_arrows(ctx, new_positions[identity][0], dx, dy)
+
+            # 4. Відновлюємо прокрутку
+            _scroll_canvas_to(view_x, view_y)
+
+        # (Кроки 3-4 - після того, як схема намальована повністю)
+        update_drawing(on_complete=_restore_view, trigger="live_reload")
 # --- 4.4. Обробники Drag & Drop (Блоки та Стрілки) ---
 
     def _on_block_drag_start(event):
         """Викликається при натисканні ЛКМ на полотні."""
+        if ctx.render_job is not None:
+            return  # (Схема ще малюється частинами - стрілки частини блоків ще не створені)
+
         # Отримуємо "абсолютні" координати на полотні (з урахуванням прокрутки)
         x_canvas_offset = canvas.canvasx(0)
         y_canvas_offset = canvas.canvasy(0)
@@ -2196,7 +5602,7 @@ def draw_flowchart_window(root, function_map):
             tags = canvas.gettags(obj_id)
             if "flow_arrow" in tags:
                 arrow_id = obj_id
-                arrow_coords = list(canvas.coords(arrow_id))
+                arrow_coords = ctx.geometry.edge_coords(arrow_id)
 
                 # Перевіряємо, чи клік знаходиться близько до однієї з вершин стрілки
                 point_index = -1
@@ -2208,10 +5614,10 @@ def draw_flowchart_window(root, function_map):
 
                 if point_index != -1:
                     # Знайшли точку стрілки! Починаємо її редагування.
-                    drag_data["arrow_id"] = arrow_id
-                    drag_data["point_index"] = point_index
-                    drag_data["x"] = abs_x
-                    drag_data["y"] = abs_y
+                    ctx.drag["arrow_id"] = arrow_id
+                    ctx.drag["point_index"] = point_index
+                    ctx.drag["x"] = abs_x
+                    ctx.drag["y"] = abs_y
                     canvas.config(cursor="hand2")
 
                     # Зберігаємо поточні координати для редагування
@@ -2225,112 +5631,61 @@ def draw_flowchart_window(root, function_map):
                     return  # Виходимо, пріоритет у стрілки
 
         # --- 2. ПЕРЕВІРКА БЛОКУ (якщо стрілка не знайдена) ---
-        block_id = None;
-        group_tag = None
-        for obj_id in reversed(overlapping):
-            tags = canvas.gettags(obj_id)
-            # Шукаємо фігуру ("block"), але не її текст ("block_text")
-            if "block" in tags and "block_text" not in tags:
-                block_id = obj_id
-                # Знаходимо унікальний тег групи
-                for tag in tags:
-                    if tag.startswith(("sub_", "rect_", "rhombus_", "ell_", "para_", "hex_")):
-                        group_tag = tag
-                        break
-                if group_tag: break
+        # (Векторний пошук за межами блоків; верхній блок - перший)
+        hit_blocks = ctx.geometry.blocks_at(abs_x, abs_y, tolerance=7)
+        block = ctx.blocks[hit_blocks[0]] if hit_blocks else None
 
-        if block_id and group_tag:
+        if block:
             # Знайшли блок! Починаємо його перетягування.
-            drag_data["item"] = (block_id, group_tag)
-            drag_data["x"] = abs_x;
-            drag_data["y"] = abs_y
+            ctx.drag["item"] = block.block_id
+            ctx.drag["x"] = abs_x;
+            ctx.drag["y"] = abs_y
             canvas.config(cursor="hand2")
-            canvas.tag_raise(group_tag)  # Блок та його текст/лінії поверх інших
+            for item_id in block.items:  # Блок та його текст/лінії поверх інших
+                canvas.tag_raise(item_id)
         else:
             # Клікнули на порожньому місці
-            drag_data["item"] = None
+            ctx.drag["item"] = None
 
     def _on_block_drag_move(event):
         """Викликається при русі миші з затиснутою ЛКМ."""
 
         # --- 1. РУХ ТОЧКИ СТРІЛКИ ---
-        if drag_data["arrow_id"] is not None:
+        if ctx.drag["arrow_id"] is not None:
             _on_arrow_point_drag_move(event)
             return
 
         # --- 2. РУХ БЛОКУ ---
-        if drag_data["item"]:
+        if ctx.drag["item"] is not None:
             x_canvas_offset = canvas.canvasx(0)
             y_canvas_offset = canvas.canvasy(0)
             current_abs_x = event.x + x_canvas_offset
             current_abs_y = event.y + y_canvas_offset
-            block_id, group_tag = drag_data["item"]
+            block_id = ctx.drag["item"]
 
             # Розрахунок зсуву (delta)
-            dx = current_abs_x - drag_data["x"]
-            dy = current_abs_y - drag_data["y"]
-
-            # 2.1. Переміщення самого блоку (всіх елементів з group_tag)
-            canvas.move(group_tag, dx, dy)
+            dx = current_abs_x - ctx.drag["x"]
+            dy = current_abs_y - ctx.drag["y"]
 
-            # 2.2. Ручне переміщення *приєднаних* до блоку стрілок
-            if group_tag in BLOCK_TO_ARROWS:
-                for arrow_id in BLOCK_TO_ARROWS[group_tag]:
-                    arrow_id_int = int(arrow_id)
-                    coords = list(canvas.coords(arrow_id_int))
-                    num_points = len(coords) // 2
-                    conn = ARROW_CONNECTIONS.get(arrow_id_int, {})
-
-                    is_source = (conn.get('source_tag') == group_tag)
-                    is_target = (conn.get('target_tag') == group_tag)
-
-                    new_coords = []
-                    for i in range(num_points):
-                        point_x = coords[i * 2]
-                        point_y = coords[i * 2 + 1]
-
-                        # Рухаємо лише ті точки, які прив'язані до *цього* блоку
-                        if (i == 0 and is_source) or \
-                                (i == num_points - 1 and is_target):
-                            new_coords.extend([point_x + dx, point_y + dy])
-
-                        # (Проміжні точки рухаються, якщо хоча б один кінець приєднаний)
-                        elif i > 0 and i < num_points - 1 and (is_source or is_target):
-                            new_coords.extend([point_x + dx, point_y + dy])
-
-                        # (Інший кінець стрілки, приєднаний до іншого блоку, не рухається)
-                        else:
-                            new_coords.extend([point_x, point_y])
-
-                    if new_coords:
-                        canvas.coords(arrow_id_int, *new_coords)
+            # 2.1. Переміщення блоку разом з приєднаними стрілками
+            _move_block_with_arrows(ctx, block_id, dx, dy)
 
             # 2.3. Оновлення останніх координат
-            drag_data["x"] = current_abs_x
-            drag_data["y"] = current_abs_y
+            ctx.drag["x"] = current_abs_x
+            ctx.drag["y"] = current_abs_y
 
     def _on_block_drag_release(event):
         """Викликається при відпусканні ЛКМ."""
 
         # --- 1. ЗВІЛЬНЕННЯ ТОЧКИ СТРІЛКИ ---
-        if drag_data["arrow_id"] is not None:
+        if ctx.drag["arrow_id"] is not None:
             _on_arrow_point_drag_release()
             return
 
         # --- 2. ЗВІЛЬНЕННЯ БЛОКУ (з "прилипанням" до сітки) ---
-        item_data = drag_data["item"]
-        if item_data:
-            block_id, group_tag = item_data
-            canvas.update_idletasks()
-            bbox = canvas.bbox(block_id)
-            if not bbox:
-                drag_data["item"] = None;
-                canvas.config(cursor="");
-                return
-
-            x0, y0, x1, y1 = bbox
-            current_center_x = (x0 + x1) / 2
-            current_center_y = (y0 + y1) / 2
+        block_id = ctx.drag["item"]
+        if block_id is not None:
+            current_center_x, current_center_y = ctx.blocks[block_id].center()
 
             # 2.1. Розрахунок "прилипання" до сітки
             new_x_center = round(current_center_x / GRID_SIZE) * GRID_SIZE
@@ -2340,46 +5695,20 @@ def draw_flowchart_window(root, function_map):
             final_dy = new_y_center - current_center_y
 
             if final_dx != 0 or final_dy != 0:
-                # 2.2. Застосовуємо зсув до блоку
-                canvas.move(group_tag, final_dx, final_dy)
-
-                # 2.3. Застосовуємо той самий зсув до приєднаних стрілок
-                if group_tag in BLOCK_TO_ARROWS:
-                    for arrow_id in BLOCK_TO_ARROWS[group_tag]:
-                        arrow_id_int = int(arrow_id)
-                        coords = list(canvas.coords(arrow_id_int))
-                        num_points = len(coords) // 2
-                        conn = ARROW_CONNECTIONS.get(arrow_id_int, {})
-                        is_source = (conn.get('source_tag') == group_tag)
-                        is_target = (conn.get('target_tag') == group_tag)
-
-                        new_coords = []
-                        for i in range(num_points):
-                            point_x = coords[i * 2];
-                            point_y = coords[i * 2 + 1]
-
-                            # (Логіка ідентична _on_block_drag_move)
-                            if (i == 0 and is_source) or (i == num_points - 1 and is_target):
-                                new_coords.extend([point_x + final_dx, point_y + final_dy])
-                            elif i > 0 and i < num_points - 1 and (is_source or is_target):
-                                new_coords.extend([point_x + final_dx, point_y + final_dy])
-                            else:
-                                new_coords.extend([point_x, point_y])
-
-                        if new_coords:
-                            canvas.coords(arrow_id_int, *new_coords)
+                # 2.2. Застосовуємо зсув до блоку та приєднаних стрілок
+                _move_block_with_arrows(ctx, block_id, final_dx, final_dy)
 
         # Скидання стану
-        drag_data["item"] = None
+        ctx.drag["item"] = None
         canvas.config(cursor="")
         _update_minimap_viewport()
 
     def _on_arrow_point_drag_release():
         """Відпускання точки стрілки (прив'язка або вирівнювання)."""
-        if drag_data["arrow_id"] is None: return
+        if ctx.drag["arrow_id"] is None: return
 
-        arrow_id = drag_data["arrow_id"]
-        point_index = drag_data["point_index"]
+        arrow_id = ctx.drag["arrow_id"]
+        point_index = ctx.drag["point_index"]
         coords = arrow_data["coords"]  # (Координати оновлювалися в _on_arrow_point_drag_move)
         coords_index = point_index * 2
         total_points = len(coords) // 2
@@ -2393,33 +5722,33 @@ def draw_flowchart_window(root, function_map):
         # --- 1. ЛОГІКА ПРИВ'ЯЗКИ (тільки для кінцевих точок) ---
         if is_end_point:
             # Шукаємо, чи є порт блоку під курсором
-            snap_point, block_tag, _ = _snap_to_closest_block_point(canvas, i_x, i_y)
-            current_conn = ARROW_CONNECTIONS.get(arrow_id_int, {'source_tag': None, 'target_tag': None})
+            snap_point, block_id, _ = _snap_to_closest_block_point(ctx, i_x, i_y)
 
-            if block_tag:
+            if block_id is not None:
                 # 1.1. Стрілка ПРИЛИПЛА
                 coords[coords_index] = snap_point[0]
                 coords[coords_index + 1] = snap_point[1]
                 canvas.coords(arrow_id, *coords)
+                ctx.geometry.set_edge_coords(arrow_id, coords)
 
                 # 1.2. Оновлюємо логіку зв'язків
                 if is_source:
-                    _update_arrow_mapping(arrow_id_int, source_tag=block_tag, target_tag=current_conn['target_tag'])
+                    _update_arrow_mapping(ctx, arrow_id_int, source=block_id)
                 else:
-                    _update_arrow_mapping(arrow_id_int, source_tag=current_conn['source_tag'], target_tag=block_tag)
+                    _update_arrow_mapping(ctx, arrow_id_int, target=block_id)
 
                 # Завершуємо редагування
                 canvas.delete("arrow_edit_point");
-                drag_data["arrow_id"] = None
-                drag_data["point_index"] = -1;
+                ctx.drag["arrow_id"] = None
+                ctx.drag["point_index"] = -1;
                 canvas.config(cursor="");
                 return
             else:
                 # 1.3. Стрілка ВІДЛИПЛА (Явно розриваємо зв'язок)
                 if is_source:
-                    _update_arrow_mapping(arrow_id_int, source_tag=False, target_tag=None)
+                    _update_arrow_mapping(ctx, arrow_id_int, source=False)
                 else:
-                    _update_arrow_mapping(arrow_id_int, source_tag=None, target_tag=False)
+                    _update_arrow_mapping(ctx, arrow_id_int, target=False)
 
         # --- 2. ЛОГІКА ВИРІВНЮВАННЯ (для проміжних точок або відлиплих кінців) ---
 
@@ -2463,11 +5792,12 @@ def draw_flowchart_window(root, function_map):
             coords[coords_index + 1] = snap_y
 
         canvas.coords(arrow_id, *coords)
+        ctx.geometry.set_edge_coords(arrow_id, coords)
 
         # Загальне очищення
         canvas.delete("arrow_edit_point");
-        drag_data["arrow_id"] = None
-        drag_data["point_index"] = -1;
+        ctx.drag["arrow_id"] = None
+        ctx.drag["point_index"] = -1;
         canvas.config(cursor="")
 
     def _draw_arrow_points_for_edit(arrow_id, coords):
@@ -2480,14 +5810,14 @@ def draw_flowchart_window(root, function_map):
 
     def _on_arrow_point_drag_move(event):
         """Рух точки стрілки (поки ЛКМ затиснута)."""
-        if drag_data["arrow_id"] is not None:
+        if ctx.drag["arrow_id"] is not None:
             current_abs_x = canvas.canvasx(event.x)
             current_abs_y = canvas.canvasy(event.y)
-            arrow_id = drag_data["arrow_id"]
-            point_index = drag_data["point_index"]
+            arrow_id = ctx.drag["arrow_id"]
+            point_index = ctx.drag["point_index"]
 
-            dx = current_abs_x - drag_data["x"]
-            dy = current_abs_y - drag_data["y"]
+            dx = current_abs_x - ctx.drag["x"]
+            dy = current_abs_y - ctx.drag["y"]
 
             # Оновлюємо координати в тимчасовому списку
             coords = arrow_data["coords"]
@@ -2499,17 +5829,67 @@ def draw_flowchart_window(root, function_map):
             canvas.coords(arrow_id, *coords)
 
             # Оновлюємо позицію для наступного руху
-            drag_data["x"] = current_abs_x
-            drag_data["y"] = current_abs_y
+            ctx.drag["x"] = current_abs_x
+            ctx.drag["y"] = current_abs_y
 
             # Перемальовуємо червоні точки
             _draw_arrow_points_for_edit(arrow_id, coords)
 
+    # --- 4.5. Згортання тіл циклів та розгалужень ---
+
+    def _scroll_canvas_to(view_x, view_y):
+        """Прокручує полотно так, щоб точка (view_x, view_y) стала лівим верхнім кутом видимої області."""
+        try:
+            x0, y0, x1, y1 = (float(v) for v in canvas.cget("scrollregion").split())
+        except ValueError:
+            return
+        if x1 > x0 and y1 > y0:
+            canvas.xview_moveto((view_x - x0) / (x1 - x0))
+            canvas.yview_moveto((view_y - y0) / (y1 - y0))
+        _rebase_view_origin()
+        _update_minimap_viewport()
+
+    def _redraw_keeping_node(line, screen_x, screen_y):
+        """Перемальовує схему, залишаючи блок вузла line у тій самій точці екрана."""
+        def _anchor():
+            for block_id, block_line in ctx.block_nodes.items():
+                if block_line == line:
+                    center_x, center_y = ctx.blocks[block_id].center()
+                    _scroll_canvas_to(center_x - screen_x, center_y - screen_y)
+                    return
+
+        update_drawing(on_complete=_anchor, trigger="collapse")
+
+    def _on_toggle_collapse(event):
+        """ПКМ по умові або циклу - згортає його тіло; по згорнутому блоку - розгортає."""
+        abs_x, abs_y = canvas.canvasx(event.x), canvas.canvasy(event.y)
+        for block_id in ctx.geometry.blocks_at(abs_x, abs_y):
+            block_id = int(block_id)
+            line = ctx.block_nodes.get(block_id)
+            if line is not None:
+                break
+        else:
+            return
+
+        code_list = function_map.get(selected_func.get(), [])
+        if _toggle_collapsed(ctx, code_list, skip_init_var.get(), line) is None:
+            return
+        center_x, center_y = ctx.blocks[block_id].center()
+        _redraw_keeping_node(line, center_x - canvas.canvasx(0), center_y - canvas.canvasy(0))
+
+    def _collapse_all(is_collapsed):
+        """Згортає або розгортає всі цикли та розгалуження поточної функції."""
+        code_list = function_map.get(selected_func.get(), [])
+        _set_all_collapsed(ctx, code_list, skip_init_var.get(), is_collapsed)
+        update_drawing(trigger="collapse_all")
+
     def update_colors_wrapper(*args):
         """Обгортка для оновлення кольорів (викликається при зміні полів)."""
         colors = (ellipse_color_var.get(), rect_color_var.get(), rhombus_color_var.get(),
                   sub_color_var.get(), hex_color_var.get())
         _update_colors_only(canvas, colors)
+        if ctx.render_job is not None:
+            ctx.render_job.set_colors(colors)
 
     def toggle_grid_closure():
         """Обгортка для перемикання сітки (для чекбоксу)."""
@@ -2525,9 +5905,30 @@ def draw_flowchart_window(root, function_map):
     minimap_canvas.pack(fill=tk.BOTH, expand=1)
     minimap_canvas.create_rectangle(0, 0, 1, 1, outline="red", width=2, tags="viewport");
 
+    # 5.1.1. Панель продуктивності (розміщується в _toggle_perf_panel)
+    perf_frame = tk.Frame(canvas_frame, bd=1, relief="sunken", bg="white")
+    perf_text = tk.Text(perf_frame, width=70, height=20, font=("Courier", 8), state="disabled")
+    perf_text.pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+    perf_buttons = tk.Frame(perf_frame, bg="white")
+    perf_buttons.pack(side=tk.TOP, fill=tk.X)
+    tk.Button(perf_buttons, text="Скинути", command=_reset_perf).pack(side=tk.LEFT, padx=2, pady=2)
+    tk.Button(perf_buttons, text="Зберегти JSON", command=save_perf_json).pack(side=tk.LEFT, padx=2, pady=2)
+
     # 5.2. Панель керування (Control Frame)
-    dropdown = tk.OptionMenu(control_frame, selected_func, *function_names, command=update_drawing)
+    back_button = tk.Button(control_frame, text="◀", width=2, state="disabled", command=lambda: navigate_history(-1))
+    back_button.pack(side=tk.LEFT, padx=(5, 0), anchor="n")
+    forward_button = tk.Button(control_frame, text="▶", width=2, state="disabled",
+                               command=lambda: navigate_history(1))
+    forward_button.pack(side=tk.LEFT, anchor="n")
+    tk.Label(control_frame, text="Пошук:").pack(side=tk.LEFT, padx=(5, 0), anchor="n")
+    function_filter_entry = ttk.Entry(control_frame, width=14, textvariable=function_filter_var)
+    function_filter_entry.pack(side=tk.LEFT, anchor="n")
+    function_filter_entry.bind("<Return>", _select_first_match)
+    dropdown = tk.OptionMenu(control_frame, selected_func, *function_names[:FUNCTION_MENU_MAX_ITEMS],
+                             command=_redraw_on("function"))
     dropdown.pack(side=tk.LEFT, padx=5, anchor="n")
+    _refresh_function_menu()
+    function_filter_var.trace_add("write", _refresh_function_menu)
 
     scale_frame = tk.Frame(control_frame);
     scale_frame.pack(side=tk.LEFT, padx=10)
@@ -2578,28 +5979,65 @@ def draw_flowchart_window(root, function_map):
     ttk.Entry(color_frame, width=8, textvariable=hex_color_var).pack(side=tk.LEFT, padx=(2, 5))
     ttk.Checkbutton(color_frame, text="Пропускати Ініціалізацію", variable=skip_init_var).pack(side=tk.LEFT,
                                                                                                padx=(20, 5))
+    ttk.Checkbutton(color_frame, text="Сторінки", variable=page_mode_var).pack(side=tk.LEFT, padx=(20, 2))
+    page_spinbox = ttk.Spinbox(color_frame, from_=1, to=1, width=4, textvariable=page_var)
+    page_spinbox.pack(side=tk.LEFT)
+    tk.Label(color_frame, textvariable=page_count_var).pack(side=tk.LEFT, padx=(2, 5))
+    diff_checkbox = ttk.Checkbutton(color_frame, text="Порівняння", variable=diff_var, command=_toggle_diff,
+                                    state="disabled")
+    diff_checkbox.pack(side=tk.LEFT, padx=(20, 2))
+    tk.Label(color_frame, textvariable=diff_status_var, font=("Arial", 8)).pack(side=tk.LEFT, padx=(2, 5))
     tk.Label(scale_frame, text="| Zoom:").pack(side=tk.LEFT, padx=(20, 0))
     ttk.Entry(scale_frame, width=6, textvariable=zoom_display_var, state='readonly').pack(side=tk.LEFT, padx=(2, 5))
+
+    # Індикатор поступового рендерингу (показується лише під час малювання великої схеми)
+    render_progress_bar = ttk.Progressbar(control_frame, length=120, mode="determinate", maximum=100.0,
+                                          variable=render_progress_var)
+    render_status_label = tk.Label(control_frame, textvariable=render_status_var, font=("Arial", 8))
     # 5.4. Ліва панель (Кнопки)
     tk.Label(left_toolbar_frame, text="Збереження", font=("Arial", 11, "bold")).pack(pady=5)
     tk.Button(left_toolbar_frame, text="Повна БС (.png)", command=save_full_diagram_ps).pack(fill=tk.X, pady=3, padx=7)
     tk.Button(left_toolbar_frame, text="Видима БС (.png)", command=save_visible_diagram_png).pack(fill=tk.X, pady=3,
                                                                                                   padx=7)
     tk.Button(left_toolbar_frame, text="Експорт в .drawio", command=save_as_drawio).pack(fill=tk.X, pady=3, padx=7)
+    tk.Button(left_toolbar_frame, text="Сторінки (.png + .drawio)", command=save_pages).pack(fill=tk.X, pady=3, padx=7)
     tk.Button(left_toolbar_frame, text="Псевдокод (.txt)", command=save_pseudocode).pack(fill=tk.X, pady=3, padx=7)
 
     ttk.Checkbutton(left_toolbar_frame, text="Показати міні-карту", variable=show_minimap_var,
                     command=_toggle_minimap).pack(fill=tk.X, pady=3, padx=7)
     ttk.Checkbutton(left_toolbar_frame, text="Сітка", variable=grid_visible_var,
                     command=toggle_grid_closure).pack(fill=tk.X, padx=5, pady=5)
+    ttk.Checkbutton(left_toolbar_frame, text="Стежити за файлом", variable=watch_var, command=_toggle_watch,
+                    state="normal" if source_path else "disabled").pack(fill=tk.X, padx=5, pady=5)
+    ttk.Checkbutton(left_toolbar_frame, text="Продуктивність", variable=show_perf_var,
+                    command=_toggle_perf_panel).pack(fill=tk.X, padx=5, pady=5)
+    ttk.Checkbutton(left_toolbar_frame, text="Запис взаємодії", variable=record_var,
+                    command=_toggle_recording).pack(fill=tk.X, padx=5, pady=5)
+    tk.Button(left_toolbar_frame, text="Відтворити запис...", command=replay_recording).pack(fill=tk.X, pady=3,
+                                                                                          padx=7)
+    tk.Button(left_toolbar_frame, text="Пам'ять...", command=open_memory_window).pack(fill=tk.X, pady=3, padx=7)
+    tk.Button(left_toolbar_frame, text="Пошук по блоках...", command=open_search_window).pack(fill=tk.X, pady=3,
+                                                                                              padx=7)
+    tk.Button(left_toolbar_frame, text="Порівняти з версією...", command=compare_with_version,
+              state="disabled" if is_project else "normal").pack(fill=tk.X, pady=3, padx=7)
+    tk.Button(left_toolbar_frame, text="Згорнути всі тіла", command=lambda: _collapse_all(True)).pack(fill=tk.X, pady=3,
+                                                                                                    padx=7)
+    tk.Button(left_toolbar_frame, text="Розгорнути всі", command=lambda: _collapse_all(False)).pack(fill=tk.X, pady=3,
+                                                                                                  padx=7)
     ttk.Separator(left_toolbar_frame, orient='horizontal').pack(fill=tk.X, pady=10, padx=5)
     tk.Button(left_toolbar_frame, text="Допомога", command=open_help_window).pack(fill=tk.X, pady=3, padx=7)
 
+    # 5.1. Помилки розбору поточної функції
+    ttk.Separator(left_toolbar_frame, orient='horizontal').pack(fill=tk.X, pady=10, padx=5)
+    tk.Label(left_toolbar_frame, textvariable=diagnostics_title_var, font=("Arial", 10, "bold")).pack(pady=(0, 3))
+    diagnostics_listbox = tk.Listbox(left_toolbar_frame, height=10, font=("Arial", 8), activestyle="none")
+    diagnostics_listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=(0, 5))
+
     # --- 6. ПРИВ'ЯЗКА ПОДІЙ (BINDING) ---
 
     # 6.1. Скролбари та Міні-карта
-    v_scroll.config(command=lambda *a: (canvas.yview(*a), _update_minimap_viewport()))
-    h_scroll.config(command=lambda *a: (canvas.xview(*a), _update_minimap_viewport()))
+    v_scroll.config(command=lambda *a: (canvas.yview(*a), _rebase_view_origin(), _update_minimap_viewport()))
+    h_scroll.config(command=lambda *a: (canvas.xview(*a), _rebase_view_origin(), _update_minimap_viewport()))
     minimap_canvas.bind("<Button-1>", _on_minimap_click)
     minimap_canvas.bind("<B1-Motion>", _on_minimap_click)
 
@@ -2607,6 +6045,12 @@ def draw_flowchart_window(root, function_map):
     canvas.bind("<ButtonPress-1>", _on_block_drag_start);
     canvas.bind("<B1-Motion>", _on_block_drag_move);
     canvas.bind("<ButtonRelease-1>", _on_block_drag_release)
+    canvas.bind("<ButtonPress-3>", _on_toggle_collapse)  # (ПКМ - згорнути/розгорнути тіло)
+    canvas.bind("<Double-Button-1>", _on_call_block_double_click)  # (Подвійний клік по виклику - його схема)
+    draw_window.bind("<Alt-Left>", lambda event: navigate_history(-1))
+    draw_window.bind("<Alt-Right>", lambda event: navigate_history(1))
+    draw_window.bind("<Control-f>", lambda event: open_search_window())
+    search_query_var.trace_add("write", _schedule_search)
 
     # 6.3. Панорамування (Pan)
     canvas.bind("<ButtonPress-2>", _on_pan_start);  # (Середня кнопка)
@@ -2630,9 +6074,11 @@ def draw_flowchart_window(root, function_map):
     canvas.bind("<Shift-Button-5>", _on_horizontal_scroll)
 
     # 6.6. Оновлення від повзунків/чекбоксів (Trace/Command)
-    loop_offset_var.trace_add("write", update_drawing)
-    if_offset_var.trace_add("write", update_drawing)
-    skip_init_var.trace_add("write", update_drawing)
+    loop_offset_var.trace_add("write", _redraw_on("loop_offset"))
+    if_offset_var.trace_add("write", _redraw_on("if_offset"))
+    skip_init_var.trace_add("write", _redraw_on("skip_init"))
+    page_mode_var.trace_add("write", _redraw_on("page_mode"))
+    page_var.trace_add("write", _redraw_on("page"))
 
     # (Для миттєвого оновлення кольорів)
     ellipse_color_var.trace_add("write", update_colors_wrapper);
@@ -2643,14 +6089,26 @@ def draw_flowchart_window(root, function_map):
     global_text_scale_var.trace_add("write", update_text_scale_and_redraw)
 
     # (Command для Scale, щоб спрацьовувало при русі повзунка)
-    h_slider.config(command=update_drawing)
-    v_slider.config(command=update_drawing)
-    loop_slider.config(command=update_drawing)
-    if_slider.config(command=update_drawing)
+    h_slider.config(command=_redraw_on("h_scale"))
+    v_slider.config(command=_redraw_on("v_scale"))
+    loop_slider.config(command=_redraw_on("loop_offset"))
+    if_slider.config(command=_redraw_on("if_offset"))
     text_scale_slider.config(command=update_text_scale_and_redraw)
 
+    # 6.7. Віджети, події яких записуються та відтворюються
+    interaction["widgets"] = {"canvas": canvas, "minimap": minimap_canvas, "h_slider": h_slider,
+                              "v_slider": v_slider, "loop_slider": loop_slider, "if_slider": if_slider,
+                              "text_scale_slider": text_scale_slider}
+    interaction["recorder"] = InteractionRecorder(interaction["widgets"])
+
     # --- 7. ПЕРШИЙ ЗАПУСК ---
-    update_drawing()
+    if diff_path:
+        compare_with_version(diff_path)
+    if not _diff_active():
+        update_drawing(trigger="startup")
+
+    # (Для сценаріїв без GUI-діалогів, напр. benchmarks/replay.py)
+    return {"window": draw_window, "ctx": ctx, "start_replay": start_replay}
 
 
 # --- 10. ЗАПУСК ПРОГРАМИ ТА ЕКСПОРТ В DRAW.IO ---
@@ -2660,7 +6118,8 @@ def select_file_and_read_words_v30(root):
     Головна функція запуску:
     1. Відкриває діалог вибору файлу.
     2. Читає C-код.
-    3. Запускає токенізацію та парсинг.
+    3. Запускає токенізацію та пошук функцій (або бере їх з дискового кешу;
+       тіла парсяться ліниво).
     4. Запускає вікно GUI (draw_flowchart_window).
     """
     global FUNCTION_CODE_MAP
@@ -2679,85 +6138,16 @@ def select_file_and_read_words_v30(root):
     if file_path:
         print(f"File selected: {file_path}")
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                full_text = f.read()
-
-            # --- PREPROCESSING (Tokenization) ---
-            # (Ця логіка дублює 'tokenize_code', але працює)
-            full_text = re.sub(r'//.*', '', full_text)  # Видалення // коментарів
-
-            # Додавання пробілів навколо операторів
-            symbols_to_separate = ['(', ')', '[', ']', ';', '=', ',', '&', '<', '>', '!', '+', '-', '{', '}', '|']
-            for symbol in symbols_to_separate:
-                full_text = full_text.replace(symbol, f' {symbol} ')
-            full_text = full_text.replace('!=', ' != ')
-            full_text = full_text.replace('==', ' == ')
-            full_text = full_text.replace('<=', ' <= ')
-            full_text = full_text.replace('>=', ' >= ')
-            full_text = full_text.replace('++', ' ++ ')
-            full_text = full_text.replace('--', ' -- ')
-            full_text = full_text.replace('+=', ' += ')
-            full_text = full_text.replace('-=', ' -= ')
-            full_text = full_text.replace('||', ' || ')
-            full_text = full_text.replace('&&', ' && ')
-
-            symbols = ['(', ')', '{', '}', ';', ',', '=', '+', '-', '*', '/', '>', '<', '!']
-            for sym in symbols:
-                full_text = full_text.replace(sym, f' {sym} ')
-
-            tokens = full_text.split()
-
-            # Фільтрація /* ... */ та #define
-            filtered_tokens = []
-            in_comment = False
-            in_define = False
-            for token in tokens:
-                if token.startswith('/*'): in_comment = True; continue
-                if token.endswith('*/'): in_comment = False; continue
-                if token.startswith('#'): in_define = True; continue
-                if in_define and token.endswith('\\'): continue
-                if in_define and not token.endswith('\\'): in_define = False; continue
-                if not in_comment and not in_define:
-                    filtered_tokens.append(token)
-
-            word_list = filtered_tokens  # (Це фінальний список токенів)
-            # --- END PREPROCESSING ---
-
-            # Знаходимо всі функції в коді
-            function_map = find_function_bodies(word_list)
-
-            # Парсимо тіло кожної знайденої функції
-            FUNCTION_CODE_MAP = {}
-            for func_name, data in function_map.items():
-                try:
-                    tokens = data["body"]
-                    arg_tokens = data["args"]
-
-                    # Запускаємо парсер C -> Псевдокод
-                    parsed_list = parse_token_list(tokens, depth=0)
-
-                    final_list = []
-                    arg_string = " ".join(arg_tokens)
-                    if len(arg_string) > 30:
-                        arg_string = arg_string[:27] + "..."
-
-                    # Додаємо "Початок" та "Кінець"
-                    if func_name == "main":
-                        final_list.append("Початок")
-                        final_list.extend(parsed_list)
-                        final_list.append("Кінець")
-                    else:
-                        final_list.append(f"Початок: {func_name}({arg_string})")
-                        final_list.extend(parsed_list)
-                        final_list.append(f"Кінець: {func_name}({arg_string})")
+            FUNCTION_CODE_MAP = load_c_source(file_path)
 
-                    FUNCTION_CODE_MAP[func_name] = final_list
-                except Exception as e_inner:
-                    print(f"Error while parsing function '{func_name}': {e_inner}")
+            # Для великих файлів решту функцій парсимо у фоні (паралельно)
+            if FUNCTION_CODE_MAP.body_token_count() >= PARALLEL_PARSE_MIN_TOKENS and \
+                    not FUNCTION_CODE_MAP.is_fully_parsed():
+                threading.Thread(target=FUNCTION_CODE_MAP.parse_all_and_save_cache, daemon=True).start()
 
-            print("Parsing complete. Launching flowchart viewer...")
+            print(f"Found {len(FUNCTION_CODE_MAP)} function(s). Launching flowchart viewer...")
             # Запускаємо GUI
-            draw_flowchart_window(root, FUNCTION_CODE_MAP)
+            draw_flowchart_window(root, FUNCTION_CODE_MAP, source_path=file_path)
 
         except FileNotFoundError:
             print(f"Error: File not found at {file_path}")
@@ -2769,20 +6159,59 @@ def select_file_and_read_words_v30(root):
         root.destroy()
 
 
+def select_project_and_open(root, directory=None):
+    """
+    Режим проекту: індексує всі C-файли каталогу (паралельно) і відкриває
+    вікно з пошуком функцій по всьому проекту. Без directory - діалог вибору каталогу.
+    """
+    global FUNCTION_CODE_MAP
+
+    if not directory:
+        directory = filedialog.askdirectory(title="Select a C project directory")
+    if not directory:
+        print("No directory was selected.")
+        root.destroy()
+        return
+
+    start = time.perf_counter()
+    FUNCTION_CODE_MAP = index_project(directory)
+    for file_path, error in FUNCTION_CODE_MAP.errors.items():
+        print(f"Skipped {file_path}: {error}")
+    print(f"Indexed {FUNCTION_CODE_MAP.file_count} file(s), {len(FUNCTION_CODE_MAP)} function(s) "
+          f"in {time.perf_counter() - start:.2f} s. Launching flowchart viewer...")
+    draw_flowchart_window(root, FUNCTION_CODE_MAP)
+
+
+def compare_files_and_open(root, old_path, new_path):
+    """Режим порівняння: відкриває new_path зі змінами відносно old_path, виділеними на схемах."""
+    global FUNCTION_CODE_MAP
+
+    try:
+        FUNCTION_CODE_MAP = load_c_source(new_path)
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"Error: cannot read {new_path}: {e}")
+        root.destroy()
+        return
+    print(f"Found {len(FUNCTION_CODE_MAP)} function(s). Comparing with {old_path}...")
+    draw_flowchart_window(root, FUNCTION_CODE_MAP, source_path=new_path, diff_path=old_path)
+
+
 # --- 10.1. Логіка експорту в DRAW.IO XML ---
 
-DRAWIO_HEADER = """<mxfile host="app.diagrams.net">
-  <diagram id="DIAGRAM_ID" name="{page_name}">
+DRAWIO_FILE_HEADER = """<mxfile host="app.diagrams.net">
+"""
+DRAWIO_PAGE_HEADER = """  <diagram id="{diagram_id}" name="{page_name}">
     <mxGraphModel dx="1400" dy="800" grid="1" gridSize="10" guides="1" tooltips="1" connect="1" arrows="1" fold="1" page="1" pageScale="1" pageWidth="850" pageHeight="1100" math="0" shadow="0">
       <root>
         <mxCell id="0" />
         <mxCell id="1" parent="0" />
 """
-DRAWIO_FOOTER = """
+DRAWIO_PAGE_FOOTER = """
       </root>
     </mxGraphModel>
   </diagram>
-</mxfile>
+"""
+DRAWIO_FILE_FOOTER = """</mxfile>
 """
 # Співвідношення стилів tkinter та draw.io
 STYLES = {
@@ -2792,12 +6221,15 @@ STYLES = {
     "sub": "shape=process;whiteSpace=wrap;html=1;fillColor=#CCEEFF;strokeColor=#000000;",
     "hex": "shape=hexagon;perimeter=hexagonPerimeter2;whiteSpace=wrap;html=1;fillColor=#D8BFD8;strokeColor=#000000;",
     "para": "shape=parallelogram;perimeter=parallelogramPerimeter;whiteSpace=wrap;html=1;fillColor=#CCEEFF;strokeColor=#000000;",
+    "fold": "rounded=0;whiteSpace=wrap;html=1;dashed=1;strokeWidth=2;fillColor=#FFFFE0;strokeColor=#000000;",
+    "conn": "shape=offPageConnector;whiteSpace=wrap;html=1;fillColor=#FFFFFF;strokeColor=#000000;",
     "arrow": "edgeStyle=orthogonalEdgeStyle;rounded=0;html=1;endArrow=classic;strokeColor=#000000;"
 }
 
 
 def _calculate_relative_point(abs_x, abs_y, bbox):
     """
+    (Не використовується, див. GeometryStore.relative_points)
     Перетворює абсолютні координати (кінці стрілки) на відносні (0..1)
     відносно меж (bbox) батьківського блоку (для draw.io).
     """
@@ -2868,103 +6300,807 @@ def _xml_block(id_num, text, style_key, x, y, w, h):
     )
 
 
-def generate_drawio_xml_from_canvas(canvas, page_name="Page-1"):
+@PERF.timed("export_drawio")
+def _drawio_page_xml(ctx, page_name="Page-1", diagram_id="DIAGRAM_ID"):
     """
-    Генерує XML-файл .drawio на основі поточного стану полотна.
+    Генерує сторінку (<diagram>) .drawio на основі поточного стану полотна.
 
-    Використовує BLOCK_TEXT_MAP для тексту та ARROW_CONNECTIONS для зв'язків.
+    Використовує реєстр блоків ctx.blocks (тип, текст), сховище геометрії
+    ctx.geometry (межі, точки стрілок) та ctx.arrow_connections для зв'язків.
     """
-    global ARROW_CONNECTIONS
-    global BLOCK_TEXT_MAP
-
+    _finish_scene_render(ctx)  # (Незавершений поступовий рендеринг - домальовуємо)
     id_counter = 10
     xml_elements = []
-    group_tag_to_data = {}  # {group_tag: {"id": drawio_id, "bbox": ...}}
+    block_to_data = {}  # {block_id: {"id": drawio_id}}
 
-    canvas.update_idletasks()
+    # Стиль draw.io за типом блоку
+    style_map = {"ell": "ellipse", "rect": "rect", "rhombus": "rhombus", "sub": "sub", "hex": "hex",
+                 "para": "para", "fold": "fold", "conn": "conn"}
 
-    # 1. Фаза 1: Обробка БЛОКІВ
-    # (Використовуємо find_withtag, щоб ігнорувати сітку/порти)
-    all_blocks = canvas.find_withtag("block")
+    # 1. Фаза 1: Обробка БЛОКІВ (прямо з реєстру, без пошуку по тегах)
+    for block in ctx.blocks.values():
+        rect = block.rect
+        if not rect: continue
 
-    for obj_id in all_blocks:
-        tags = canvas.gettags(obj_id)
-        if "block_text" in tags: continue  # Ігноруємо текст, нам потрібні фігури
+        style_key = style_map.get(block.kind, "rect")
 
-        # Знаходимо унікальний тег групи (напр. "rect_400_50")
-        potential_group_tag = next(
-            (tag for tag in tags if tag.startswith(("sub_", "rect_", "rhombus_", "ell_", "para_", "hex_"))), None)
+        drawio_id = f"block-{id_counter}";
+        id_counter += 1
+        x0, y0, x1, y1 = rect
+        w = x1 - x0;
+        h = y1 - y0
 
-        if potential_group_tag and potential_group_tag not in group_tag_to_data:
-            bbox = canvas.bbox(obj_id)
-            if not bbox: continue
+        block_to_data[block.block_id] = {"id": drawio_id}
+        xml_elements.append(_xml_block(drawio_id, block.text, style_key, x0 + ctx.origin_x, y0 + ctx.origin_y, w, h))
 
-            # Визначаємо стиль draw.io
-            style_map = {"ellipse": "ell_", "rect": "rect_", "rhombus": "rhombus_", "sub": "sub_", "hex": "hex_",
-                         "para": "para_"}
-            style_key = next((key for key, val in style_map.items() if potential_group_tag.startswith(val)), "rect")
+    # 2. Фаза 2: Обробка СТРІЛОК
+    # (Переконуємось, що обидва кінці стрілки прив'язані)
+    geometry = ctx.geometry
+    origin = (ctx.origin_x, ctx.origin_y)  # (Експорт - у світових координатах)
+    arrows = [(arrow_id, conn['source'], conn['target']) for arrow_id, conn in ctx.arrow_connections.items()
+              if conn['source'] in block_to_data and conn['target'] in block_to_data
+              and arrow_id in geometry.edge_index and len(geometry.edge_points(arrow_id)) >= 2]
+
+    if arrows:
+        # Розрахунок відносних точок (для draw.io) - одним векторним запитом для всіх стрілок
+        starts = np.array([geometry.edge_points(arrow_id)[0] for arrow_id, _, _ in arrows])
+        ends = np.array([geometry.edge_points(arrow_id)[-1] for arrow_id, _, _ in arrows])
+        source_rel = geometry.relative_points(starts, [source for _, source, _ in arrows]).tolist()
+        target_rel = geometry.relative_points(ends, [target for _, _, target in arrows]).tolist()
+
+        for (arrow_id, source, target), (source_x_rel, source_y_rel), (target_x_rel, target_y_rel) in \
+                zip(arrows, source_rel, target_rel):
+            drawio_id = f"arrow-{id_counter}";
+            id_counter += 1
+            arrow_text = ""  # (Текст "True/False" ще не реалізований для експорту)
 
-            # ❗️ (Ключовий момент) Беремо текст з BLOCK_TEXT_MAP за тегом.
-            text_content = BLOCK_TEXT_MAP.get(potential_group_tag, style_key.capitalize())
+            xml_elements.append(_xml_arrow_with_waypoints(
+                drawio_id, block_to_data[source]["id"], block_to_data[target]["id"], text=arrow_text,
+                waypoint_coords=[value + origin[i % 2] for i, value in enumerate(geometry.edge_coords(arrow_id))],
+                source_x_rel=source_x_rel, source_y_rel=source_y_rel,
+                target_x_rel=target_x_rel, target_y_rel=target_y_rel
+            ))
 
-            drawio_id = f"block-{id_counter}";
-            id_counter += 1
-            x0, y0, x1, y1 = bbox
-            w = x1 - x0;
-            h = y1 - y0
+    # 3. Збірка XML
+    body = "".join(xml_elements)
+    return DRAWIO_PAGE_HEADER.format(diagram_id=diagram_id, page_name=page_name) + body + DRAWIO_PAGE_FOOTER
 
-            group_tag_to_data[potential_group_tag] = {"id": drawio_id, "bbox": bbox}
-            xml_elements.append(_xml_block(drawio_id, text_content, style_key, x0, y0, w, h))
 
-    # 2. Фаза 2: Обробка СТРІЛОК
-    for arrow_id, conn_data in ARROW_CONNECTIONS.items():
-        source_tag = conn_data.get('source_tag')
-        target_tag = conn_data.get('target_tag')
-
-        # (Переконуємось, що обидва кінці стрілки прив'язані)
-        if not (source_tag and target_tag and \
-                source_tag in group_tag_to_data and \
-                target_tag in group_tag_to_data):
+def generate_drawio_xml_from_canvas(ctx, page_name="Page-1"):
+    """Генерує XML-файл .drawio (одна сторінка) на основі поточного стану полотна."""
+    return DRAWIO_FILE_HEADER + _drawio_page_xml(ctx, page_name) + DRAWIO_FILE_FOOTER
+
+
+# --- 10.2. Експорт сцени в SVG ---
+
+_SVG_FONTS = {}  # {опис шрифту Tk: tk.font.Font} - для перенесення тексту як у Tk
+_SVG_TEXT_ANCHORS = {"w": "start", "e": "end"}  # (Решта - "middle")
+SVG_PADDING = 30  # Відступ навколо схеми у SVG, px
+
+
+def _svg_font(font):
+    """(tk.font.Font або None без Tk, сімейство, розмір, жирний) для опису шрифту елемента сцени."""
+    font = tuple(font) if isinstance(font, (tuple, list)) else ("Arial", 10)
+    family, size = font[0], abs(int(font[1])) if len(font) > 1 else 10
+    try:
+        if font not in _SVG_FONTS:
+            _SVG_FONTS[font] = tk.font.Font(font=font)
+        measure = _SVG_FONTS[font]
+    except Exception:
+        measure = None
+    return measure, family, size, "bold" in font[2:]
+
+
+def _svg_wrap_text(text, measure, width):
+    """Розбиває текст на рядки так само, як Tk з опцією width (за словами)."""
+    if not width or measure is None:
+        return text.split("\n")
+    lines = []
+    for paragraph in text.split("\n"):
+        line = ""
+        for word in paragraph.split(" "):
+            candidate = f"{line} {word}" if line else word
+            if line and measure.measure(candidate) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def _svg_element(item_type, coords, options):
+    """Один елемент сцени (тип, координати, опції Tk) як елемент SVG."""
+    fill = options.get("fill") or "none"
+    outline = options.get("outline", "black") or "none"
+    stroke = f'stroke="{outline}" stroke-width="{options.get("width", 1)}"'
+    if options.get("dash"):
+        stroke += f' stroke-dasharray="{",".join(str(value) for value in options["dash"])}"'
+    points = " ".join(f"{x:.2f},{y:.2f}" for x, y in zip(coords[0::2], coords[1::2]))
+
+    if item_type == "rectangle":
+        x0, y0, x1, y1 = coords
+        return f'<rect x="{x0:.2f}" y="{y0:.2f}" width="{x1 - x0:.2f}" height="{y1 - y0:.2f}" fill="{fill}" {stroke}/>'
+    if item_type == "oval":
+        x0, y0, x1, y1 = coords
+        return (f'<ellipse cx="{(x0 + x1) / 2:.2f}" cy="{(y0 + y1) / 2:.2f}" rx="{(x1 - x0) / 2:.2f}" '
+                f'ry="{(y1 - y0) / 2:.2f}" fill="{fill}" {stroke}/>')
+    if item_type == "polygon":
+        return f'<polygon points="{points}" fill="{fill}" {stroke}/>'
+    if item_type == "line":
+        # (У ліній Tk колір - fill, а не outline)
+        line_color = options.get("fill") or "black"
+        markers = {"last": ' marker-end="url(#arrow)"', "first": ' marker-start="url(#arrow-start)"',
+                   "both": ' marker-start="url(#arrow-start)" marker-end="url(#arrow)"'}.get(options.get("arrow"), "")
+        dash = f' stroke-dasharray="{",".join(str(value) for value in options["dash"])}"' if options.get("dash") else ""
+        return (f'<polyline points="{points}" fill="none" stroke="{line_color}" '
+                f'stroke-width="{options.get("width", 1)}"{dash}{markers}/>')
+    if item_type == "text":
+        measure, family, size, bold = _svg_font(options.get("font"))
+        lines = _svg_wrap_text(str(options.get("text", "")), measure, options.get("width"))
+        line_height = measure.metrics("linespace") if measure is not None else size * 1.3
+        ascent = measure.metrics("ascent") if measure is not None else size
+        anchor = options.get("anchor", "center").replace("center", "")  # (Лише сторони світу: n, s, e, w)
+        x, y = coords[0], coords[1]
+        total = line_height * len(lines)
+        top = y if "n" in anchor else y - total if "s" in anchor else y - total / 2
+        text_anchor = next((value for key, value in _SVG_TEXT_ANCHORS.items() if key in anchor), "middle")
+        spans = "".join(f'<tspan x="{x:.2f}" y="{top + ascent + index * line_height:.2f}">{xml_escape(line)}</tspan>'
+                        for index, line in enumerate(lines))
+        weight = ' font-weight="bold"' if bold else ""
+        return (f'<text font-family="{xml_escape(family)}" font-size="{size}pt"{weight} text-anchor="{text_anchor}" '
+                f'fill="{options.get("fill") or "black"}">{spans}</text>')
+    return ""
+
+
+@PERF.timed("export_svg")
+def generate_svg_from_scene(scene, colors=None):
+    """
+    SVG (текст) зі сцени (див. SceneRecorder.scene): світові координати,
+    межі - зі сцени з відступом SVG_PADDING. colors - кольори блоків
+    (як у SceneRenderer; None - кольори, з якими сцену записано).
+    """
+    fills = _scene_fill_overrides(scene, colors) if colors else {}
+    x0, y0, x1, y1 = scene["bounds"] or (0, 0, 0, 0)
+    x0, y0, x1, y1 = x0 - SVG_PADDING, y0 - SVG_PADDING, x1 + SVG_PADDING, y1 + SVG_PADDING
+    elements = []
+    for index, (item_type, coords, options) in enumerate(scene["items"]):
+        if index in fills:
+            options = dict(options, fill=fills[index])
+        elements.append(_svg_element(item_type, coords, options))
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{x1 - x0:.0f}" height="{y1 - y0:.0f}" '
+            f'viewBox="{x0:.2f} {y0:.2f} {x1 - x0:.2f} {y1 - y0:.2f}">\n'
+            '<defs>'
+            '<marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="5" markerHeight="5" '
+            'orient="auto"><path d="M0,0 L10,5 L0,10 z" fill="black"/></marker>'
+            '<marker id="arrow-start" viewBox="0 0 10 10" refX="0" refY="5" markerWidth="5" markerHeight="5" '
+            'orient="auto"><path d="M10,0 L0,5 L10,10 z" fill="black"/></marker>'
+            '</defs>\n'
+            f'<rect x="{x0:.2f}" y="{y0:.2f}" width="{x1 - x0:.2f}" height="{y1 - y0:.2f}" fill="white"/>\n'
+            + "\n".join(element for element in elements if element) + "\n</svg>\n")
+
+
+# --- 10.3. HTTP-СЕРВІС РЕНДЕРИНГУ ---
+# python Main.py --serve [--port 8765] [--workers 2] [--timeout 20]
+#
+# POST /render, тіло - JSON {"source": "C-код", "function": "main",
+#     "formats": ["drawio", "svg", "png"], "colors": [5 кольорів]} ->
+#     JSON {"function", "functions", "pseudocode", "diagnostics", "drawio", "svg", "png" (base64), "cached"};
+# або тіло - сам C-код, ?function=main&format=svg|drawio|png|pseudocode -> лише цей формат.
+# GET /health -> стан сервісу (воркери, кеш, запити).
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_WORKERS = 2  # Процесів-воркерів (кожен - з власним прихованим полотном Tk)
+SERVICE_TIMEOUT_S = 20  # Ліміт часу на один запит, с
+SERVICE_QUEUE_PER_WORKER = 4  # Скільки запитів може чекати на кожного воркера (далі - 503)
+SERVICE_CACHE_ITEMS = 256  # Скільки готових результатів зберігати (LRU за хешем вмісту)
+SERVICE_MAX_SOURCE_BYTES = 2 * 1024 * 1024  # Максимальний розмір C-коду в запиті
+SERVICE_FORMATS = ("pseudocode", "drawio", "svg", "png")
+SERVICE_COLORS = ("#FFD1DC", "#ADD8E6", "#FFFFE0", "#CCEEFF", "#D8BFD8")  # (Кольори за замовчуванням вікна)
+SERVICE_CONTENT_TYPES = {"pseudocode": "text/plain; charset=utf-8", "drawio": "application/xml; charset=utf-8",
+                         "svg": "image/svg+xml; charset=utf-8", "png": "image/png"}
+
+_RENDER_WORKER = {}  # {"root", "ctx"} - полотно процесу-воркера (створюється при першому малюванні)
+
+
+class RenderRequestError(Exception):
+    """Помилка запиту до сервісу рендерингу (з HTTP-статусом для відповіді)."""
+
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+    def __reduce__(self):
+        # (Помилка передається з воркера в сервер через pickle)
+        return _rebuild_render_error, (self.status, str(self), self.details)
+
+
+def _rebuild_render_error(status, message, details):
+    return RenderRequestError(status, message, **details)
+
+
+def _render_timeout(signum, frame):
+    raise RenderRequestError(504, "Перевищено ліміт часу на обробку запиту.")
+
+
+def start_virtual_display():
+    """
+    Забезпечує дисплей для Tk: наявний DISPLAY, Xvfb (якщо встановлений)
+    або None. Повертає (процес Xvfb або None, причина недоступності або None);
+    процес Xvfb завершує той, хто його запросив.
+    """
+    if os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin"):
+        return None, None
+    xvfb = shutil.which("Xvfb")
+    if xvfb is None:
+        return None, "немає DISPLAY і Xvfb не встановлений"
+    display = f":{90 + os.getpid() % 100}"
+    process = subprocess.Popen([xvfb, display, "-screen", "0", "1600x1200x24", "-nolisten", "tcp"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.environ["DISPLAY"] = display
+    for _ in range(50):  # (Xvfb стартує асинхронно)
+        if process.poll() is not None:
+            return None, "Xvfb не запустився"
+        try:
+            tk.Tk().destroy()
+            return process, None
+        except tk.TclError:
+            time.sleep(0.1)
+    process.terminate()
+    return None, "Xvfb не відповідає"
+
+
+def _render_worker_ctx():
+    """(У воркері) Приховане полотно та контекст діаграми - одні на процес."""
+    if "ctx" not in _RENDER_WORKER:
+        try:
+            root = tk.Tk()
+        except tk.TclError as e:
+            raise RenderRequestError(503, f"Малювання недоступне (немає дисплея для Tk): {e}")
+        root.withdraw()
+        _RENDER_WORKER["root"] = root
+        _RENDER_WORKER["ctx"] = DiagramContext(tk.Canvas(root, width=1200, height=800))
+    return _RENDER_WORKER["ctx"]
+
+
+def render_function_outputs(code_list, func_name, formats, colors=SERVICE_COLORS):
+    """
+    Експортує одну функцію у вибрані формати: {"pseudocode": текст, "svg": текст,
+    "drawio": текст, "png": байти}. Схема малюється на прихованому полотні
+    процесу (_render_worker_ctx); помилки - RenderRequestError.
+    """
+    outputs = {}
+    if "pseudocode" in formats:
+        outputs["pseudocode"] = "\n".join(code_list)
+    drawn = [name for name in formats if name != "pseudocode"]
+    if not drawn:
+        return outputs
+
+    ctx = _render_worker_ctx()
+    ctx.canvas.delete("all")
+    ctx.reset_scene()
+    ctx.flow_tree = None
+    scene = _record_flowchart_scene(ctx, code_list, 1.0, 1.0, 1.0, 1.0, colors, False)
+    if "svg" in drawn:
+        outputs["svg"] = generate_svg_from_scene(scene)
+    if "drawio" in drawn or "png" in drawn:
+        SceneRenderer(ctx, scene, colors).run()
+    if "drawio" in drawn:
+        outputs["drawio"] = generate_drawio_xml_from_canvas(ctx, page_name=func_name)
+    if "png" in drawn:
+        with tempfile.TemporaryDirectory() as directory:
+            png_path = os.path.join(directory, "flowchart.png")
+            save_full_flowchart_as_png_via_pil(ctx, png_path)
+            if not os.path.exists(png_path):
+                raise RenderRequestError(501, "Експорт PNG не вдався (PostScript -> PNG потребує Ghostscript).")
+            with open(png_path, "rb") as f:
+                outputs["png"] = f.read()
+    return outputs
+
+
+def _render_source_job(source_bytes, func_name, formats, colors, timeout):
+    """
+    (Виконується у воркері) Розбирає C-код, будує псевдокод функції та
+    потрібні формати схеми. Ліміт часу - сигналом (де він є), щоб воркер
+    звільнявся сам; сервер додатково не чекає довше за timeout.
+    """
+    use_alarm = hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _render_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        try:
+            lines = _decode_source_lines(source_bytes)
+        except UnicodeDecodeError as e:
+            raise RenderRequestError(400, f"C-код має бути в UTF-8 (байт {e.start}: {source_bytes[e.start:e.start + 1]!r}).")
+        lexed = lex_source_lines(lines)
+        code_map = LazyFunctionCodeMap(find_function_bodies(_join_line_tokens(lexed)), line_starts=_line_starts(lexed))
+        if func_name not in code_map:
+            raise RenderRequestError(404, f"Функцію '{func_name}' не знайдено.", functions=list(code_map))
+        code_list = code_map[func_name]
+        result = {"function": func_name, "functions": list(code_map), "diagnostics": code_map.diagnostics(func_name)}
+        result.update(render_function_outputs(code_list, func_name, formats, colors))  # (formats - завжди з псевдокодом)
+        if "png" in result:
+            result["png"] = base64.b64encode(result["png"]).decode("ascii")
+        return result
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class RenderService:
+    """
+    Пул процесів-воркерів з обмеженою чергою та LRU-кешем результатів за
+    хешем вмісту (C-код, функція, формати, кольори): однакові запити
+    відповідаються з кешу, а однакові одночасні - одним завданням.
+    """
+
+    def __init__(self, workers=SERVICE_WORKERS, timeout=SERVICE_TIMEOUT_S, cache_items=SERVICE_CACHE_ITEMS):
+        self.workers = workers
+        self.timeout = timeout
+        self.cache_items = cache_items
+        self.cache = OrderedDict()  # {ключ: результат}, порядок = давність використання
+        self.pending = {}  # {ключ: Future} - завдання, що виконуються
+        self.lock = threading.RLock()  # (Колбек готового завдання може виконатись одразу, під блокуванням)
+        self.slots = threading.BoundedSemaphore(workers * (1 + SERVICE_QUEUE_PER_WORKER))
+        self.stats = {"requests": 0, "cache_hits": 0, "rendered": 0, "bad_requests": 0, "errors": 0, "timeouts": 0}
+        self.executor = self._new_executor()
+
+    def _new_executor(self):
+        # 'spawn' - як у parse_all_functions (кожен воркер створює власний Tk)
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def cache_key(self, source_bytes, func_name, formats, colors):
+        digest = hashlib.sha256(_source_cache_key(source_bytes).encode("ascii"))
+        digest.update(json.dumps([func_name, sorted(formats), list(colors)]).encode("utf-8"))
+        return digest.hexdigest()
+
+    def render(self, source_bytes, func_name="main", formats=("drawio",), colors=SERVICE_COLORS):
+        """Повертає (результат, з кешу?); помилки - RenderRequestError."""
+        formats = tuple(sorted(set(formats) | {"pseudocode"}))
+        unknown = [name for name in formats if name not in SERVICE_FORMATS]
+        if unknown:
+            raise RenderRequestError(400, f"Невідомі формати: {', '.join(unknown)}.", formats=list(SERVICE_FORMATS))
+        if len(source_bytes) > SERVICE_MAX_SOURCE_BYTES:
+            raise RenderRequestError(413, f"C-код більший за {SERVICE_MAX_SOURCE_BYTES} байт.")
+        colors = tuple(colors)
+        key = self.cache_key(source_bytes, func_name, formats, colors)
+        job = (source_bytes, func_name, formats, colors, self.timeout)
+
+        with self.lock:
+            self.stats["requests"] += 1
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return result, True
+            future = self.pending.get(key)
+            if future is None:
+                if not self.slots.acquire(blocking=False):
+                    raise RenderRequestError(503, "Сервіс перевантажений, спробуйте пізніше.")
+                try:
+                    try:
+                        future = self.executor.submit(_render_source_job, *job)
+                    except BrokenProcessPool:
+                        # (Воркер аварійно завершився раніше - пул непридатний, створюємо новий)
+                        self.executor = self._new_executor()
+                        future = self.executor.submit(_render_source_job, *job)
+                except Exception as e:
+                    # (Завдання не створено - колбек, що звільняє місце, не спрацює)
+                    self.slots.release()
+                    self.stats["errors"] += 1
+                    raise RenderRequestError(503, f"Не вдалося запустити рендеринг: {e}")
+                self.pending[key] = future
+                future.add_done_callback(lambda done: self._finished(key, done))
+
+        try:
+            # (Запас на запуск воркера та передачу результату)
+            result = future.result(timeout=self.timeout + 5)
+        except FutureTimeoutError:  # (До Python 3.11 - не вбудований TimeoutError)
+            self._count("timeouts")
+            raise RenderRequestError(504, "Перевищено ліміт часу на обробку запиту.")
+        except RenderRequestError as e:
+            # (4xx з воркера - помилка в запиті: кодування, немає функції)
+            self._count("timeouts" if e.status == 504 else "bad_requests" if e.status < 500 else "errors")
+            raise
+        except BrokenProcessPool:
+            # (Новий пул створиться при наступному submit)
+            self._count("errors")
+            raise RenderRequestError(500, "Воркер аварійно завершився під час рендерингу.")
+        except Exception as e:
+            self._count("errors")
+            raise RenderRequestError(500, f"Внутрішня помилка рендерингу: {e}")
+
+        with self.lock:
+            if key not in self.cache:
+                self.stats["rendered"] += 1
+            self.cache[key] = result
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_items:
+                self.cache.popitem(last=False)
+        return result, False
+
+    def _count(self, name):
+        """Лічильник stats (обробники запитів - у різних потоках)."""
+        with self.lock:
+            self.stats[name] += 1
+
+    def _finished(self, key, future):
+        """Завдання завершилось (у т.ч. після тайм-ауту відповіді): звільняє місце в черзі."""
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        self.slots.release()
+
+    def health(self):
+        with self.lock:
+            return dict(self.stats, status="ok", workers=self.workers, timeout_s=self.timeout,
+                        cached=len(self.cache), in_progress=len(self.pending))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _check_render_request(request):
+    """Типи полів JSON-запиту /render (інакше - 400, а не TypeError в обробнику)."""
+    if not isinstance(request.get("function", "main"), str):
+        raise RenderRequestError(400, "\"function\" - рядок з іменем функції.")
+    formats = request.get("formats", [])
+    if not isinstance(formats, list) or not all(isinstance(name, str) for name in formats):
+        raise RenderRequestError(400, "\"formats\" - список назв форматів.", formats=list(SERVICE_FORMATS))
+    colors = request.get("colors") or SERVICE_COLORS
+    if not isinstance(colors, (list, tuple)) or len(colors) != len(SERVICE_COLORS) or \
+            not all(isinstance(color, str) for color in colors):
+        raise RenderRequestError(400, f"\"colors\" - список з {len(SERVICE_COLORS)} кольорів "
+                                      "(овал, прямокутник, ромб, підпрограма, шестикутник).")
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """HTTP-обробник сервісу рендерингу (service - RenderService сервера)."""
+
+    server_version = "AutoASD"
+
+    def _send(self, status, body, content_type="application/json; charset=utf-8"):
+        if not isinstance(body, bytes):
+            body = (body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, error):
+        self._send(error.status, dict(error.details, error=str(error)))
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self._send(200, self.server.service.health())
+        else:
+            self._send(404, {"error": "Невідомий шлях (POST /render, GET /health)."})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/render":
+            self._send(404, {"error": "Невідомий шлях (POST /render, GET /health)."})
+            return
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                raise RenderRequestError(400, "Некоректний Content-Length.")
+            if length > SERVICE_MAX_SOURCE_BYTES * 2:
+                raise RenderRequestError(413, "Запит завеликий.")
+            body = self.rfile.read(length)
+
+            raw_format = query.get("format")
+            if raw_format is not None:
+                source_bytes, request = body, {"function": query.get("function", "main"), "formats": [raw_format]}
+            else:
+                try:
+                    request = json.loads(body.decode("utf-8"))
+                    source_bytes = request["source"].encode("utf-8")
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    raise RenderRequestError(400, "Очікується JSON {\"source\": ...} або C-код з ?format=.")
+                _check_render_request(request)
+
+            result, cached = self.server.service.render(
+                source_bytes, request.get("function", "main"), request.get("formats", ["drawio"]),
+                request.get("colors") or SERVICE_COLORS)
+        except RenderRequestError as e:
+            self._send_error(e)
+            return
+
+        if raw_format is None:
+            self._send(200, dict(result, cached=cached))
+        elif raw_format == "png":
+            self._send(200, base64.b64decode(result["png"]), SERVICE_CONTENT_TYPES["png"])
+        else:
+            self._send(200, result[raw_format], SERVICE_CONTENT_TYPES[raw_format])
+
+    def log_message(self, format, *args):
+        print(f"[{self.log_date_time_string()}] {self.address_string()} {format % args}")
+
+
+def serve_render_service(host=SERVICE_HOST, port=SERVICE_PORT, workers=SERVICE_WORKERS, timeout=SERVICE_TIMEOUT_S):
+    """Запускає HTTP-сервіс рендерингу (до Ctrl+C)."""
+    server = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    server.daemon_threads = True
+    server.service = RenderService(workers, timeout)
+    print(f"Сервіс рендерингу: http://{host}:{server.server_address[1]}/render "
+          f"(воркерів: {workers}, ліміт часу: {timeout} с)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+
+
+# --- 10.4. ІНКРЕМЕНТАЛЬНИЙ ЕКСПОРТ (МАНІФЕСТ) ---
+# python Main.py --export-dir docs/flowcharts [--formats svg,drawio,pseudocode] [--force] src/*.c
+#
+# Маніфест у каталозі експорту зберігає для кожного файлу хеш вмісту, а для
+# кожної функції (файл, функція) - хеш токенів, параметри експорту та шляхи
+# результатів. Перегенеровуються лише функції зі зміненими входами; файли
+# без змін пропускаються без токенізації, застарілі результати видаляються.
+
+EXPORT_MANIFEST_NAME = ".autoasd-export.json"
+EXPORT_MANIFEST_VERSION = 1  # Збільшувати при зміні формату маніфесту або експортерів
+EXPORT_FORMATS_DEFAULT = ("svg", "drawio", "pseudocode")
+EXPORT_EXTENSIONS = {"pseudocode": ".txt", "drawio": ".drawio", "svg": ".svg", "png": ".png"}
+
+
+def _export_options(formats, colors):
+    """Параметри, від яких залежать результати (зміна - перегенерувати все)."""
+    return {"version": EXPORT_MANIFEST_VERSION, "parser": PARSER_VERSION, "formats": sorted(formats),
+            "colors": list(colors)}
+
+
+def _read_export_manifest(out_dir):
+    """Маніфест каталогу експорту (порожній, якщо його немає або він пошкоджений)."""
+    try:
+        with open(os.path.join(out_dir, EXPORT_MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == EXPORT_MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"version": EXPORT_MANIFEST_VERSION, "options": None, "files": {}, "functions": {}}
+
+
+def _write_export_manifest(out_dir, manifest):
+    """Атомарно записує маніфест (як запис дискового кешу парсингу)."""
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, os.path.join(out_dir, EXPORT_MANIFEST_NAME))
+
+
+EXPORT_OUTSIDE_ROOT_DIR = "_abs"  # Підкаталог для файлів поза root (далі - їх повний шлях)
+
+
+def _export_file_dir(file_path, root):
+    """
+    Підкаталог результатів файлу: шлях відносно root без розширення. Файли
+    поза root - під EXPORT_OUTSIDE_ROOT_DIR з повним шляхом (ім'я файлу
+    саме по собі не унікальне: x/u.c та y/u.c).
+    """
+    path = os.path.abspath(file_path)
+    relative = os.path.relpath(path, root) if os.path.splitdrive(path)[0] == os.path.splitdrive(root)[0] else None
+    if relative is None or relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        drive, tail = os.path.splitdrive(path)
+        relative = os.path.join(EXPORT_OUTSIDE_ROOT_DIR, drive.rstrip(":\\/"), tail.lstrip(os.sep))
+    return os.path.splitext(os.path.normpath(relative))[0].replace(os.sep, "/")
+
+
+def _export_outputs_exist(out_dir, entry):
+    return all(os.path.exists(os.path.join(out_dir, path)) for path in entry["outputs"].values())
+
+
+def _remove_export_outputs(out_dir, paths):
+    """Видаляє застарілі результати та підкаталоги, що стали порожніми."""
+    for path in paths:
+        full_path = os.path.join(out_dir, path)
+        try:
+            os.remove(full_path)
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(full_path)
+        while os.path.abspath(directory) != os.path.abspath(out_dir):
+            try:
+                os.rmdir(directory)  # (Лише порожній)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+def export_incremental(files, out_dir, formats=EXPORT_FORMATS_DEFAULT, colors=SERVICE_COLORS, root=None,
+                       force=False):
+    """
+    Експортує функції C-файлів files у out_dir/<файл>/<функція>.<розширення>,
+    перегенеровуючи лише змінене (force - усе). Повертає звіт:
+    {"exported", "skipped", "removed", "failed": [...], "files_unchanged", "seconds"}.
+
+    Усім форматам, крім pseudocode, потрібен Tk (розкладка вимірює текст
+    шрифтами Tk): без DISPLAY на час експорту запускається Xvfb, якщо він
+    встановлений (start_virtual_display), інакше такі функції - у "failed".
+    """
+    xvfb = None
+    if any(name != "pseudocode" for name in formats):
+        xvfb, reason = start_virtual_display()
+        if reason is not None:
+            print(f"Увага: {reason} - експорт {', '.join(sorted(set(formats) - {'pseudocode'}))} не вдасться.")
+    try:
+        return _export_incremental(files, out_dir, formats, colors, root, force)
+    finally:
+        if xvfb is not None:
+            # (Полотно воркера прив'язане до цього дисплея - прибрати разом із ним)
+            _RENDER_WORKER.pop("ctx", None)
+            if "root" in _RENDER_WORKER:
+                _RENDER_WORKER.pop("root").destroy()
+            xvfb.terminate()
+
+
+def _export_incremental(files, out_dir, formats, colors, root, force):
+    """Тіло export_incremental (дисплей для Tk вже забезпечено)."""
+    start = time.perf_counter()
+    root = os.path.abspath(root or os.getcwd())
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = _read_export_manifest(out_dir)
+    options = _export_options(formats, colors)
+    options_changed = force or manifest.get("options") != options
+    old_functions = manifest["functions"]
+    new_files = {}
+    new_functions = {}
+    report = {"exported": [], "skipped": [], "removed": [], "failed": [], "files_unchanged": 0}
+    file_dirs = {}  # {підкаталог: файл} - два файли не можуть писати в один підкаталог
+
+    for file_path in files:
+        file_dir = _export_file_dir(file_path, root)
+        if file_dir in file_dirs:
+            if os.path.abspath(file_dirs[file_dir]) == os.path.abspath(file_path):
+                continue  # (Той самий файл двічі у списку)
+            report["failed"].append({"function": file_path,
+                                     "error": f"результати збігаються з {file_dirs[file_dir]} ({file_dir}/) - пропущено"})
             continue
+        file_dirs[file_dir] = file_path
+        with open(file_path, "rb") as f:
+            file_hash = _source_cache_key(f.read())
+        old_file = manifest["files"].get(file_dir)
+
+        # Файл не змінився - усі його функції беруться з маніфесту без токенізації
+        if not options_changed and old_file is not None and old_file["hash"] == file_hash:
+            entries = {key: old_functions[key] for key in old_file["functions"] if key in old_functions}
+            if len(entries) == len(old_file["functions"]) and \
+                    all(entry["hash"] and _export_outputs_exist(out_dir, entry) for entry in entries.values()):
+                new_files[file_dir] = old_file
+                new_functions.update(entries)
+                report["skipped"].extend(entries)
+                report["files_unchanged"] += 1
+                continue
 
-        source_id = group_tag_to_data[source_tag]["id"]
-        target_id = group_tag_to_data[target_tag]["id"]
+        code_map = load_c_source(file_path)
+        keys = []
+        for func_name in code_map:
+            key = f"{file_dir}::{func_name}"
+            keys.append(key)
+            body_hash = code_map.body_hash(func_name)
+            outputs = {name: f"{file_dir}/{func_name}{EXPORT_EXTENSIONS[name]}" for name in sorted(formats)}
+            old_entry = old_functions.get(key)
+            if not options_changed and old_entry is not None and old_entry["hash"] == body_hash and \
+                    old_entry["outputs"] == outputs and _export_outputs_exist(out_dir, old_entry):
+                new_functions[key] = old_entry
+                report["skipped"].append(key)
+                continue
 
-        arrow_coords = canvas.coords(arrow_id)
-        if len(arrow_coords) < 4: continue
+            try:
+                rendered = render_function_outputs(code_map[func_name], func_name, formats, colors)
+                for name, path in outputs.items():
+                    full_path = os.path.join(out_dir, path)
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    content = rendered[name]
+                    with open(full_path, "wb") as f:
+                        f.write(content if isinstance(content, bytes) else content.encode("utf-8"))
+            except (RenderRequestError, OSError) as e:
+                report["failed"].append({"function": key, "error": str(e)})
+                if old_entry is not None:
+                    new_functions[key] = dict(old_entry, hash=None)  # (Старі результати лишаються, наступний запуск повторить)
+                continue
+            new_functions[key] = {"file": file_path, "function": func_name, "hash": body_hash, "outputs": outputs}
+            report["exported"].append(key)
 
-        x_start, y_start = arrow_coords[0], arrow_coords[1]
-        x_end, y_end = arrow_coords[-2], arrow_coords[-1]
+        code_map.save_cache()  # (Наступний запуск для зміненого файлу - без повторного парсингу)
+        new_files[file_dir] = {"hash": file_hash, "functions": keys}
 
-        # Розрахунок відносних точок (для draw.io)
-        source_x_rel, source_y_rel = _calculate_relative_point(x_start, y_start, group_tag_to_data[source_tag]["bbox"])
-        target_x_rel, target_y_rel = _calculate_relative_point(x_end, y_end, group_tag_to_data[target_tag]["bbox"])
+    # Застарілі результати: видалені функції/файли та формати, яких більше немає
+    kept_paths = {path for entry in new_functions.values() for path in entry["outputs"].values()}
+    for key, entry in old_functions.items():
+        stale = [path for path in entry["outputs"].values() if path not in kept_paths]
+        if stale:
+            _remove_export_outputs(out_dir, stale)
+            report["removed"].extend(stale)
 
-        drawio_id = f"arrow-{id_counter}";
-        id_counter += 1
-        arrow_text = ""  # (Текст "True/False" ще не реалізований для експорту)
+    manifest.update(options=options, files=new_files, functions=new_functions)
+    _write_export_manifest(out_dir, manifest)
+    report["seconds"] = time.perf_counter() - start
+    return report
 
-        xml_elements.append(_xml_arrow_with_waypoints(
-            drawio_id, source_id, target_id, text=arrow_text,
-            waypoint_coords=arrow_coords,
-            source_x_rel=source_x_rel, source_y_rel=source_y_rel,
-            target_x_rel=target_x_rel, target_y_rel=target_y_rel
-        ))
 
-    # 3. Збірка XML
-    body = "".join(xml_elements)
-    return DRAWIO_HEADER.format(page_name=page_name) + body + DRAWIO_FOOTER
+def format_export_report(report):
+    """Короткий текст звіту інкрементального експорту."""
+    lines = [f"Експортовано: {len(report['exported'])}, пропущено без змін: {len(report['skipped'])} "
+             f"(файлів без змін: {report['files_unchanged']}), видалено застарілих: {len(report['removed'])}, "
+             f"помилок: {len(report['failed'])} - {report['seconds']:.2f} с"]
+    lines.extend(f"  + {key}" for key in report["exported"])
+    lines.extend(f"  - {path}" for path in report["removed"])
+    lines.extend(f"  ! {failure['function']}: {failure['error']}" for failure in report["failed"])
+    return "\n".join(lines)
 
 
 # --- 11. ТОЧКА ВХОДУ ---
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="AutoASD: блок-схеми з C-коду.")
+    arg_parser.add_argument("--project", nargs="?", const="", metavar="DIR",
+                            help="відкрити каталог з кількома C-файлами (без DIR - діалог вибору)")
+    arg_parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"),
+                            help="відкрити NEW з виділеними змінами відносно OLD")
+    arg_parser.add_argument("--serve", action="store_true", help="HTTP-сервіс рендерингу замість вікна")
+    arg_parser.add_argument("--host", default=SERVICE_HOST)
+    arg_parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    arg_parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+    arg_parser.add_argument("--timeout", type=float, default=SERVICE_TIMEOUT_S, help="ліміт часу на запит, с")
+    arg_parser.add_argument("--export-dir", help="інкрементальний експорт файлів sources у цей каталог "
+                                                 "(svg/drawio/png потребують Tk: без DISPLAY - Xvfb, якщо встановлений)")
+    arg_parser.add_argument("--formats", default=",".join(EXPORT_FORMATS_DEFAULT),
+                            help=f"формати експорту через кому ({', '.join(SERVICE_FORMATS)})")
+    arg_parser.add_argument("--export-root", help="корінь для шляхів результатів (за замовчуванням - поточний; "
+                                                  "файли поза ним - у _abs/<повний шлях>)")
+    arg_parser.add_argument("--force", action="store_true", help="перегенерувати все, ігноруючи маніфест")
+    arg_parser.add_argument("--report", help="JSON-звіт експорту")
+    arg_parser.add_argument("sources", nargs="*", help="C-файли для --export-dir")
+    cli_args = arg_parser.parse_args()
+
+    if os.environ.get("AUTOASD_TRACEMALLOC"):
+        start_memory_tracing()  # (Щоб у звіті пам'яті були всі виділення з початку роботи)
+
+    if cli_args.serve:
+        serve_render_service(cli_args.host, cli_args.port, cli_args.workers, cli_args.timeout)
+        sys.exit(0)
+    if cli_args.export_dir:
+        export_formats = [name.strip() for name in cli_args.formats.split(",") if name.strip()]
+        unknown_formats = [name for name in export_formats if name not in EXPORT_EXTENSIONS]
+        if unknown_formats:
+            arg_parser.error(f"невідомі формати: {', '.join(unknown_formats)}")
+        export_report = export_incremental(cli_args.sources, cli_args.export_dir, export_formats,
+                                           root=cli_args.export_root, force=cli_args.force)
+        print(format_export_report(export_report))
+        if cli_args.report:
+            with open(cli_args.report, 'w', encoding='utf-8') as f:
+                json.dump(export_report, f, ensure_ascii=False, indent=2)
+        sys.exit(1 if export_report["failed"] else 0)
+
     main_root = tk.Tk()
     main_root.withdraw()  # Ховаємо головне (порожнє) вікно Tk
     main_root.attributes('-topmost', True)  # (Для діалогу вибору файлу)
 
     # Запускаємо головну логіку
-    select_file_and_read_words_v30(main_root)
+    if cli_args.project is not None:
+        select_project_and_open(main_root, cli_args.project)
+    elif cli_args.diff:
+        compare_files_and_open(main_root, *cli_args.diff)
+    else:
+        select_file_and_read_words_v30(main_root)
 
     print("Запуск головного циклу Tkinter. Закрийте вікно схеми для виходу.")
-    main_root.mainloop()  # Запускаємо цикл подій
\ No newline at end of file
+    main_root.mainloop()  # Запускаємо цикл подій
+
+    # Зберігаємо розпарсені за сесію тіла функцій у дисковий кеш
+    if isinstance(FUNCTION_CODE_MAP, (LazyFunctionCodeMap, ProjectCodeMap)):
+        FUNCTION_CODE_MAP.save_cache()
\ No newline at end of file
@@ -0,0 +1,19 @@
+"""
+Бенчмарки AutoASD.
+
+- generate.py - генератор синтетичних C-програм заданого розміру
+  (функції, оператори, глибина вкладеності, ланцюжки else-if, do-while,
+  довгі вирази).
+- run.py - вимірює кожен етап окремо (токенізація, пошук функцій,
+  парсинг, розкладка, рендеринг, кожен експортер) і пише результати в
+  JSON; етап, повільніший за поріг (thresholds.json) або за попередній
+  результат (--baseline), робить запуск невдалим (код виходу 1).
+- replay.py - відтворює запис взаємодії з вікна схеми під віртуальним
+  дисплеєм і звітує перцентилі затримки обробників та пропущені кадри.
+- memory.py - звіт пам'яті для C-файлу: токени, розпарсені тіла, кеш
+  сцен, розкладка, елементи полотна за тегами, місця виділення (tracemalloc).
+
+Запуск (з кореня репозиторію):
+    python -m benchmarks.generate --preset medium -o synthetic.c
+    python -m benchmarks.run --preset medium -o bench.json
+"""
@@ -0,0 +1,182 @@
+"""
+Генератор синтетичних C-програм для бенчмарків.
+
+Програма детермінована (залежить лише від параметрів та seed) і містить
+усе, що розбирає парсер: присвоєння з довгими виразами, виклики функцій,
+printf/scanf, if / else if / else, for, while, do-while, return, а також
+коментарі та директиви препроцесора (для токенізатора).
+"""
+
+import argparse
+import random
+
+# Готові набори параметрів (--preset)
+PRESETS = {
+    "small": {"functions": 10, "statements": 30, "depth": 2, "else_if": 2, "expression_terms": 4},
+    "medium": {"functions": 60, "statements": 80, "depth": 3, "else_if": 3, "expression_terms": 6},
+    "large": {"functions": 250, "statements": 160, "depth": 4, "else_if": 4, "expression_terms": 10},
+}
+
+_VARIABLES = ["a", "b", "x", "y", "i", "j", "k"]
+_OPERATORS = ["+", "-", "*", "/", "%"]
+_COMPARISONS = ["<", ">", "<=", ">=", "==", "!="]
+
+
+def _expression(rng, terms):
+    """Арифметичний вираз з terms операндів (іноді - в дужках)."""
+    parts = []
+    for index in range(terms):
+        operand = rng.choice(_VARIABLES) if rng.random() < 0.7 else str(rng.randint(1, 99))
+        if index:
+            parts.append(rng.choice(_OPERATORS))
+        parts.append(operand)
+    if terms > 3 and rng.random() < 0.5:
+        start = rng.randrange(0, terms - 2) * 2
+        parts[start] = "(" + parts[start]
+        parts[start + 2] = parts[start + 2] + ")"
+    return " ".join(parts)
+
+
+def _condition(rng):
+    return f"{rng.choice(_VARIABLES)} {rng.choice(_COMPARISONS)} {_expression(rng, 2)}"
+
+
+class _FunctionWriter:
+    """Пише тіло однієї функції, поки не вичерпано бюджет операторів."""
+
+    def __init__(self, rng, params, callees):
+        self.rng = rng
+        self.params = params
+        self.callees = callees
+        self.budget = params["statements"]
+        self.lines = []
+
+    def emit(self, indent, text):
+        self.lines.append("    " * indent + text)
+
+    def block(self, indent, depth, count):
+        """count операторів на рівні indent (складені - лише поки depth > 0, тіло не порожнє)."""
+        for index in range(count):
+            if self.budget <= 0 and index:
+                return
+            self.statement(indent, depth if self.budget > 0 else 0)
+
+    def body_size(self):
+        return self.rng.randint(1, 4)
+
+    def statement(self, indent, depth):
+        rng = self.rng
+        self.budget -= 1
+        kind = rng.choices(["assign", "call", "print", "if", "for", "while", "do"],
+                           weights=[6, 2, 1, 3, 2, 1, 1])[0]
+        if depth <= 0 and kind in ("if", "for", "while", "do"):
+            kind = "assign"
+
+        if kind == "assign":
+            if rng.random() < 0.1:
+                self.emit(indent, f"// {rng.choice(_VARIABLES)} оновлюється")
+            self.emit(indent, f"{rng.choice(_VARIABLES)} = {_expression(rng, self.params['expression_terms'])};")
+        elif kind == "call":
+            if self.callees:
+                self.emit(indent, f"x = {rng.choice(self.callees)}({_expression(rng, 2)}, {rng.choice(_VARIABLES)});")
+            else:
+                self.emit(indent, f"y = {_expression(rng, 3)};")
+        elif kind == "print":
+            self.emit(indent, f'printf("%d %d\\n", {rng.choice(_VARIABLES)}, {rng.choice(_VARIABLES)});')
+        elif kind == "if":
+            self.emit(indent, f"if ({_condition(rng)}) {{")
+            self.block(indent + 1, depth - 1, self.body_size())
+            for _ in range(rng.randint(0, self.params["else_if"])):
+                self.emit(indent, f"}} else if ({_condition(rng)}) {{")
+                self.block(indent + 1, depth - 1, self.body_size())
+            if rng.random() < 0.6:
+                self.emit(indent, "} else {")
+                self.block(indent + 1, depth - 1, self.body_size())
+            self.emit(indent, "}")
+        elif kind == "for":
+            counter = rng.choice(["i", "j", "k"])
+            self.emit(indent, f"for ({counter} = 0; {counter} < LIMIT; {counter}++) {{")
+            self.block(indent + 1, depth - 1, self.body_size())
+            self.emit(indent, "}")
+        elif kind == "while":
+            self.emit(indent, f"while ({_condition(rng)}) {{")
+            self.block(indent + 1, depth - 1, self.body_size())
+            self.emit(indent, "}")
+        else:
+            self.emit(indent, "do {")
+            self.block(indent + 1, depth - 1, self.body_size())
+            self.emit(indent, f"}} while ({_condition(rng)});")
+
+
+def generate_c_program(functions=20, statements=40, depth=3, else_if=3, expression_terms=6, seed=1):
+    """
+    Повертає текст C-програми: functions функцій по ~statements операторів
+    (складені оператори вкладені не глибше depth, до else_if гілок "else if",
+    вирази з expression_terms операндів) та main, що викликає кожну з них.
+    """
+    rng = random.Random(seed)
+    params = {"statements": statements, "else_if": else_if, "expression_terms": expression_terms}
+    names = [f"func_{index}" for index in range(functions)]
+
+    lines = ["#include <stdio.h>", "#define LIMIT 100", "/* Синтетична програма для бенчмарків */", ""]
+    for index, name in enumerate(names):
+        writer = _FunctionWriter(rng, params, names[index + 1:index + 4])
+        lines.append(f"int {name}(int a, int b) {{")
+        writer.emit(1, "int i, j, k, x = 0, y = 1;")
+        while writer.budget > 0:
+            writer.statement(1, depth)
+        lines.extend(writer.lines)
+        lines.append("    return x + y;")
+        lines.append("}")
+        lines.append("")
+
+    lines.append("int main() {")
+    lines.append("    int a, b, x = 0;")
+    lines.append('    scanf("%d %d", &a, &b);')
+    for name in names:
+        lines.append(f"    x = x + {name}(a, b);")
+    lines.append('    printf("%d\\n", x);')
+    lines.append("    return 0;")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def preset_params(preset, **overrides):
+    """Параметри набору preset з перевизначеними (не None) значеннями."""
+    params = dict(PRESETS[preset])
+    params.update({key: value for key, value in overrides.items() if value is not None})
+    return params
+
+
+def add_size_arguments(parser):
+    """Спільні аргументи розміру програми (generate.py та run.py)."""
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="medium")
+    parser.add_argument("--functions", type=int)
+    parser.add_argument("--statements", type=int, help="операторів на функцію")
+    parser.add_argument("--depth", type=int, help="глибина вкладеності")
+    parser.add_argument("--else-if", type=int, dest="else_if", help="макс. гілок else if в ланцюжку")
+    parser.add_argument("--expression-terms", type=int, dest="expression_terms", help="операндів у виразі")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def size_params(args):
+    return preset_params(args.preset, functions=args.functions, statements=args.statements, depth=args.depth,
+                         else_if=args.else_if, expression_terms=args.expression_terms)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Генерує синтетичну C-програму для бенчмарків.")
+    add_size_arguments(parser)
+    parser.add_argument("-o", "--output", help="файл (за замовчуванням - stdout)")
+    args = parser.parse_args(argv)
+
+    source = generate_c_program(seed=args.seed, **size_params(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(source)
+    else:
+        print(source, end="")
+
+
+if __name__ == "__main__":
+    main()
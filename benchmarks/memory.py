@@ -0,0 +1,73 @@
+"""
+Звіт пам'яті AutoASD для C-файлу (те саме, що кнопка "Пам'ять..." у вікні схеми).
+
+    python -m benchmarks.memory program.c [--draw] [--function main] [-o memory.json]
+
+Файл завантажується та розбирається повністю (усі функції) під tracemalloc;
+з --draw вибрана функція ще й малюється на полотні Tk (потрібен дисплей,
+без DISPLAY запускається Xvfb, як у benchmarks.run), і у звіт потрапляють
+дерево розкладки, реєстр блоків, геометрія та елементи полотна за тегами.
+Без --output звіт друкується текстом, з --output - зберігається в JSON.
+"""
+
+import argparse
+import json
+import sys
+
+from benchmarks.run import COLORS, Main, _start_display
+
+
+def _draw(function_map, func_name):
+    """Малює функцію на прихованому полотні; повертає (root, ctx)."""
+    root = Main.tk.Tk()
+    root.withdraw()
+    canvas = Main.tk.Canvas(root, width=1200, height=800)
+    ctx = Main.DiagramContext(canvas)
+    Main.draw_flowchart_with_offset(ctx, function_map[func_name], 1.0, 1.0, 1.0, 1.0, COLORS, False, True,
+                                    cache_key=(func_name,))
+    Main._finish_scene_render(ctx)
+    return root, ctx
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Звіт пам'яті для розібраного C-файлу та його схеми.")
+    parser.add_argument("source", help="C-файл")
+    parser.add_argument("--draw", action="store_true", help="також намалювати функцію (потрібен Tk)")
+    parser.add_argument("--function", default="main", help="функція для --draw")
+    parser.add_argument("--frames", type=int, default=1, help="глибина стеку tracemalloc")
+    parser.add_argument("-o", "--output", help="JSON-файл звіту (за замовчуванням - текст у stdout)")
+    args = parser.parse_args(argv)
+
+    Main.start_memory_tracing(args.frames)
+    function_map = Main.load_c_source(args.source)
+    function_map.parse_all(max_workers=1)  # (У цьому ж процесі - щоб tracemalloc бачив виділення)
+
+    root, ctx, xvfb = None, None, None
+    if args.draw:
+        if args.function not in function_map:
+            print(f"Функцію '{args.function}' не знайдено.", file=sys.stderr)
+            return 2
+        xvfb, reason = _start_display()
+        if reason is not None:
+            print(f"Малювання неможливе: {reason}", file=sys.stderr)
+            return 2
+        root, ctx = _draw(function_map, args.function)
+    try:
+        report = Main.memory_report(function_map, ctx)
+    finally:
+        if root is not None:
+            root.destroy()
+        if xvfb is not None:
+            xvfb.terminate()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+    else:
+        print(Main.format_memory_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
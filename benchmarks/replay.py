@@ -0,0 +1,68 @@
+"""
+Відтворення запису взаємодії (кнопка "Запис взаємодії" у вікні схеми)
+під віртуальним дисплеєм і звіт затримок обробників.
+
+    python -m benchmarks.replay interaction.json program.c -o replay.json [--speed 2]
+
+Звіт (JSON): перцентилі затримки (p50/p90/p99/max, мс) для кожного типу
+події кожного віджета та разом, кількість пропущених кадрів, найдовший кадр.
+Без DISPLAY запускається Xvfb (як у benchmarks.run).
+"""
+
+import argparse
+import json
+import sys
+
+from benchmarks.run import Main, _start_display
+
+
+def replay(recording, source_path, speed=1.0):
+    """Відкриває вікно схеми для source_path, відтворює запис і повертає звіт."""
+    root = Main.tk.Tk()
+    root.withdraw()
+    result = {}
+
+    def _on_done(report):
+        result.update(report)
+        root.destroy()
+
+    handles = Main.draw_flowchart_window(root, Main.load_c_source(source_path), source_path=source_path)
+    if handles is None:
+        raise SystemExit("У файлі немає функції 'main'.")
+    handles["window"].update()  # (Вікно має бути показане, щоб координати подій збігалися)
+    handles["start_replay"](recording, _on_done, speed)
+    root.mainloop()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Відтворює запис взаємодії та міряє затримки обробників.")
+    parser.add_argument("recording", help="JSON-запис (InteractionRecorder)")
+    parser.add_argument("source", help="C-файл, для якого зроблено запис")
+    parser.add_argument("--speed", type=float, default=1.0, help="прискорення відтворення")
+    parser.add_argument("-o", "--output", help="файл звіту (за замовчуванням - stdout)")
+    args = parser.parse_args(argv)
+
+    with open(args.recording, encoding="utf-8") as f:
+        recording = json.load(f)
+    xvfb, reason = _start_display()
+    if reason is not None:
+        print(f"Відтворення неможливе: {reason}", file=sys.stderr)
+        return 2
+    try:
+        report = replay(recording, args.source, args.speed)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
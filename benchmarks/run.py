@@ -0,0 +1,210 @@
+"""
+Бенчмарк етапів AutoASD на синтетичній програмі (див. generate.py).
+
+Кожен етап вимірюється окремо, repeat разів (у звіті - найкращий та
+середній час):
+- tokenize, find_function_bodies, parse (послідовно), parse_parallel (пул процесів);
+- з Tk (потрібен дисплей; без DISPLAY запускається Xvfb, якщо встановлений,
+  інакше етапи пропускаються): layout, record (розкладка + запис сцени +
+  прив'язка стрілок), render, export_drawio, export_png.
+
+Результат - JSON (--output або stdout). Етап, повільніший за поріг
+(thresholds.json, мс, для кожного набору) або за --baseline * --tolerance,
+позначається "slow", і запуск завершується з кодом 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import add_size_arguments, generate_c_program, size_params
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import Main  # noqa: E402  (Main.py - у корені репозиторію)
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json")
+COLORS = ("#FFD1DC", "#ADD8E6", "#FFFFE0", "#CCEEFF", "#D8BFD8")  # (Кольори за замовчуванням вікна)
+
+
+def _measure(function, repeat):
+    """Виконує function() repeat разів; повертає (останній результат, [тривалості, мс])."""
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        runs.append((time.perf_counter() - start) * 1000)
+    return result, runs
+
+
+def _start_display():
+    """Дисплей для Tk (див. Main.start_virtual_display): (процес Xvfb або None, причина пропуску або None)."""
+    return Main.start_virtual_display()
+
+
+def _gui_stages(code_map, repeat, stages, skipped):
+    """Етапи, яким потрібне полотно Tk: розкладка, запис сцени, рендеринг, експорт."""
+    root = Main.tk.Tk()
+    root.withdraw()
+    try:
+        canvas = Main.tk.Canvas(root, width=1200, height=800)
+        ctx = Main.DiagramContext(canvas)
+        code_lists = [code_map[name] for name in code_map]
+
+        def layout():
+            for code_list in code_lists:
+                nodes = Main.build_flow_tree(code_list)
+                Main.layout_flow_tree(ctx, nodes, 1.0, 1.0, 1.0, 1.0)
+
+        def record():
+            return [Main._record_flowchart_scene(ctx, code_list, 1.0, 1.0, 1.0, 1.0, COLORS, False)
+                    for code_list in code_lists]
+
+        _, stages["layout"] = _measure(layout, repeat)
+        scenes, stages["record"] = _measure(record, repeat)
+
+        def render():
+            for scene in scenes:
+                canvas.delete("all")
+                ctx.reset_scene()
+                Main.SceneRenderer(ctx, scene, COLORS).run()
+            canvas.update_idletasks()
+
+        _, stages["render"] = _measure(render, repeat)
+
+        # Експортери - на найбільшій сцені
+        largest = max(scenes, key=lambda scene: len(scene["items"]))
+        canvas.delete("all")
+        ctx.reset_scene()
+        Main.SceneRenderer(ctx, largest, COLORS).run()
+        _, stages["export_drawio"] = _measure(lambda: Main.generate_drawio_xml_from_canvas(ctx), repeat)
+        with tempfile.TemporaryDirectory() as directory:
+            png_path = os.path.join(directory, "bench.png")
+            saved, runs = _measure(lambda: Main.save_full_flowchart_as_png_via_pil(ctx, png_path), repeat)
+            if (saved[0] if isinstance(saved, tuple) else saved) and os.path.exists(png_path):
+                stages["export_png"] = runs
+            else:
+                skipped["export_png"] = "експорт PNG не вдався (PostScript -> PNG потребує Ghostscript)"
+    finally:
+        root.destroy()
+
+
+def run_benchmarks(params, seed=1, repeat=3, gui=True):
+    """
+    Генерує програму та вимірює етапи. Повертає словник результатів
+    (без статусів - див. check_results).
+    """
+    source = generate_c_program(seed=seed, **params)
+    stages = {}
+    skipped = {}
+
+    tokens, stages["tokenize"] = _measure(lambda: Main.tokenize_c_source(source), repeat)
+    function_map, stages["find_function_bodies"] = _measure(lambda: Main.find_function_bodies(tokens), repeat)
+    parsed, stages["parse"] = _measure(lambda: Main.parse_all_functions(function_map, max_workers=1), repeat)
+    _, stages["parse_parallel"] = _measure(lambda: Main.parse_all_functions(function_map), repeat)
+    code_map = {name: code_list for name, (code_list, _) in parsed.items()}
+
+    gui_stage_names = ["layout", "record", "render", "export_drawio", "export_png"]
+    if gui:
+        xvfb, reason = _start_display()
+        try:
+            if reason is None:
+                _gui_stages(code_map, repeat, stages, skipped)
+        finally:
+            if xvfb is not None:
+                xvfb.terminate()
+    else:
+        reason = "--no-gui"
+    if reason is not None:
+        skipped.update({name: reason for name in gui_stage_names})
+
+    return {
+        "params": dict(params, seed=seed, repeat=repeat),
+        "source": {"bytes": len(source.encode("utf-8")), "lines": source.count("\n"),
+                   "tokens": len(tokens), "functions": len(function_map),
+                   "pseudocode_lines": sum(len(code_list) for code_list in code_map.values())},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "stages": {name: {"best_ms": min(runs), "mean_ms": statistics.mean(runs), "runs_ms": runs}
+                   for name, runs in stages.items()},
+        "skipped": skipped,
+    }
+
+
+def check_results(results, thresholds=None, baseline=None, tolerance=1.25):
+    """
+    Позначає кожен етап: "ok" або "slow" (найкращий час більший за поріг
+    thresholds[етап], мс, або за baseline-час * tolerance).
+    Повертає список повідомлень про повільні етапи.
+    """
+    failures = []
+    baseline_stages = (baseline or {}).get("stages", {})
+    for name, entry in results["stages"].items():
+        entry["status"] = "ok"
+        limit = (thresholds or {}).get(name)
+        if limit is not None:
+            entry["threshold_ms"] = limit
+            if entry["best_ms"] > limit:
+                entry["status"] = "slow"
+                failures.append(f"{name}: {entry['best_ms']:.1f} мс > поріг {limit:.1f} мс")
+        if name in baseline_stages:
+            allowed = baseline_stages[name]["best_ms"] * tolerance
+            entry["baseline_ms"] = baseline_stages[name]["best_ms"]
+            if entry["best_ms"] > allowed:
+                entry["status"] = "slow"
+                failures.append(f"{name}: {entry['best_ms']:.1f} мс > базовий {entry['baseline_ms']:.1f} мс "
+                                f"x {tolerance}")
+    results["failures"] = failures
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк етапів AutoASD на синтетичній C-програмі.")
+    add_size_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-gui", action="store_true", help="лише етапи без Tk (токенізація, парсинг)")
+    parser.add_argument("--thresholds", default=THRESHOLDS_PATH, help="JSON {набір: {етап: мс}}")
+    parser.add_argument("--baseline", help="попередній JSON-результат для порівняння")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="допустиме сповільнення відносно baseline")
+    parser.add_argument("-o", "--output", help="файл результатів (за замовчуванням - stdout)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(size_params(args), seed=args.seed, repeat=args.repeat, gui=not args.no_gui)
+    results["params"]["preset"] = args.preset
+
+    thresholds = None
+    if args.thresholds and os.path.exists(args.thresholds):
+        with open(args.thresholds, encoding="utf-8") as f:
+            thresholds = json.load(f).get(args.preset)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    failures = check_results(results, thresholds, baseline, args.tolerance)
+
+    report = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+    for name, entry in results["stages"].items():
+        print(f"{name:<22}{entry['best_ms']:>10.1f} мс  {entry['status']}", file=sys.stderr)
+    for name, reason in results["skipped"].items():
+        print(f"{name:<22}{'-':>10}     пропущено ({reason})", file=sys.stderr)
+    if failures:
+        print("ПОВІЛЬНО:\n  " + "\n  ".join(failures), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+/* Розгалуження: if / else if / else, вкладені умови,
+   умови без фігурних дужок */
+#include <stdio.h>
+
+int sign(int x) {
+    if (x > 0) {
+        return 1;
+    } else if (x < 0) {
+        return -1;
+    } else {
+        return 0;
+    }
+}
+
+int classify(int a, int b) {
+    int result = 0;
+    if (a > b)
+        result = a - b;
+    else
+        result = b - a;
+    if (a == b && a != 0) {
+        if (a > 10)
+            printf("big %d\n", a);
+        else if (a > 5) {
+            printf("medium\n");
+        }
+    }
+    return result;
+}
+
+int main() {
+    int n;
+    scanf("%d", &n);
+    printf("%d %d\n", sign(n), classify(n, 3)); // виклик двох функцій
+    return 0;
+}
@@ -0,0 +1,43 @@
+#include <stdio.h>
+/* Цикли: for / while / do-while, тіла без фігурних дужок,
+   break/continue, багаторядковий #define */
+#define SIZE 10
+#define SQUARE(x) \
+    ((x) * (x))
+
+int sum_squares(int n) {
+    int total = 0;
+    for (int i = 0; i < n; i++)
+        total += SQUARE(i);
+    return total;
+}
+
+void countdown(int n) {
+    while (n > 0) {
+        printf("%d\n", n);
+        n--;
+        if (n == 3)
+            break;
+    }
+    do {
+        n++;
+    } while (n < 5);
+}
+
+int main() {
+    int values[SIZE];
+    int i = 0, j;
+    for (i = 0; i < SIZE; i++) {
+        values[i] = i * 2;
+        for (j = 0; j < i; j++) {
+            if (values[j] % 3 == 0)
+                continue;
+            values[i] += values[j];
+        }
+    }
+    while (i > 0)
+        i -= 2;
+    countdown(values[1]);
+    printf("%d\n", sum_squares(i));
+    return 0;
+}
@@ -0,0 +1,134 @@
+"""
+Інкрементальний експорт (export_incremental): маніфест вирішує, що
+перегенерувати, що пропустити та що видалити. Лише pseudocode - без Tk.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Main  # noqa: E402  (Main.py - у корені репозиторію)
+
+SOURCE = """int square(int a) {
+    return a * a;
+}
+
+int main() {
+    int x = 0;
+    scanf("%d", &x);
+    printf("%d", square(x));
+    return 0;
+}
+"""
+
+FORMATS = ("pseudocode",)
+
+
+class ExportIncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_dir = Main.PARSE_CACHE_DIR
+        Main.PARSE_CACHE_DIR = os.path.join(self.directory.name, "cache")
+        self.src_dir = os.path.join(self.directory.name, "src")
+        self.out_dir = os.path.join(self.directory.name, "out")
+        os.makedirs(self.src_dir)
+        self.path = self._write("lab.c", SOURCE)
+
+    def tearDown(self):
+        Main.PARSE_CACHE_DIR = self.cache_dir
+        self.directory.cleanup()
+
+    def _write(self, name, text):
+        path = os.path.join(self.src_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def _export(self, files=None, force=False):
+        return Main.export_incremental(files or [self.path], self.out_dir, FORMATS, root=self.src_dir, force=force)
+
+    def _output(self, relative):
+        with open(os.path.join(self.out_dir, relative), encoding="utf-8") as f:
+            return f.read()
+
+    def _manifest(self):
+        with open(os.path.join(self.out_dir, Main.EXPORT_MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_unchanged_file_is_skipped(self):
+        report = self._export()
+        self.assertEqual(report["exported"], ["lab::square", "lab::main"])
+        self.assertIn("Вивід: square ( x )", self._output("lab/main.txt"))
+
+        report = self._export()
+        self.assertEqual(report["exported"], [])
+        self.assertEqual(sorted(report["skipped"]), ["lab::main", "lab::square"])
+        self.assertEqual(report["files_unchanged"], 1)
+
+    def test_changed_body_is_regenerated(self):
+        self._export()
+        self._write("lab.c", SOURCE.replace("return a * a;", "return a * a * a;"))
+        report = self._export()
+        self.assertEqual(report["exported"], ["lab::square"])
+        self.assertEqual(report["skipped"], ["lab::main"])
+        self.assertEqual(report["files_unchanged"], 0)
+        self.assertIn("a * a * a", self._output("lab/square.txt"))
+
+    def test_renamed_function_removes_stale_outputs(self):
+        self._export()
+        self._write("lab.c", SOURCE.replace("square", "cube"))
+        report = self._export()
+        self.assertEqual(sorted(report["exported"]), ["lab::cube", "lab::main"])
+        self.assertEqual(report["removed"], ["lab/square.txt"])
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, "lab", "square.txt")))
+        self.assertNotIn("lab::square", self._manifest()["functions"])
+
+    def test_force_regenerates_everything(self):
+        self._export()
+        report = self._export(force=True)
+        self.assertEqual(report["exported"], ["lab::square", "lab::main"])
+        self.assertEqual(report["skipped"], [])
+
+    def test_failure_keeps_old_entry_and_retries(self):
+        self._export()
+        self._write("lab.c", SOURCE.replace("return a * a;", "return a * a * a;"))
+        with mock.patch.object(Main, "render_function_outputs",
+                               side_effect=Main.RenderRequestError(503, "немає дисплея")):
+            report = self._export()
+        self.assertEqual([failure["function"] for failure in report["failed"]], ["lab::square"])
+        entry = self._manifest()["functions"]["lab::square"]
+        self.assertIsNone(entry["hash"])
+        self.assertNotIn("a * a * a", self._output("lab/square.txt"))  # (Старий результат лишився)
+
+        # Файл не змінився, але невдала функція перегенеровується
+        report = self._export()
+        self.assertEqual(report["exported"], ["lab::square"])
+        self.assertEqual(report["failed"], [])
+        self.assertIn("a * a * a", self._output("lab/square.txt"))
+
+    def test_same_name_outside_root_does_not_collide(self):
+        outside = os.path.join(self.directory.name, "other")
+        first = os.path.join(outside, "x", "u.c")
+        second = os.path.join(outside, "y", "u.c")
+        for path, value in ((first, 1), (second, 2)):
+            os.makedirs(os.path.dirname(path))
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f"int main() {{\n    return {value};\n}}\n")
+
+        report = self._export([first, second])
+        self.assertEqual(len(report["exported"]), 2)
+        self.assertEqual(len(set(report["exported"])), 2)
+        report = self._export([first, second])
+        self.assertEqual(report["exported"], [])
+        self.assertEqual(report["files_unchanged"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
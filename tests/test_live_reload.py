@@ -0,0 +1,99 @@
+"""
+Live reload (reload_c_source) на файлі, що ще редагується: незакрита '{'
+не повинна зациклювати пошук функцій (він виконується в потоці Tk).
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Main  # noqa: E402  (Main.py - у корені репозиторію)
+
+SOURCE = """int square(int a) {
+    return a * a;
+}
+
+int main() {
+    int x = 0;
+    scanf("%d", &x);
+    x = square(x);
+    printf("%d", x);
+    return 0;
+}
+"""
+
+# (Зникла '}' в кінці main - як під час набору)
+UNBALANCED = SOURCE.rstrip().rstrip("}") + "\n"
+
+
+def _call_with_timeout(function, *args, timeout=10):
+    """Викликає function(*args) в окремому потоці; зависання - провал тесту, а не тесту-раннера."""
+    result = {}
+
+    def _run():
+        try:
+            result["value"] = function(*args)
+        except BaseException as e:  # (Передаємо помилку в основний потік)
+            result["error"] = e
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise AssertionError(f"{function.__name__} не завершився за {timeout} с")
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+class LiveReloadUnbalancedBraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_dir = Main.PARSE_CACHE_DIR
+        Main.PARSE_CACHE_DIR = os.path.join(self.directory.name, "cache")
+        self.path = os.path.join(self.directory.name, "lab.c")
+        self._write(SOURCE)
+
+    def tearDown(self):
+        Main.PARSE_CACHE_DIR = self.cache_dir
+        self.directory.cleanup()
+
+    def _write(self, text):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def test_reload_with_missing_closing_brace(self):
+        code_map = Main.load_c_source(self.path)
+        self.assertEqual(list(code_map), ["square", "main"])
+        lexed = Main.lex_source_lines(Main._decode_source_lines(SOURCE.encode("utf-8")))
+
+        self._write(UNBALANCED)
+        new_map, lexed, changed = _call_with_timeout(Main.reload_c_source, code_map, lexed, self.path)
+        self.assertEqual(list(new_map), ["square", "main"])
+        self.assertEqual(changed, ["main"])
+        self.assertIn("Вивід: x", [line.strip() for line in new_map["main"]])
+        diagnostics = new_map.diagnostics("main")
+        self.assertEqual(len(diagnostics), 1)
+        self.assertEqual(diagnostics[0]["line"], 5)  # (Рядок відкриваючої '{' main)
+        self.assertEqual(new_map.diagnostics("square"), [])
+
+        # Після виправлення файлу - знову без діагностики
+        self._write(SOURCE)
+        fixed_map, _, changed = _call_with_timeout(Main.reload_c_source, new_map, lexed, self.path)
+        self.assertEqual(changed, ["main"])
+        self.assertEqual(fixed_map.diagnostics("main"), [])
+
+    def test_unclosed_body_from_parse_cache(self):
+        self._write(UNBALANCED)
+        _call_with_timeout(Main.load_c_source, self.path)
+        cached_map = _call_with_timeout(Main.load_c_source, self.path)  # (Функції - з дискового кешу)
+        self.assertEqual(len(cached_map.diagnostics("main")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
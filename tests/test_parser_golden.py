@@ -0,0 +1,98 @@
+"""
+Псевдокод парсера (parse_token_list) на фіксованих програмах: ітеративний
+розбір з явним стеком має давати той самий результат, що й рекурсивний,
+а panic mode - відновлюватись після помилки й повідомляти про неї.
+
+Еталони - tests/golden/*.txt (C-файли поруч) та хеші псевдокоду
+програм benchmarks.generate (generated.json).
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import Main  # noqa: E402  (Main.py - у корені репозиторію)
+from benchmarks.generate import generate_c_program  # noqa: E402
+
+GOLDEN_DIR = os.path.join(ROOT, "tests", "golden")
+GENERATED_PARAMS = {"functions": 3, "statements": 15}  # (Решта - за замовчуванням generate_c_program)
+
+# (Пропущена ';' після "x = x + 1": оператор "з'їдає" '{' від if, далі - зайва '}')
+MISSING_SEMICOLON = """int main() {
+    int x = 0;
+    x = x + 1
+    if (x > 0) {
+        printf("%d", x);
+    }
+    printf("%d", x * 2);
+    return 0;
+}
+"""
+
+
+def pseudocode_text(code_map):
+    """Псевдокод усіх функцій файлу: "## функція" і рядки її псевдокоду."""
+    return "".join(f"## {name}\n" + "\n".join(code_map[name]) + "\n" for name in code_map)
+
+
+class ParserGoldenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_dir = Main.PARSE_CACHE_DIR
+        Main.PARSE_CACHE_DIR = os.path.join(self.directory.name, "cache")
+
+    def tearDown(self):
+        Main.PARSE_CACHE_DIR = self.cache_dir
+        self.directory.cleanup()
+
+    def _load(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return Main.load_c_source(path)
+
+    def test_golden_sources(self):
+        names = sorted(name for name in os.listdir(GOLDEN_DIR) if name.endswith(".c"))
+        self.assertTrue(names)
+        for name in names:
+            with self.subTest(source=name):
+                code_map = Main.load_c_source(os.path.join(GOLDEN_DIR, name))
+                with open(os.path.join(GOLDEN_DIR, name[:-2] + ".txt"), encoding="utf-8") as f:
+                    self.assertEqual(pseudocode_text(code_map), f.read())
+                for func_name in code_map:
+                    self.assertEqual(code_map.diagnostics(func_name), [])
+
+    def test_generated_programs(self):
+        with open(os.path.join(GOLDEN_DIR, "generated.json"), encoding="utf-8") as f:
+            expected = json.load(f)
+        for seed, digest in expected.items():
+            with self.subTest(seed=seed):
+                code_map = self._load(f"seed{seed}.c", generate_c_program(seed=int(seed), **GENERATED_PARAMS))
+                self.assertEqual(hashlib.sha256(pseudocode_text(code_map).encode("utf-8")).hexdigest(), digest)
+
+    def test_deep_nesting_without_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 2
+        body = "if (x > 0) {\n" * depth + "x = x - 1;\n" + "}\n" * depth
+        code_map = self._load("deep.c", f"int main() {{\nint x = 5;\n{body}return 0;\n}}\n")
+        code_list = code_map["main"]
+        self.assertEqual(code_list.count("\t" * (depth - 1) + "Якщо: x > 0 то"), 1)
+        self.assertEqual(code_list[-2], "Все якщо")
+        self.assertEqual(code_map.diagnostics("main"), [])
+
+    def test_recovery_after_missing_semicolon(self):
+        code_map = self._load("broken.c", MISSING_SEMICOLON)
+        self.assertEqual(code_map["main"], ["Початок", "Ініціалізація: x = 0", "Вивід: x * 2 ", "Кінець"])
+        diagnostics = code_map.diagnostics("main")
+        self.assertEqual([(d["line"], d["near"], d["message"]) for d in diagnostics],
+                         [(4, "{", "Очікувалась ';'"), (6, "}", "Зайва '}'")])
+
+
+if __name__ == "__main__":
+    unittest.main()